@@ -0,0 +1,76 @@
+"""Import time of the package, and a guard that the lightweight entry points stay lightweight.
+
+Each case runs in a fresh interpreter, best of `--repeat` runs:
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --max_ms 150    # exit with 1 if a light case is slower
+
+Light cases must not load any of `HEAVY_MODULES`; they are only imported once something is run.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["openai", "httpx", "pydantic", "rich", "multiprocessing", "sqlite3", "pyarrow", "zstandard"]
+
+# name -> (code, light)
+CASES = {
+    "import llm_api_access": ("import llm_api_access", True),
+    "parse_args / wrapper base": ("from llm_api_access import parse_args, EntireArguments, LLMRunnerWrapperBase, Stage", True),
+    "utils": ("from llm_api_access.utils import readjson2list, iter_output_ids, omit_existing_data_wrapper", True),
+    "cli": ("from llm_api_access.cli import build_parser; build_parser()", True),
+    "runner (reference)": ("import llm_api_access.llm_runner", False),
+}
+
+MEASURE = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def measure(code: str, repeat: int) -> dict:
+    results = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(code=code, heavy=HEAVY_MODULES)],
+            cwd=REPO_DIR, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"Measuring `{code}` failed:\n{completed.stderr}")
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return {"seconds": min(result["seconds"] for result in results), "heavy": results[0]["heavy"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="llm-api-access import time benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per case, the fastest counts.")
+    parser.add_argument("--max_ms", type=float, default=0, help="Fail if a light case takes longer. 0 disables the check.")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'case':<28} {'ms':>8}  heavy modules loaded")
+    for name, (code, light) in CASES.items():
+        result = measure(code, args.repeat)
+        milliseconds = result["seconds"] * 1000
+        print(f"{name:<28} {milliseconds:>8.1f}  {', '.join(result['heavy']) or '-'}")
+        if light and len(result["heavy"]) > 0:
+            failures.append(f"'{name}' loads {result['heavy']}")
+        if light and args.max_ms > 0 and milliseconds > args.max_ms:
+            failures.append(f"'{name}' takes {milliseconds:.1f}ms > {args.max_ms:.0f}ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+"""OpenAI-compatible mock server for offline benchmarks.
+
+Serves `POST /v1/chat/completions` (plain and streaming), and the files/batches endpoints used by
+`use_batch_api`, with configurable latency distribution, error and 429 rates and response sizes.
+`GET /stats` returns request and connection counters. Run it standalone:
+
+    python benchmarks/mock_server.py --port 18080 --latency lognormal --latency_mean 0.5 --rate_limit_rate 0.01
+
+and point `base_url` at `http://127.0.0.1:18080/v1`.
+"""
+import re
+import json
+import hashlib
+import math
+import time
+import random
+import argparse
+import itertools
+import collections
+import threading
+import dataclasses
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# OpenAI caches prompts of at least 1024 tokens, in steps of 128 tokens (~4 characters each)
+PROMPT_CACHE_MIN_CHARS = 1024 * 4
+PROMPT_CACHE_BLOCK_CHARS = 128 * 4
+
+
+@dataclasses.dataclass
+class MockConfig:
+    latency: str = dataclasses.field(
+        default="lognormal", metadata={"help": "One of 'constant', 'uniform', 'exponential', 'lognormal'."}
+    )
+    latency_mean: float = dataclasses.field(
+        default=0.2, metadata={"help": "Mean time to first token in seconds."}
+    )
+    latency_sigma: float = dataclasses.field(
+        default=0.5, metadata={"help": "Shape of 'lognormal' (sigma of the underlying normal), half width of 'uniform'."}
+    )
+    slow_rate: float = dataclasses.field(
+        default=0.0, metadata={"help": "Fraction of requests whose latency is multiplied by `slow_factor`, a heavy tail."}
+    )
+    slow_factor: float = dataclasses.field(
+        default=10.0, metadata={"help": "Latency multiplier of the slow requests."}
+    )
+    time_per_token: float = dataclasses.field(
+        default=0.0, metadata={"help": "Generation time per completion token in seconds, added to the latency."}
+    )
+    time_per_prompt_token: float = dataclasses.field(
+        default=0.0, metadata={"help": "Prefill time per prompt token that isn't cached in seconds, added to the latency."}
+    )
+    prompt_cache: bool = dataclasses.field(
+        default=False, metadata={
+            "help": "Cache prompt prefixes of at least 1024 tokens in 128 token blocks once a request finished, like OpenAI."
+        }
+    )
+    prompt_cache_blocks: int = dataclasses.field(
+        default=0, metadata={"help": "Number of 128 token blocks the prompt cache keeps, least recently used first out. 0 for no limit."}
+    )
+    completion_tokens: int = dataclasses.field(
+        default=64, metadata={"help": "Mean completion length in tokens, capped by `max_completion_tokens`."}
+    )
+    completion_tokens_jitter: float = dataclasses.field(
+        default=0.5, metadata={"help": "Completion lengths vary uniformly by this fraction around the mean."}
+    )
+    error_rate: float = dataclasses.field(
+        default=0.0, metadata={"help": "Fraction of requests answered with a 500."}
+    )
+    rate_limit_rate: float = dataclasses.field(
+        default=0.0, metadata={"help": "Fraction of requests answered with a 429."}
+    )
+    capacity: int = dataclasses.field(
+        default=0, metadata={"help": "Requests beyond this many in flight are answered with a 429. 0 means unlimited."}
+    )
+    batch_delay: float = dataclasses.field(
+        default=2.0, metadata={"help": "Seconds until a submitted batch is reported as completed."}
+    )
+    seed: int = dataclasses.field(default=0, metadata={"help": "Seed of all random draws."})
+
+
+class MockState(object):
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.request_counter = itertools.count()
+        self.id_counter = itertools.count()
+        self.counts = {
+            "requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "in_flight": 0, "max_in_flight": 0,
+            "connections": 0, "open_connections": 0, "max_open_connections": 0,
+        }
+        self.files = {}
+        self.batches = {}
+        self.prompt_blocks = collections.OrderedDict()
+
+    def rng(self) -> random.Random:
+        # one generator per request, so a run draws the same values whatever the thread interleaving
+        return random.Random(f"{self.config.seed}-{next(self.request_counter)}")
+
+    def count(self, key: str, amount: int = 1) -> int:
+        with self.lock:
+            self.counts[key] += amount
+            if key in ("in_flight", "open_connections"):
+                self.counts["max_" + key] = max(self.counts["max_" + key], self.counts[key])
+            return self.counts[key]
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}-{next(self.id_counter)}"
+
+    def sample_latency(self, rng: random.Random) -> float:
+        latency = self.sample_base_latency(rng)
+        if self.config.slow_rate > 0 and rng.random() < self.config.slow_rate:
+            latency *= self.config.slow_factor
+        return latency
+
+    def sample_base_latency(self, rng: random.Random) -> float:
+        config = self.config
+        if config.latency == "constant":
+            return config.latency_mean
+        if config.latency == "uniform":
+            return max(0.0, rng.uniform(config.latency_mean - config.latency_sigma, config.latency_mean + config.latency_sigma))
+        if config.latency == "exponential":
+            return rng.expovariate(1.0 / config.latency_mean) if config.latency_mean > 0 else 0.0
+        if config.latency == "lognormal":
+            if config.latency_mean <= 0:
+                return 0.0
+            # choose mu so that the mean of the distribution is `latency_mean`
+            mu = math.log(config.latency_mean) - config.latency_sigma ** 2 / 2
+            return rng.lognormvariate(mu, config.latency_sigma)
+        raise ValueError(f"Unknown latency distribution '{config.latency}'.")
+
+    def prompt_block_hashes(self, text: str):
+        # chained, so a block only matches if the whole prefix before it matches too
+        hashes, digest = [], b""
+        for start in range(0, len(text) - PROMPT_CACHE_BLOCK_CHARS + 1, PROMPT_CACHE_BLOCK_CHARS):
+            digest = hashlib.sha1(digest + text[start:start + PROMPT_CACHE_BLOCK_CHARS].encode("utf-8")).digest()
+            hashes.append(digest)
+        return hashes
+
+    def cached_prompt_tokens(self, body: dict) -> int:
+        text = prompt_text(body)
+        if not self.config.prompt_cache or len(text) < PROMPT_CACHE_MIN_CHARS:
+            return 0
+        num_cached = 0
+        with self.lock:
+            for digest in self.prompt_block_hashes(text):
+                if digest not in self.prompt_blocks:
+                    break
+                self.prompt_blocks.move_to_end(digest)
+                num_cached += 1
+        return num_cached * PROMPT_CACHE_BLOCK_CHARS // 4
+
+    def cache_prompt(self, body: dict):
+        text = prompt_text(body)
+        if self.config.prompt_cache and len(text) >= PROMPT_CACHE_MIN_CHARS:
+            hashes = self.prompt_block_hashes(text)
+            with self.lock:
+                for digest in hashes:
+                    self.prompt_blocks[digest] = True
+                    self.prompt_blocks.move_to_end(digest)
+                while 0 < self.config.prompt_cache_blocks < len(self.prompt_blocks):
+                    self.prompt_blocks.popitem(last=False)
+
+    def sample_completion_tokens(self, rng: random.Random, body: dict) -> int:
+        jitter = self.config.completion_tokens_jitter
+        num_tokens = round(self.config.completion_tokens * rng.uniform(1 - jitter, 1 + jitter))
+        max_tokens = body.get("max_completion_tokens", None) or body.get("max_tokens", None)
+        if max_tokens is not None:
+            num_tokens = min(num_tokens, max_tokens)
+        return max(1, num_tokens)
+
+
+def prompt_text(body: dict) -> str:
+    texts = []
+    for message in body.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+    return "\n".join(texts)
+
+
+def count_prompt_tokens(body: dict) -> int:
+    # same ~4 characters per token heuristic as the client side estimate
+    return max(1, len(prompt_text(body)) // 4)
+
+
+def make_tokens(rng: random.Random, num_tokens: int):
+    return [f"tok{rng.randrange(1000)} " for _ in range(num_tokens)]
+
+
+def make_completion(state: MockState, rng: random.Random, body: dict, cached_tokens: int = 0) -> dict:
+    choices = []
+    completion_tokens = 0
+    for index in range(body.get("n", 1) or 1):
+        num_tokens = state.sample_completion_tokens(rng, body)
+        completion_tokens += num_tokens
+        choices.append({
+            "index": index,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "".join(make_tokens(rng, num_tokens))},
+        })
+    prompt_tokens = count_prompt_tokens(body)
+    return {
+        "id": state.new_id("chatcmpl"),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)},
+        },
+    }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real API
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        # one handler per TCP connection, so these count connections opened by the clients
+        super().setup()
+        self.state.count("connections")
+        self.state.count("open_connections")
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.state.count("open_connections", -1)
+
+    def send_json(self, obj, status: int = 200, headers: dict = None, raw: bytes = None):
+        data = raw if raw is not None else json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str, error_type: str, code: str, headers: dict = None):
+        self.send_json({"error": {"message": message, "type": error_type, "code": code}}, status=status, headers=headers)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.state.lock:
+                counts = dict(self.state.counts)
+            return self.send_json(counts)
+        if self.path.rstrip("/").endswith("/models"):
+            return self.send_json({"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]})
+        match = re.search(r"/batches/([^/]+)$", self.path)
+        if match is not None and match.group(1) in self.state.batches:
+            return self.send_json(self.batch_status(match.group(1)))
+        match = re.search(r"/files/([^/]+)/content$", self.path)
+        if match is not None and match.group(1) in self.state.files:
+            return self.send_json(None, raw=self.state.files[match.group(1)])
+        self.send_error_json(404, f"Unknown path '{self.path}'.", "invalid_request_error", "not_found")
+
+    def do_POST(self):
+        data = self.read_body()
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            return self.chat_completions(json.loads(data))
+        if path.endswith("/files"):
+            return self.upload_file(data)
+        if path.endswith("/batches"):
+            return self.create_batch(json.loads(data))
+        self.send_error_json(404, f"Unknown path '{self.path}'.", "invalid_request_error", "not_found")
+
+    def chat_completions(self, body: dict):
+        state, rng = self.state, self.state.rng()
+        state.count("requests")
+        in_flight = state.count("in_flight")
+        try:
+            draw = rng.random()
+            over_capacity = state.config.capacity > 0 and in_flight > state.config.capacity
+            if over_capacity or draw < state.config.rate_limit_rate:
+                state.count("rate_limited")
+                return self.send_error_json(
+                    429, "Rate limit reached for requests.", "requests", "rate_limit_exceeded",
+                    headers={"retry-after-ms": "200", "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "200ms"},
+                )
+            latency = state.sample_latency(rng)
+            if draw < state.config.rate_limit_rate + state.config.error_rate:
+                time.sleep(latency)
+                state.count("errors")
+                return self.send_error_json(500, "The server had an error while processing your request.", "server_error", "server_error")
+
+            completion = make_completion(state, rng, body, cached_tokens=state.cached_prompt_tokens(body))
+            usage = completion["usage"]
+            latency += (usage["prompt_tokens"] - usage["prompt_tokens_details"]["cached_tokens"]) * state.config.time_per_prompt_token
+            if body.get("stream", False):
+                self.stream_completion(completion, body, latency)
+            else:
+                time.sleep(latency + usage["completion_tokens"] * state.config.time_per_token)
+                self.send_json(completion, headers={"x-ratelimit-remaining-requests": "1000000", "x-ratelimit-remaining-tokens": "1000000000"})
+            state.cache_prompt(body)
+            state.count("ok")
+        except (BrokenPipeError, ConnectionResetError):
+            # client closed the stream early
+            pass
+        finally:
+            state.count("in_flight", -1)
+
+    def stream_completion(self, completion: dict, body: dict, latency: float):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload: str):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(choices, usage=None):
+            return json.dumps({
+                "id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                "model": completion["model"], "choices": choices, "usage": usage,
+            })
+
+        time.sleep(latency)
+        for choice in completion["choices"]:
+            for token in re.findall(r"\S+\s*", choice["message"]["content"]):
+                send_event(chunk([{"index": choice["index"], "delta": {"content": token}, "finish_reason": None}]))
+                if self.state.config.time_per_token > 0:
+                    time.sleep(self.state.config.time_per_token)
+            send_event(chunk([{"index": choice["index"], "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage", False):
+            send_event(chunk([], usage=completion["usage"]))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def upload_file(self, data: bytes):
+        boundary = self.headers["Content-Type"].split("boundary=")[1].encode("utf-8")
+        content = b""
+        for part in data.split(b"--" + boundary):
+            if b'name="file"' in part:
+                content = part.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n", 1)[0]
+        file_id = self.state.new_id("file")
+        self.state.files[file_id] = content
+        self.send_json({
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": "batch.jsonl", "purpose": "batch", "status": "processed",
+        })
+
+    def create_batch(self, body: dict):
+        state = self.state
+        outputs = []
+        for line in state.files[body["input_file_id"]].decode("utf-8").splitlines():
+            if len(line.strip()) == 0:
+                continue
+            request = json.loads(line)
+            rng = state.rng()
+            if rng.random() < state.config.error_rate:
+                response = {"status_code": 500, "request_id": state.new_id("req"), "body": {"error": {"message": "server_error"}}}
+            else:
+                response = {"status_code": 200, "request_id": state.new_id("req"), "body": make_completion(state, rng, request["body"])}
+            outputs.append({"id": state.new_id("batch_req"), "custom_id": request["custom_id"], "response": response, "error": None})
+        output_file_id = state.new_id("file")
+        state.files[output_file_id] = "\n".join(json.dumps(output) for output in outputs).encode("utf-8")
+
+        batch_id = state.new_id("batch")
+        state.batches[batch_id] = {
+            "batch": {
+                "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                "completion_window": body.get("completion_window", "24h"), "created_at": int(time.time()),
+                "status": "in_progress", "output_file_id": None,
+                "request_counts": {"total": len(outputs), "completed": 0, "failed": 0},
+            },
+            "output_file_id": output_file_id,
+            "completed_at": time.time() + state.config.batch_delay,
+        }
+        self.send_json(state.batches[batch_id]["batch"])
+
+    def batch_status(self, batch_id: str) -> dict:
+        entry = self.state.batches[batch_id]
+        batch = dict(entry["batch"])
+        if time.time() >= entry["completed_at"]:
+            total = batch["request_counts"]["total"]
+            batch.update(status="completed", output_file_id=entry["output_file_id"], request_counts={"total": total, "completed": total, "failed": 0})
+        return batch
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # a large backlog, so hundreds of clients connecting at once aren't refused
+    request_queue_size = 1024
+
+
+class MockServer(object):
+    """Runs the mock server on a background thread, e.g. `with MockServer(MockConfig(), port=0) as server: server.base_url`."""
+    def __init__(self, config: MockConfig = None, host: str = "127.0.0.1", port: int = 0):
+        handler = type("Handler", (MockHandler,), {"state": MockState(config or MockConfig())})
+        self.httpd = MockHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def parse_mock_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    for field in dataclasses.fields(MockConfig):
+        field_type = type(field.default)
+        if field_type is bool:
+            field_type = lambda value: value.lower() in ("1", "true", "yes", "y", "t")  # noqa: E731
+        parser.add_argument(f"--{field.name}", type=field_type, default=field.default, help=field.metadata["help"])
+    args = vars(parser.parse_args(argv))
+    host, port = args.pop("host"), args.pop("port")
+    return MockConfig(**args), host, port
+
+
+if __name__ == "__main__":
+    config, host, port = parse_mock_args()
+    server = MockServer(config, host=host, port=port)
+    print(f"Mock OpenAI server listening on {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,99 @@
+"""Write/read cost and size of the output formats and serializers, without any server:
+
+    python benchmarks/output_formats.py
+    python benchmarks/output_formats.py --num_items 50000 --response_chars 8000
+
+Results are written the way the `Consumer` does (batches of `--flush_size`, then `finalize`), and read back
+the way resuming does (`iter_output_ids`). Formats whose optional dependency is missing are skipped.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_api_access.serialization import get_serializer   # noqa: E402
+from llm_api_access.sinks import get_output_sink           # noqa: E402
+from llm_api_access.utils import iter_output_ids           # noqa: E402
+
+# name -> (file name, save_as_json)
+FORMATS = {
+    "jsonl": ("output.jsonl", False),
+    "json": ("output.json", True),
+    "jsonl.gz": ("output.jsonl.gz", False),
+    "jsonl.zst": ("output.jsonl.zst", False),
+    "parquet": ("output.parquet", False),
+    "arrow": ("output.arrow", False),
+}
+
+WORDS = ["the", "model", "answer", "is", "because", "therefore", "résumé", "数据", "step", "value", "result", "first"]
+
+
+def make_items(num_items: int, response_chars: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    items = []
+    for idx in rng.sample(range(num_items), num_items):
+        words, length = [], 0
+        while length < response_chars:
+            words.append(rng.choice(WORDS))
+            length += len(words[-1]) + 1
+        items.append({"id": idx, "query": f"question {idx}", "response": " ".join(words), "score": rng.random()})
+    return items
+
+
+def measure(items: list, filepath: str, save_as_json: bool, serializer_name: str, flush_size: int) -> dict:
+    serializer = get_serializer(serializer_name)
+    start = time.perf_counter()
+    sink = get_output_sink(filepath, save_as_json=save_as_json, serializer=serializer)
+    for idx in range(0, len(items), flush_size):
+        sink.write(items[idx: idx + flush_size])
+    write_seconds = time.perf_counter() - start
+    sink.finalize(sort_by_id=True)
+    finalize_seconds = time.perf_counter() - start - write_seconds
+
+    start = time.perf_counter()
+    num_ids = sum(1 for _ in iter_output_ids(filepath))
+    read_seconds = time.perf_counter() - start
+    assert num_ids == len(items), f"{filepath}: read {num_ids} of {len(items)} items"
+    return {
+        "write": write_seconds, "finalize": finalize_seconds, "read": read_seconds,
+        "megabytes": os.path.getsize(filepath) / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="llm-api-access output format benchmark")
+    parser.add_argument("--num_items", type=int, default=20000)
+    parser.add_argument("--response_chars", type=int, default=2000)
+    parser.add_argument("--flush_size", type=int, default=20)
+    parser.add_argument("--formats", type=str, nargs="*", default=list(FORMATS.keys()))
+    parser.add_argument("--serializers", type=str, nargs="*", default=["json", "orjson", "msgspec"])
+    args = parser.parse_args()
+
+    items = make_items(args.num_items, args.response_chars)
+    work_dir = tempfile.mkdtemp(prefix="llm-api-access-formats-")
+    print(f"{'format':<10} {'serializer':<10} {'write s':>8} {'final s':>8} {'read s':>8} {'MB':>8}")
+    try:
+        for format_name in args.formats:
+            filename, save_as_json = FORMATS[format_name]
+            for serializer_name in args.serializers:
+                filepath = os.path.join(work_dir, serializer_name + "-" + filename)
+                try:
+                    result = measure(items, filepath, save_as_json, serializer_name, args.flush_size)
+                except ImportError as exception:
+                    print(f"{format_name:<10} {serializer_name:<10} skipped: {exception}")
+                    continue
+                print(
+                    f"{format_name:<10} {serializer_name:<10} {result['write']:>8.2f} {result['finalize']:>8.2f} "
+                    f"{result['read']:>8.2f} {result['megabytes']:>8.1f}"
+                )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
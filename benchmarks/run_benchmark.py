@@ -0,0 +1,348 @@
+"""Throughput benchmark of the full `LLMRunnerWrapperBase.run_llm_api` path against the local mock server.
+
+Every scenario starts a fresh `mock_server.py` and runs the framework in its own process, then reports
+requests/s, API latency percentiles, peak RSS and the time until the first result reached the output file.
+No network access or API key is needed:
+
+    python benchmarks/run_benchmark.py                              # all scenarios
+    python benchmarks/run_benchmark.py -s threads-8 -s async-256 --num_items 500
+    python benchmarks/run_benchmark.py --output new.json --baseline old.json
+
+Server latencies are drawn from a seeded generator, so numbers are comparable between commits on the same machine.
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = "BENCHMARK_RESULT "
+
+# mock server options shared by all scenarios, see `MockConfig`
+DEFAULT_SERVER = {"latency": "lognormal", "latency_mean": 0.1, "latency_sigma": 0.5, "completion_tokens": 64}
+# `EntireArguments` shared by all scenarios
+DEFAULT_ARGUMENTS = {"num_threads": 32, "max_completion_tokens": 256, "generate_log_file": False, "save_as_json": False}
+
+SCENARIOS = {
+    "threads-8": {"arguments": {"num_threads": 8}},
+    "threads-32": {"arguments": {"num_threads": 32}},
+    "threads-128": {"arguments": {"num_threads": 128}},
+    "async-256": {"arguments": {"use_async": True, "max_concurrency": 256}},
+    "stream-32": {"server": {"time_per_token": 0.001}, "arguments": {"stream": True}},
+    "faults-32": {"server": {"error_rate": 0.02, "rate_limit_rate": 0.02}},
+    "large-responses-32": {"server": {"completion_tokens": 2000}, "arguments": {"max_completion_tokens": 4096}},
+    # provider that only takes 48 concurrent requests: fixed 128 threads vs. adaptive concurrency
+    "overload-128": {"server": {"capacity": 48, "latency_mean": 1.0}, "arguments": {"num_threads": 128}},
+    "adaptive-overload": {
+        "server": {"capacity": 48, "latency_mean": 1.0},
+        "arguments": {"adaptive_concurrency": True, "min_concurrency": 4, "max_concurrency": 128},
+    },
+    # questions about 100 long documents in random order; the server caches the prefixes of ~10 documents
+    "prefix-unordered": {
+        "dataset": "shared-context",
+        "server": {"prompt_cache": True, "prompt_cache_blocks": 200, "time_per_prompt_token": 0.0001},
+    },
+    "prefix-scheduling": {
+        "dataset": "shared-context",
+        "server": {"prompt_cache": True, "prompt_cache_blocks": 200, "time_per_prompt_token": 0.0001},
+        "arguments": {"prefix_scheduling": True},
+    },
+    # every 50th item asks for a long answer: in dataset order vs. longest expected first
+    "skewed-fifo": {
+        "dataset": "skewed",
+        "server": {"completion_tokens": 2000, "completion_tokens_jitter": 0.0, "time_per_token": 0.002},
+    },
+    "skewed-longest-first": {
+        "dataset": "skewed",
+        "server": {"completion_tokens": 2000, "completion_tokens_jitter": 0.0, "time_per_token": 0.002},
+        "arguments": {"size_aware_scheduling": True},
+    },
+    # items carrying a ~300 KB base64 attachment that isn't sent, e.g. an image kept for postprocessing
+    "large-items-32": {"dataset": "large-items"},
+    # generate -> critique -> refine, three requests per item
+    "pipeline-32": {"pipeline": True},
+    "pipeline-async-96": {"pipeline": True, "arguments": {"use_async": True, "max_concurrency": 96}},
+    # 2% of the requests take 20x longer: without and with hedging
+    "tail-32": {"server": {"slow_rate": 0.02, "slow_factor": 20.0}},
+    "tail-hedged-32": {
+        "server": {"slow_rate": 0.02, "slow_factor": 20.0},
+        "arguments": {"hedge_requests": True, "hedge_min_delay": 0.5},
+    },
+    "tail-hedged-async-32": {
+        "server": {"slow_rate": 0.02, "slow_factor": 20.0},
+        "arguments": {"use_async": True, "max_concurrency": 32, "hedge_requests": True, "hedge_min_delay": 0.5},
+    },
+    # postprocessing that parses each response for 20ms of CPU: on the consumer thread vs. 4 processes
+    "heavy-postprocess-32": {"postprocess_cpu": 0.02},
+    "heavy-postprocess-procs-32": {"postprocess_cpu": 0.02, "arguments": {"postprocess_workers": 4}},
+    # distributed mode, one process working through units of 100 items with the same runner
+    "units-32": {"distributed": True, "arguments": {"work_unit_size": 100}},
+    "batch-api": {"server": {"batch_delay": 1.0}, "arguments": {"use_batch_api": True, "batch_poll_interval": 0.5}},
+}
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_server_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def start_mock_server(server_options: dict, verbose: bool = False):
+    port = free_port()
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, "mock_server.py"), "--port", str(port)]
+    for key, value in server_options.items():
+        command += [f"--{key}", str(value)]
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen(command, stdout=output, stderr=output)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            get_server_stats(port)
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"Mock server failed to start: {' '.join(command)}")
+            time.sleep(0.05)
+
+
+class FirstWriteWatcher(object):
+    """Records when the output file first becomes non-empty."""
+    def __init__(self, filepath: str, start_time: float, poll_interval: float = 0.005):
+        self.filepath = filepath
+        self.start_time = start_time
+        self.poll_interval = poll_interval
+        self.first_write = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                if os.path.getsize(self.filepath) > 0:
+                    self.first_write = time.monotonic() - self.start_time
+                    return
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(scenario_name: str, num_items: int, base_url: str, work_dir: str) -> dict:
+    """Runs one scenario in this process. Called through `--worker` so that each run has its own RSS."""
+    from llm_api_access import EntireArguments, LLMRunnerWrapperBase, Stage
+
+    dataset = SCENARIOS[scenario_name].get("dataset", "default")
+    pipeline = SCENARIOS[scenario_name].get("pipeline", False)
+    postprocess_cpu = SCENARIOS[scenario_name].get("postprocess_cpu", 0.0)
+    distributed = SCENARIOS[scenario_name].get("distributed", False)
+
+    class BenchmarkRunner(LLMRunnerWrapperBase):
+        def load_data(self, data_args):
+            if dataset == "shared-context":
+                rng = random.Random(0)
+                documents = [f"Document {doc_idx}. " + f"sentence {doc_idx} about the topic. " * 300 for doc_idx in range(100)]
+                return [
+                    {"id": idx, "query": rng.choice(documents) + f"\n\nQuestion {idx}: what does the document say?"}
+                    for idx in range(num_items)
+                ]
+            if dataset == "large-items":
+                # distinct per item, like real images
+                return (
+                    {"id": idx, "query": f"Question {idx}: " + "lorem ipsum " * 20, "attachment": base64.b64encode(os.urandom(225000)).decode("ascii")}
+                    for idx in range(num_items)
+                )
+            if dataset == "skewed":
+                return [
+                    {"id": idx, "query": f"Question {idx}: " + "lorem ipsum " * 20, "max_completion_tokens": 2000 if idx % 50 == 49 else 32}
+                    for idx in range(num_items)
+                ]
+            return [{"id": idx, "query": f"Question {idx}: " + "lorem ipsum " * (idx % 50 + 10)} for idx in range(num_items)]
+
+        def prepare_llm_inputs(self, inputs: dict, prompt_template: str):
+            prompt = prompt_template.format(query=inputs["query"])
+            if "max_completion_tokens" in inputs:
+                return {"prompt": prompt, "max_completion_tokens": inputs["max_completion_tokens"]}
+            return prompt
+
+        def postprocess_llm_outputs(self, inputs: dict, response: str, prompt: str, *args, **kwargs):
+            end_time = time.thread_time() + postprocess_cpu
+            while time.thread_time() < end_time:
+                re.findall(r"tok(\d+)", str(response))
+            return {"id": inputs["id"], "response": response}
+
+        def stages(self):
+            if not pipeline:
+                return None
+            # generate two drafts -> critique them -> refine
+            return [
+                Stage("draft", lambda inputs, outputs: inputs["query"], n=2),
+                Stage("critique", lambda inputs, outputs: "Critique these drafts:\n" + "\n---\n".join(outputs["draft"])),
+                Stage("refine", lambda inputs, outputs: f"Improve the drafts given the critique:\n{outputs['critique'][0]}"),
+            ]
+
+    output_filepath = os.path.join(work_dir, "output.jsonl")
+    metrics_path = os.path.join(work_dir, "metrics.json")
+    arguments = EntireArguments(**{
+        **DEFAULT_ARGUMENTS,
+        **SCENARIOS[scenario_name].get("arguments", {}),
+        "llm": "mock",
+        "api_key": "sk-benchmark",
+        "base_url": base_url,
+        "output_filepath": output_filepath,
+        "metrics_path": metrics_path,
+        "work_queue_path": os.path.join(work_dir, "work_queue.sqlite") if distributed else "",
+    })
+    runner = BenchmarkRunner(arguments=arguments, prompt_template="{query}")
+
+    start_time = time.monotonic()
+    watcher = FirstWriteWatcher(output_filepath, start_time)
+    runner.run_llm_api()
+    elapsed = time.monotonic() - start_time
+    watcher.stop()
+
+    with open(output_filepath, "r", encoding="utf-8") as fin:
+        num_written = sum(1 for line in fin if len(line.strip()) > 0)
+    latency, totals = {}, {}
+    if os.path.isfile(metrics_path):
+        with open(metrics_path, "r", encoding="utf-8") as fin:
+            for metric in json.load(fin)["metrics"]:
+                if metric["name"] == "llm_request_latency_seconds" and len(metric["labels"]) == 0:
+                    latency = {key: metric[key] for key in ("p50", "p95", "p99")}
+                elif "value" in metric:
+                    totals[metric["name"]] = totals.get(metric["name"], 0) + metric["value"]
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "scenario": scenario_name,
+        "num_items": num_items,
+        "num_written": num_written,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": num_written / elapsed,
+        "latency_p50": latency.get("p50", None),
+        "latency_p95": latency.get("p95", None),
+        "latency_p99": latency.get("p99", None),
+        "time_to_first_write": watcher.first_write,
+        "cached_token_ratio": totals.get("llm_cached_tokens_total", 0) / max(totals.get("llm_prompt_tokens_total", 0), 1),
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        # kilobytes on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+    }
+
+
+def run_scenario(scenario_name: str, num_items: int, timeout: float, verbose: bool = False) -> dict:
+    scenario = SCENARIOS[scenario_name]
+    server, port = start_mock_server({**DEFAULT_SERVER, **scenario.get("server", {})}, verbose=verbose)
+    try:
+        with tempfile.TemporaryDirectory(prefix="llm-api-access-benchmark-") as work_dir:
+            command = [
+                sys.executable, os.path.abspath(__file__), "--worker", scenario_name,
+                "--num_items", str(num_items), "--base_url", f"http://127.0.0.1:{port}/v1", "--work_dir", work_dir,
+            ]
+            completed = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL,
+                text=True, timeout=timeout,
+            )
+            for line in completed.stdout.splitlines():
+                if line.startswith(RESULT_MARKER):
+                    result = json.loads(line[len(RESULT_MARKER):])
+                    break
+            else:
+                raise RuntimeError(f"Scenario '{scenario_name}' failed with exit code {completed.returncode}.")
+        result["server"] = get_server_stats(port)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def format_number(value, spec: str) -> str:
+    return "-" if value is None else format(value, spec)
+
+
+def print_results(results: list, baseline: dict = None):
+    header = f"{'scenario':<20} {'items':>6} {'req/s':>9} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'1st write s':>11} {'CPU s':>7} {'RSS MB':>8} {'429/5xx':>8} {'cached':>7} {'conns':>6}"
+    if baseline is not None:
+        header += f" {'req/s vs base':>14}"
+    print(header)
+    for result in results:
+        server = result.get("server", {})
+        line = (
+            f"{result['scenario']:<20} {result['num_written']:>6} {result['requests_per_second']:>9.1f} "
+            f"{format_number(result['latency_p50'], '.3f'):>7} {format_number(result['latency_p95'], '.3f'):>7} "
+            f"{format_number(result['latency_p99'], '.3f'):>7} {format_number(result['time_to_first_write'], '.3f'):>11} "
+            f"{result.get('cpu_seconds', 0):>7.1f} {result['peak_rss_mb']:>8.1f} {server.get('rate_limited', 0):>4}/{server.get('errors', 0):<3} "
+            f"{result.get('cached_token_ratio', 0):>7.1%} {server.get('connections', 0):>6}"
+        )
+        if baseline is not None:
+            base = baseline.get(result["scenario"], None)
+            if base is None:
+                line += f" {'-':>14}"
+            else:
+                change = result["requests_per_second"] / base["requests_per_second"] - 1
+                line += f" {change:>+13.1%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="llm-api-access throughput benchmark")
+    parser.add_argument("-s", "--scenario", action="append", default=None, choices=sorted(SCENARIOS),
+                        help="Scenario to run, may be repeated. Defaults to all.")
+    parser.add_argument("--num_items", type=int, default=1000, help="Data items per scenario.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario; the one with median req/s is reported.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds after which a scenario is aborted.")
+    parser.add_argument("--output", type=str, default="", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=str, default="", help="Results JSON of an earlier run to compare req/s with.")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the server and the framework.")
+    # internal, used by `run_scenario`
+    parser.add_argument("--worker", type=str, default="", help=argparse.SUPPRESS)
+    parser.add_argument("--base_url", type=str, default="", help=argparse.SUPPRESS)
+    parser.add_argument("--work_dir", type=str, default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if len(args.worker) > 0:
+        result = run_worker(args.worker, args.num_items, args.base_url, args.work_dir)
+        print(RESULT_MARKER + json.dumps(result), flush=True)
+        return
+
+    baseline = None
+    if len(args.baseline) > 0:
+        with open(args.baseline, "r", encoding="utf-8") as fin:
+            baseline = {result["scenario"]: result for result in json.load(fin)["results"]}
+
+    results = []
+    for scenario_name in args.scenario or list(SCENARIOS):
+        runs = []
+        for _ in range(args.repeat):
+            runs.append(run_scenario(scenario_name, args.num_items, args.timeout, verbose=args.verbose))
+        runs.sort(key=lambda result: result["requests_per_second"])
+        results.append(runs[len(runs) // 2])
+        print(f"Finished '{scenario_name}': {results[-1]['requests_per_second']:.1f} req/s", file=sys.stderr, flush=True)
+
+    print_results(results, baseline)
+    if len(args.output) > 0:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump({"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, fout, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ from .arguments import (
     RunningArguments,
 )
 from .base_wrapper import LLMRunnerWrapperBase
+from .pipeline import Stage
 
 __all__ = [
     'parse_args',
@@ -16,4 +17,5 @@ __all__ = [
     'GenerationArguments',
     'RunningArguments',
     'LLMRunnerWrapperBase',
+    'Stage',
 ]
@@ -13,9 +13,10 @@ class BaseArguments:
     def from_args(cls, arguments):
         # arguments should be dataclasses
         args_dict = dataclasses.asdict(arguments)
+        parameters = inspect.signature(cls).parameters
         return cls(**{
             k: v for k, v in args_dict.items()
-            if k in inspect.signature(cls).parameters
+            if k in parameters
         })
 
     def to_dict(self):
@@ -39,9 +40,87 @@ class LLMArguments(BaseArguments):
             )
         }
     )
+    system_prompt: str = dataclasses.field(
+        default="You are a helpful asistant.", metadata={
+            "help": "System message sent first in every request. Empty sends none. Defaults to 'You are a helpful asistant.'."
+        }
+    )
+    few_shot_filepath: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "JSON/YAML list of `{role, content}` messages sent after the system message in every request, "
+                "e.g. few-shot examples. Being identical across requests, they are cached by the provider."
+            )
+        }
+    )
+    image_downscale: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Downscale and recompress images to the resolution the model uses for `image_detail` "
+                "before sending them, which cuts upload size. Needs Pillow. Defaults to 'False'."
+            )
+        }
+    )
+    image_quality: int = dataclasses.field(
+        default=85, metadata={"help": "JPEG quality of images recompressed by `image_downscale`. Defaults to 85."}
+    )
+    image_cache_mb: float = dataclasses.field(
+        default=256, metadata={
+            "help": "Size of the in-memory cache of encoded images, keyed by content hash. Defaults to 256 MB."
+        }
+    )
     base_url: str = dataclasses.field(
         default="https://api.openai.com/v1", metadata={"help": "API base URL. Defaults to 'https://api.openai.com/v1'."}
     )
+    stream: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Stream completions, recording time-to-first-token and inter-token latency per request, "
+                "and allowing early-stop predicates to cut generation short. Defaults to 'False'."
+            )
+        }
+    )
+    endpoint_name: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "Name of the endpoint in `llm_api_access.api_keys`. If given, requests are spread over all "
+                "API keys registered under this name instead of only using `api_key`."
+            )
+        }
+    )
+    endpoints_config: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "YAML/JSON file listing several endpoints as `{name, base_url, api_keys, max_concurrency}`. "
+                "Requests are routed over all of them by observed latency and error rate, "
+                "and `base_url` / `endpoint_name` are ignored."
+            )
+        }
+    )
+    max_concurrency_per_key: int = dataclasses.field(
+        default=0, metadata={"help": "Maximum in-flight requests per API key when routing over several keys. 0 means no limit."}
+    )
+    http_max_connections: int = dataclasses.field(
+        default=1000, metadata={
+            "help": (
+                "Maximum open connections to one endpoint, shared by all workers; further requests wait for a free "
+                "connection. Defaults to 1000."
+            )
+        }
+    )
+    http_max_keepalive_connections: int = dataclasses.field(
+        default=0, metadata={
+            "help": "Idle connections kept open for reuse per endpoint. 0 keeps up to `http_max_connections`. Defaults to 0."
+        }
+    )
+    http_keepalive_expiry: float = dataclasses.field(
+        default=30.0, metadata={"help": "Seconds an idle connection is kept open. Defaults to 30."}
+    )
+    http2: bool = dataclasses.field(
+        default=False, metadata={
+            "help": "Use HTTP/2, multiplexing concurrent requests over few connections. Needs `h2`. Defaults to 'False'."
+        }
+    )
 
 
 @dataclasses.dataclass
@@ -72,7 +151,12 @@ class DataArguments(BaseArguments):
     )
     output_filepath: str = dataclasses.field(
         default="",
-        metadata={"help": "The file path to save llm-generated contents in."}
+        metadata={
+            "help": (
+                "The file path to save llm-generated contents in. The suffix picks the format: '.jsonl.gz'/'.jsonl.zst' "
+                "for compressed JSONL, '.parquet' or '.arrow' for columnar files, anything else for JSONL (or JSON)."
+            )
+        }
     )
     regenerate: bool = dataclasses.field(
         default=False, metadata={"help": "If overwrite existing data and regenerate. Defaults to 'False'."}
@@ -84,12 +168,235 @@ class RunningArguments(BaseArguments):
     num_threads: int = dataclasses.field(
         default=1, metadata={"help": "Number of threads used while querying LLM. Defaults to 1."}
     )
+    data_queue_size: int = dataclasses.field(
+        default=1024, metadata={
+            "help": (
+                "Maximum number of data items waiting for a worker. Items are pulled from `load_data` "
+                "only as workers free up, so memory stays flat for large datasets. Defaults to 1024."
+            )
+        }
+    )
     generate_log_file: bool = dataclasses.field(
         default=True, metadata={"help": "Determine if generates a log file or not."}
     )
     save_as_json: bool = dataclasses.field(
         default=False, metadata={"help": "Determine if saves the output as JSON file or JSONL file."}
     )
+    requests_per_minute: int = dataclasses.field(
+        default=0, metadata={"help": "Client-side requests-per-minute budget shared by all workers. 0 disables it."}
+    )
+    tokens_per_minute: int = dataclasses.field(
+        default=0, metadata={"help": "Client-side tokens-per-minute budget shared by all workers. 0 disables it."}
+    )
+    cache_dir: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "Directory of an on-disk response cache keyed by the request payload. "
+                "Only requests with `temperature == 0` are cached unless `cache_force` is set. Empty disables it."
+            )
+        }
+    )
+    cache_max_size_mb: float = dataclasses.field(
+        default=1024, metadata={"help": "Size of the response cache before the oldest entries are evicted. Defaults to 1024."}
+    )
+    cache_max_age_hours: float = dataclasses.field(
+        default=0, metadata={"help": "Age after which cached responses are evicted. 0 keeps them forever."}
+    )
+    cache_force: bool = dataclasses.field(
+        default=False, metadata={"help": "Cache responses even for sampling with `temperature > 0`."}
+    )
+    sort_output: bool = dataclasses.field(
+        default=True, metadata={"help": "Sort the output file by `id` at the end of the run. Defaults to 'True'."}
+    )
+    postprocess_workers: int = dataclasses.field(
+        default=0, metadata={
+            "help": (
+                "Processes running `postprocess_llm_outputs` in parallel, for CPU-heavy postprocessing. "
+                "0 runs it on the consumer thread. Defaults to 0."
+            )
+        }
+    )
+    postprocess_ordered: bool = dataclasses.field(
+        default=True, metadata={
+            "help": (
+                "With `postprocess_workers`, write results in the order they arrived. Otherwise each result is "
+                "written as soon as it's postprocessed. Defaults to 'True'."
+            )
+        }
+    )
+    serializer: Literal["auto", "orjson", "msgspec", "json"] = dataclasses.field(
+        default="auto", metadata={
+            "help": (
+                "JSON library used to write and read the output. 'auto' takes orjson, then msgspec if installed, "
+                "and falls back to the stdlib 'json'. Defaults to 'auto'."
+            )
+        }
+    )
+    work_queue_path: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "SQLite file of a work queue shared by several worker processes or hosts (distributed mode). "
+                "Every worker started with the same path claims units of the dataset, writes its own output "
+                "shard, and the last one merges all shards into `output_filepath`. "
+                "Delete the file to start a new run."
+            )
+        }
+    )
+    work_unit_size: int = dataclasses.field(
+        default=256, metadata={"help": "Number of data items per work unit in distributed mode. Defaults to 256."}
+    )
+    lease_seconds: float = dataclasses.field(
+        default=600, metadata={
+            "help": "Seconds after which a work unit of an unresponsive worker goes back to the queue. Defaults to 600."
+        }
+    )
+    worker_id: str = dataclasses.field(
+        default="", metadata={"help": "Name of this worker in distributed mode. Defaults to '<hostname>-<pid>'."}
+    )
+    prefix_scheduling: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Send data items ordered by their prompt, so that prompts sharing a prefix (e.g. the same document) "
+                "arrive back to back and hit the provider's prompt cache. Defaults to 'False'."
+            )
+        }
+    )
+    prefix_scheduling_window: int = dataclasses.field(
+        default=10000, metadata={
+            "help": "Number of data items reordered at a time by `prefix_scheduling`, bounding memory for streamed datasets. Defaults to 10000."
+        }
+    )
+    size_aware_scheduling: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Send the data items expected to take longest first, estimated from prompt length, number of images and "
+                "`max_completion_tokens`, so that the run doesn't end waiting on a few long requests dequeued last. "
+                "Overrides the order of `prefix_scheduling`. Defaults to 'False'."
+            )
+        }
+    )
+    size_aware_window: int = dataclasses.field(
+        default=100000, metadata={
+            "help": "Number of data items `size_aware_scheduling` picks the longest from, bounding memory for streamed datasets. Defaults to 100000."
+        }
+    )
+    size_aware_refine: bool = dataclasses.field(
+        default=True, metadata={
+            "help": "Refine the cost estimate of `size_aware_scheduling` from the observed request latencies. Defaults to 'True'."
+        }
+    )
+    max_item_retries: int = dataclasses.field(
+        default=5, metadata={
+            "help": (
+                "How often a data item whose request failed with a retryable error (429, 5xx, timeout, ...) is retried "
+                "before it is written to the dead-letter file. Rejected requests (e.g. content policy) aren't retried. "
+                "Defaults to 5."
+            )
+        }
+    )
+    retry_base_delay: float = dataclasses.field(
+        default=2.0, metadata={
+            "help": "Backoff before the first retry of an item in seconds, doubled for each further retry and jittered. Defaults to 2."
+        }
+    )
+    retry_max_delay: float = dataclasses.field(
+        default=120.0, metadata={"help": "Upper bound of the backoff between two retries of an item in seconds. Defaults to 120."}
+    )
+    sdk_max_retries: int = dataclasses.field(
+        default=-1, metadata={
+            "help": (
+                "How often the openai client retries a failed request itself, within one attempt of an item. "
+                "Defaults to 0 while `max_item_retries` retries failed items without blocking a worker, 5 otherwise."
+            )
+        }
+    )
+    dead_letter_path: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "JSONL file of the items that failed permanently in the last run, with their errors. "
+                "Defaults to '<output_filepath>.failed.jsonl'."
+            )
+        }
+    )
+    replay_dead_letters: bool = dataclasses.field(
+        default=False, metadata={
+            "help": "Only run the items of `dead_letter_path` instead of calling `load_data`. Defaults to 'False'."
+        }
+    )
+    use_async: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Run requests on an asyncio event loop with `openai.AsyncOpenAI` instead of a thread pool. "
+                "`num_threads` is ignored in this mode, use `max_concurrency` instead. Defaults to 'False'."
+            )
+        }
+    )
+    max_concurrency: int = dataclasses.field(
+        default=256, metadata={
+            "help": (
+                "Maximum number of in-flight requests when `use_async` or `adaptive_concurrency` is set. "
+                "Defaults to 256."
+            )
+        }
+    )
+    adaptive_concurrency: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Adjust the number of in-flight requests between `min_concurrency` and `max_concurrency` during "
+                "the run: grow it while latency and error rate stay healthy, back off on 429s, timeouts and latency "
+                "spikes. Replaces `num_threads`, the thread pool then has `max_concurrency` workers. Defaults to 'False'."
+            )
+        }
+    )
+    min_concurrency: int = dataclasses.field(
+        default=4, metadata={"help": "Lower bound of `adaptive_concurrency`, also its starting point. Defaults to 4."}
+    )
+    hedge_requests: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Send a duplicate of a request that is slower than `hedge_percentile` of the recent latencies, "
+                "to the least loaded key/endpoint, and keep whichever answers first. Defaults to 'False'."
+            )
+        }
+    )
+    hedge_percentile: float = dataclasses.field(
+        default=0.95, metadata={"help": "Latency percentile after which a request is hedged. Defaults to 0.95."}
+    )
+    hedge_min_delay: float = dataclasses.field(
+        default=1.0, metadata={"help": "Seconds a request runs at least before it is hedged. Defaults to 1.0."}
+    )
+    hedge_budget: float = dataclasses.field(
+        default=0.05, metadata={"help": "At most this fraction of requests gets a hedge, capping the extra load. Defaults to 0.05."}
+    )
+    use_batch_api: bool = dataclasses.field(
+        default=False, metadata={
+            "help": (
+                "Submit all requests through the provider's Batch API and wait for the results, "
+                "instead of requesting in real time. Defaults to 'False'."
+            )
+        }
+    )
+    batch_shard_size: int = dataclasses.field(
+        default=50000, metadata={"help": "Maximum number of requests in one batch input file. Defaults to 50000."}
+    )
+    batch_poll_interval: float = dataclasses.field(
+        default=60, metadata={"help": "Seconds between two status checks of submitted batches. Defaults to 60."}
+    )
+    batch_completion_window: str = dataclasses.field(
+        default="24h", metadata={"help": "Completion window of submitted batches. Defaults to '24h'."}
+    )
+    metrics_path: str = dataclasses.field(
+        default="", metadata={
+            "help": (
+                "File the run metrics (throughput, latency percentiles, tokens, errors, queue depths) are "
+                "written to periodically: a Prometheus textfile if it ends with '.prom', JSON otherwise. "
+                "Empty only logs a summary at the end of the run."
+            )
+        }
+    )
+    metrics_interval: float = dataclasses.field(
+        default=10, metadata={"help": "Seconds between two writes of `metrics_path`. Defaults to 10."}
+    )
 
 
 @dataclasses.dataclass
@@ -1,15 +1,21 @@
 import os
 import logging
+import dataclasses
+from typing import Callable, List, Sized
 from .utils import (
     get_logger,
     llm_inputs_wrapper,
+    async_llm_inputs_wrapper,
     omit_existing_data_wrapper,
+    peek_iterable,
 )
 from .arguments import (
     DataArguments,
     EntireArguments,
 )
-from .llm_runner import LLMRunner
+from .retry import dead_letter_filepath, load_dead_letters
+from .prompts import prefix_scheduled
+from .pipeline import Stage, pipeline_wrapper, async_pipeline_wrapper
 
 
 class LLMRunnerWrapperBase:
@@ -17,9 +23,14 @@ class LLMRunnerWrapperBase:
         self,
         arguments: EntireArguments,
         prompt_template: str,
+        stop_predicates: List[Callable[[str], bool]] = None,
     ):
+        """`stop_predicates` are only used with `stream`: generation of a choice is cut short
+        as soon as one of them returns True for the text generated so far.
+        """
         self.arguments = arguments
         self.prompt_template = prompt_template
+        self.stop_predicates = stop_predicates
 
         if self.arguments.generate_log_file:
             self.logger = get_logger(output_dir=os.path.dirname(self.arguments.output_filepath))
@@ -27,6 +38,7 @@ class LLMRunnerWrapperBase:
             self.logger = logging.getLogger(__file__)
 
     def load_data(self, data_args: DataArguments):
+        """Return a list of dict items, or any iterable (e.g. a generator) to stream a large dataset."""
         raise NotImplementedError
 
     def prepare_llm_inputs(self, inputs: dict, prompt_template: str):
@@ -35,30 +47,162 @@ class LLMRunnerWrapperBase:
     def postprocess_llm_outputs(self, inputs: dict, response: str, prompt: str, *args, **kwargs):
         raise NotImplementedError
 
+    def stages(self) -> List[Stage]:
+        """Override to run several chat turns per data item, e.g. generate -> critique -> refine.
+
+        Each `Stage` builds its prompt from the data item and the results of the earlier stages, and items
+        go through the stages independently, so the whole chain takes one run. `prepare_llm_inputs` isn't
+        used then, and `postprocess_llm_outputs` gets `response` as `{stage name: list of choices}` and
+        `prompt` as `{stage name: prompt}`. Returns None for a single `prepare_llm_inputs` turn per item.
+        """
+        return None
+
+    def first_llm_inputs(self, inputs: dict, prompt_template: str):
+        """Inputs of the first request of a data item, to estimate its prefix and cost before it is sent."""
+        stages = self.stages()
+        if stages is None:
+            return self.prepare_llm_inputs(inputs, prompt_template)
+        return stages[0].prepare_func(inputs, {})
+
+    def prompt_text(self, item: dict) -> str:
+        prompt = self.first_llm_inputs(item, self.prompt_template)
+        return prompt if isinstance(prompt, str) else prompt["prompt"]
+
+    def schedule(self, dataset):
+        """Order the dataset for sending, see `prefix_scheduling`."""
+        if not self.arguments.prefix_scheduling:
+            return dataset
+        # lead each group by twice the requests in flight
+        if self.arguments.adaptive_concurrency or self.arguments.use_async:
+            concurrency = self.arguments.max_concurrency
+        else:
+            concurrency = self.arguments.num_threads
+        return prefix_scheduled(
+            dataset, self.prompt_text, window=self.arguments.prefix_scheduling_window, lead=2 * concurrency,
+        )
+
+    def build_runner(self, arguments: EntireArguments):
+        # the runners pull in openai and rich, only loaded once something is run
+        from .llm_runner import LLMRunner, AsyncLLMRunner
+        from .batch_runner import BatchLLMRunner
+
+        stages = self.stages()
+        if arguments.use_batch_api:
+            if stages is not None:
+                raise ValueError("Multi-stage pipelines can't run on the Batch API, set `use_batch_api` to False.")
+            # the batch runner builds payloads itself and never calls `chat_one_turn`
+            runner_cls, producer_process_func = BatchLLMRunner, self.prepare_llm_inputs
+        elif arguments.use_async:
+            runner_cls = AsyncLLMRunner
+            if stages is None:
+                producer_process_func = async_llm_inputs_wrapper(self.prepare_llm_inputs)
+            else:
+                producer_process_func = async_pipeline_wrapper(stages)
+        else:
+            runner_cls = LLMRunner
+            if stages is None:
+                producer_process_func = llm_inputs_wrapper(self.prepare_llm_inputs)
+            else:
+                producer_process_func = pipeline_wrapper(stages)
+        return runner_cls(
+            arguments=arguments,
+            prompt_template=self.prompt_template,
+            producer_process_func=producer_process_func,
+            consumer_postprocess_func=self.postprocess_llm_outputs,
+            logger=self.logger,
+            stop_predicates=self.stop_predicates,
+            prepare_inputs_func=self.first_llm_inputs,
+        )
+
     def run_llm_api(self):
         output_filepath = self.arguments.output_filepath
+        # only created by the logger otherwise, i.e. missing with `generate_log_file=False`
+        os.makedirs(os.path.dirname(os.path.abspath(output_filepath)), exist_ok=True)
+        if len(self.arguments.work_queue_path) > 0:
+            return self.run_distributed()
+
+        dead_letter_path = dead_letter_filepath(output_filepath, self.arguments.dead_letter_path)
 
         data_args = DataArguments.from_args(self.arguments)
-        dataset = omit_existing_data_wrapper(self.load_data)(data_args)
+        if self.arguments.replay_dead_letters:
+            dead_letters = load_dead_letters(dead_letter_path)
+            self.logger.info(f"Replay {len(dead_letters)} item(s) of '{dead_letter_path}'.")
+            dataset = omit_existing_data_wrapper(lambda data_args: dead_letters)(data_args)
+        else:
+            dataset = omit_existing_data_wrapper(self.load_data)(data_args)
+        # failed items aren't in the output, so they are run again anyway; the file only lists this run's failures
+        if os.path.isfile(dead_letter_path):
+            os.remove(dead_letter_path)
 
-        if len(dataset) == 0:
+        is_empty, dataset = peek_iterable(dataset)
+        if is_empty:
             self.logger.info("There is no data need to be run. Experiment finished.")
             return
 
+        num_dataitems = len(dataset) if isinstance(dataset, Sized) else "unknown (streaming)"
         self.logger.info(
-            f"Model: {self.arguments.llm}, # Data Items: {len(dataset)}"
+            f"Model: {self.arguments.llm}, # Data Items: {num_dataitems}"
         )
 
         # load & run llm
-        runner = LLMRunner(
-            arguments=self.arguments,
-            prompt_template=self.prompt_template,
-            producer_process_func=llm_inputs_wrapper(self.prepare_llm_inputs),
-            consumer_postprocess_func=self.postprocess_llm_outputs,
-            logger=self.logger,
-        )
-        runner.run(
-            data_items=dataset,
-            num_threads=self.arguments.num_threads,
-            output_filename=output_filepath,
+        runner = self.build_runner(self.arguments)
+        try:
+            runner.run(
+                data_items=self.schedule(dataset),
+                num_threads=self.arguments.num_threads,
+                output_filename=output_filepath,
+            )
+        finally:
+            runner.close()
+
+    def run_distributed(self):
+        """Work on a dataset together with other processes/hosts sharing `work_queue_path`, see `WorkQueue`."""
+        from .distributed import WorkQueue, LeaseKeeper, merge_output_shards, output_shard_path
+
+        output_filepath = self.arguments.output_filepath
+        data_args = DataArguments.from_args(self.arguments)
+
+        work_queue = WorkQueue(
+            db_path=self.arguments.work_queue_path,
+            lease_seconds=self.arguments.lease_seconds,
+            worker_id=self.arguments.worker_id,
         )
+        if work_queue.initialize(
+            load_dataset=lambda: self.schedule(omit_existing_data_wrapper(self.load_data)(data_args)),
+            unit_size=self.arguments.work_unit_size,
+        ):
+            self.logger.info(f"Worker '{work_queue.worker_id}' filled the work queue '{self.arguments.work_queue_path}'.")
+
+        # each worker appends to its own JSONL shard, which is merged (and sorted) once at the end
+        shard_arguments = dataclasses.replace(self.arguments, save_as_json=False, sort_output=False)
+        shard_filepath = output_shard_path(output_filepath, work_queue.worker_id)
+        runner = self.build_runner(shard_arguments)
+        try:
+            for unit in work_queue.iter_units():
+                self.logger.info(
+                    f"Worker '{work_queue.worker_id}' works on unit {unit.unit_id} ({len(unit.items)} items)."
+                )
+                try:
+                    with LeaseKeeper(work_queue, unit, logger=self.logger):
+                        runner.run(
+                            data_items=unit.items,
+                            num_threads=self.arguments.num_threads,
+                            output_filename=shard_filepath,
+                        )
+                except BaseException:
+                    # its output is incomplete, another worker (or the next run) does the unit again
+                    work_queue.release(unit)
+                    raise
+                if not work_queue.complete(unit):
+                    # its new owner redoes it; the merge drops the duplicates
+                    self.logger.warning(f"\033[91mLost the lease of unit {unit.unit_id} before completing it.\033[0m")
+        finally:
+            runner.close()
+
+        if work_queue.claim_merge():
+            with LeaseKeeper(work_queue, logger=self.logger):
+                num_merged = merge_output_shards(
+                    output_filepath, save_as_json=self.arguments.save_as_json, serializer=self.arguments.serializer
+                )
+            work_queue.complete_merge()
+            self.logger.info(f"Merged {num_merged} items of all workers into '{output_filepath}'.")
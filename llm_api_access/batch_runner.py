@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import signal
+from typing import Iterable, List
+from queue import Queue
+from openai.types.chat import ChatCompletion
+from .id_index import IdIndex
+from .llm_runner import LLMRunner
+from .llm_requester import LLMRequester
+
+
+# the Batch API accepts input files of at most 200 MB
+MAX_SHARD_BYTES = 190 * 1024 * 1024
+FINISHED_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchShard(object):
+    """One batch input file plus what is needed to map its results back to data items.
+
+    Files of a shard live in the batch directory next to the output file:
+    `<name>.requests.jsonl` is uploaded, `<name>.inputs.jsonl` keeps `{custom_id, item, prompt}`
+    and `<name>.state.json` remembers the batch id, so an interrupted run picks up where it stopped.
+    """
+    def __init__(self, batch_dir: str, name: str):
+        self.batch_dir = batch_dir
+        self.name = name
+        self.requests_filepath = os.path.join(batch_dir, f"{name}.requests.jsonl")
+        self.inputs_filepath = os.path.join(batch_dir, f"{name}.inputs.jsonl")
+        self.results_filepath = os.path.join(batch_dir, f"{name}.results.jsonl")
+        self.state_filepath = os.path.join(batch_dir, f"{name}.state.json")
+        self.state = {}
+        if os.path.isfile(self.state_filepath):
+            with open(self.state_filepath, "r", encoding="utf-8") as fin:
+                self.state = json.load(fin)
+
+    def save_state(self, **kwargs):
+        self.state.update(kwargs)
+        tmp_filepath = self.state_filepath + ".tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as fout:
+            json.dump(self.state, fout)
+        os.replace(tmp_filepath, self.state_filepath)
+
+    def iter_inputs(self):
+        with open(self.inputs_filepath, "r", encoding="utf-8") as fin:
+            for line in fin:
+                yield json.loads(line)
+
+    def remove(self):
+        for filepath in (self.requests_filepath, self.inputs_filepath, self.results_filepath, self.state_filepath):
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+
+    @classmethod
+    def list_shards(cls, batch_dir: str) -> List["BatchShard"]:
+        if not os.path.isdir(batch_dir):
+            return []
+        names = sorted(
+            filename[:-len(".inputs.jsonl")] for filename in os.listdir(batch_dir)
+            if filename.endswith(".inputs.jsonl")
+        )
+        return [cls(batch_dir, name) for name in names]
+
+
+class BatchLLMRunner(LLMRunner):
+    """Runs a dataset through the provider's Batch API instead of real-time requests.
+
+    Payloads are built by `LLMRequester.get_payload` and written to sharded batch JSONL files.
+    The shards are uploaded, submitted and polled. Their results are mapped back to the data items by
+    `custom_id` and go through `postprocess_llm_outputs` and the usual `Consumer`. Pass the raw
+    `prepare_llm_inputs` as `producer_process_func`.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # no retry scheduler here, the client retries uploads and polls itself
+        max_retries = self.arguments.sdk_max_retries if self.arguments.sdk_max_retries >= 0 else 5
+        self.llm_requester = LLMRequester(
+            arguments=self.arguments, image_encoder=self.image_encoder, http_clients=self.http_clients,
+            max_retries=max_retries,
+        )
+        self.client = self.llm_requester.openai_client
+
+    def write_shards(self, data_items: Iterable, batch_dir: str, skip_ids: set) -> List[BatchShard]:
+        shards = []
+        # unique across runs that start within the same second
+        run_name = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        shard, requests_file, inputs_file = None, None, None
+        num_requests, num_bytes = 0, 0
+        try:
+            for item in data_items:
+                if item['id'] in skip_ids:
+                    continue
+                if shard is None or num_requests >= self.arguments.batch_shard_size or num_bytes >= MAX_SHARD_BYTES:
+                    if shard is not None:
+                        requests_file.close()
+                        inputs_file.close()
+                    shard = BatchShard(batch_dir, f"shard-{run_name}-{len(shards):05d}")
+                    shards.append(shard)
+                    requests_file = open(shard.requests_filepath, "w", encoding="utf-8")
+                    inputs_file = open(shard.inputs_filepath, "w", encoding="utf-8")
+                    num_requests, num_bytes = 0, 0
+
+                prompt = self.producer_process_func(item, self.prompt_template)
+                if isinstance(prompt, str):
+                    prompt = {"prompt": prompt}
+                custom_id = f"{shard.name}-{num_requests}"
+                payload = self.llm_requester.get_payload(**{**self.gen_kwargs, **prompt})
+                request_line = json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": payload,
+                }, ensure_ascii=False) + "\n"
+                requests_file.write(request_line)
+                inputs_file.write(json.dumps({"custom_id": custom_id, "item": item, "prompt": prompt}, ensure_ascii=False) + "\n")
+                num_requests += 1
+                num_bytes += len(request_line.encode("utf-8"))
+        finally:
+            if shard is not None:
+                requests_file.close()
+                inputs_file.close()
+        return shards
+
+    def submit_shard(self, shard: BatchShard):
+        with open(shard.requests_filepath, "rb") as fin:
+            input_file = self.client.files.create(file=fin, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.arguments.batch_completion_window,
+        )
+        shard.save_state(input_file_id=input_file.id, batch_id=batch.id)
+        self.logger.info(f"Submitted batch '{batch.id}' for shard '{shard.name}'.")
+
+    def download(self, file_id: str, filepath: str):
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            response.stream_to_file(filepath)
+
+    def collect_shard(self, shard: BatchShard, batch, queue: Queue, written_ids: set):
+        """Queue the results of a finished batch. The shard is kept until the consumer has written them."""
+        if batch.status != "completed":
+            self.logger.error(
+                f"\033[91mBatch '{batch.id}' of shard '{shard.name}' ended as '{batch.status}': {batch.errors}\033[0m"
+            )
+        if batch.error_file_id is not None:
+            self.logger.error(f"\033[91mBatch '{batch.id}' has failed requests, see file '{batch.error_file_id}'.\033[0m")
+
+        results = {}
+        if batch.output_file_id is not None:
+            self.download(batch.output_file_id, shard.results_filepath)
+            with open(shard.results_filepath, "r", encoding="utf-8") as fin:
+                for line in fin:
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+                    result = json.loads(line)
+                    response = result.get("response") or {}
+                    if result.get("error") is not None or response.get("status_code") != 200:
+                        self.logger.error(f"\033[91mBatch request '{result['custom_id']}' failed: {result.get('error') or response}\033[0m")
+                        continue
+                    completion = ChatCompletion.model_validate(response["body"])
+                    results[result["custom_id"]] = self.llm_requester.parse_completion(completion)
+
+        for inputs in shard.iter_inputs():
+            response = results.get(inputs["custom_id"], None)
+            if response is None:
+                # left out of the output, so that the next run picks it up again
+                continue
+            if inputs["item"]["id"] in written_ids:
+                # written before an interrupted run could remove the shard
+                continue
+            queue.put([inputs["item"], inputs["prompt"], response])
+
+    def poll(self, shards: List[BatchShard], queue: Queue, written_ids: set) -> List[BatchShard]:
+        """Collect the shards as their batches finish; returns the collected ones."""
+        collected = []
+        pending = list(shards)
+        while len(pending) > 0:
+            still_pending = []
+            for shard in pending:
+                batch = self.client.batches.retrieve(shard.state["batch_id"])
+                if batch.status in FINISHED_BATCH_STATUSES:
+                    self.collect_shard(shard, batch, queue, written_ids)
+                    collected.append(shard)
+                else:
+                    still_pending.append(shard)
+            pending = still_pending
+            if len(pending) > 0:
+                time.sleep(self.arguments.batch_poll_interval)
+        return collected
+
+    def run(
+        self,
+        data_items: Iterable,
+        num_threads: int,
+        output_filename: str,
+        *args,
+        **kwargs
+    ):
+        batch_dir = output_filename + ".batch"
+        os.makedirs(batch_dir, exist_ok=True)
+
+        # shards of an interrupted run are still being processed by the provider, don't submit them twice
+        shards = BatchShard.list_shards(batch_dir)
+        skip_ids, written_ids = set(), set()
+        for shard in shards:
+            for inputs in shard.iter_inputs():
+                skip_ids.add(inputs["item"]["id"])
+        if len(shards) > 0:
+            self.logger.info(f"Resuming {len(shards)} batch shard(s) from '{batch_dir}'.")
+            id_index = IdIndex(output_filename)
+            if id_index.exists():
+                written_ids = id_index.load() & skip_ids
+        shards += self.write_shards(data_items, batch_dir, skip_ids)
+
+        queue = Queue()
+        consumer = self.build_consumer(
+            queue=queue,
+            num_producers=1,
+            num_dataitems=None,
+            output_filename=output_filename,
+            *args,
+            **kwargs,
+        )
+        exporter = self.start_metrics_exporter()
+        consumer.run()
+        collected = []
+        producer_exception = None
+        try:
+            for shard in shards:
+                if "batch_id" not in shard.state:
+                    self.submit_shard(shard)
+            collected = self.poll(shards, queue, written_ids)
+        except Exception as e:
+            producer_exception = e
+            self.logger.error(f"Batch runner failed because: {e}")
+        finally:
+            queue.put(signal.SIGTERM)
+        consumer.join()
+        self.log_summary(exporter)
+        self.check_run(consumer, producer_exception)
+        # only now are the results on disk; a crash before this point collects the shards again
+        for shard in collected:
+            shard.remove()
+
+        if len(os.listdir(batch_dir)) == 0:
+            shutil.rmtree(batch_dir, ignore_errors=True)
@@ -0,0 +1,98 @@
+"""Command line interface: `llm-api-access run ...` / `llm-api-access status ...`, or `python -m llm_api_access`."""
+import os
+import sys
+import argparse
+import dataclasses
+from typing import Iterable
+from .arguments import EntireArguments, DataArguments, parse_args, _parse_dataclass_field
+from .base_wrapper import LLMRunnerWrapperBase
+from .id_index import IdIndex
+from .sinks import is_empty_output, iter_items
+from .utils import iter_output_ids
+
+
+def iter_dataset(filepath: str) -> Iterable[dict]:
+    """Items of a JSON list, a (compressed) JSONL or a Parquet/Arrow file, streamed for JSONL.
+    Items without `id` get their line number."""
+    for idx, item in enumerate(iter_items(filepath)):
+        if "id" not in item:
+            item = {"id": idx, **item}
+        yield item
+
+
+class TemplateRunner(LLMRunnerWrapperBase):
+    """Fills `prompt_template` with the fields of each data item, e.g. `"Answer: {question}"`, and saves
+    the item with its `prompt` and `response`."""
+    def load_data(self, data_args: DataArguments):
+        return iter_dataset(data_args.dataset_filepath)
+
+    def prepare_llm_inputs(self, inputs: dict, prompt_template: str):
+        return prompt_template.format(**inputs)
+
+    def postprocess_llm_outputs(self, inputs: dict, response: str, prompt: str, *args, **kwargs):
+        return {**inputs, "prompt": prompt, "response": response}
+
+
+def run_command(args: argparse.Namespace):
+    if len(args.config) > 0:
+        arguments = parse_args(cfg_file=args.config)
+    else:
+        arguments = EntireArguments(**{
+            field.name: getattr(args, field.name) for field in dataclasses.fields(EntireArguments)
+        })
+    prompt_template = args.prompt_template
+    if len(args.prompt_template_file) > 0:
+        with open(args.prompt_template_file, "r", encoding="utf-8") as fin:
+            prompt_template = fin.read()
+    TemplateRunner(arguments=arguments, prompt_template=prompt_template).run_llm_api()
+    return 0
+
+
+def status_command(args: argparse.Namespace):
+    """Print how many items of the dataset are in the output, exit with 1 while some are missing."""
+    done_ids = set()
+    if os.path.isfile(args.output_filepath) and not is_empty_output(args.output_filepath):
+        id_index = IdIndex(args.output_filepath)
+        # read-only, unlike a run this doesn't rebuild a stale index
+        done_ids = id_index.load() if id_index.is_fresh() else set(iter_output_ids(args.output_filepath))
+    num_items = num_done = 0
+    for item in iter_dataset(args.dataset_filepath):
+        num_items += 1
+        num_done += item["id"] in done_ids
+    print(f"{num_done}/{num_items} items done, {num_items - num_done} remaining.")
+    return 0 if num_done == num_items else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="llm-api-access", description="Query an LLM API for every item of a dataset.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="Fill a prompt template with each item of a JSON/JSONL/Parquet dataset and query the LLM.")
+    run_parser.add_argument(
+        "--prompt_template", type=str, default="{query}",
+        help="Python format string filled with the fields of each data item. Defaults to '{query}'.",
+    )
+    run_parser.add_argument("--prompt_template_file", type=str, default="", help="Read the prompt template from this file.")
+    run_parser.add_argument(
+        "--config", type=str, default="",
+        help="YAML/JSON file with all arguments, as read by `parse_args`. The other flags are ignored then.",
+    )
+    for field in dataclasses.fields(EntireArguments):
+        _parse_dataclass_field(parser=run_parser, field=field)
+    run_parser.set_defaults(func=run_command)
+
+    status_parser = subparsers.add_parser("status", help="Count the items of a dataset that are already in the output.")
+    status_parser.add_argument("--dataset_filepath", type=str, required=True)
+    status_parser.add_argument("--output_filepath", type=str, required=True)
+    status_parser.set_defaults(func=status_command)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
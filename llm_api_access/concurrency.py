@@ -0,0 +1,177 @@
+import time
+import asyncio
+import threading
+import openai
+
+
+# EWMA smoothing factors of the recent and the long-term request latency
+SHORT_ALPHA = 0.1
+LONG_ALPHA = 0.01
+
+
+def is_congestion_error(error: Exception) -> bool:
+    """The provider is overloaded or limiting us, so fewer requests should be in flight."""
+    if isinstance(error, openai.RateLimitError):
+        # out of quota doesn't get better by sending less
+        return getattr(error, "code", None) != "insufficient_quota"
+    return isinstance(error, (openai.APITimeoutError, openai.InternalServerError))
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AsyncWaiters(object):
+    """Coroutines waiting for a slot, each on a future of its own, woken from any thread.
+
+    Not locked itself: callers hold the lock that guards the slots, so a waiter can't miss a wake-up.
+    """
+    def __init__(self):
+        self.waiters = []
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+    def add(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        return future
+
+    def notify(self, n: int = 1):
+        """Wake the `n` longest waiting coroutines."""
+        woken, self.waiters = self.waiters[:max(n, 0)], self.waiters[max(n, 0):]
+        for future in woken:
+            self._wake(future)
+
+    def notify_all(self):
+        self.notify(len(self.waiters))
+
+    def discard(self, future: asyncio.Future):
+        """Forget a waiter that stopped waiting. If it had been woken already, the wake-up goes to the next one."""
+        if future in self.waiters:
+            self.waiters.remove(future)
+        else:
+            self.notify(1)
+
+    def _wake(self, future: asyncio.Future):
+        loop = future.get_loop()
+        try:
+            is_own_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            is_own_loop = False
+        if is_own_loop:
+            _wake(future)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(_wake, future)
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """AIMD limit on the number of in-flight requests, shared by all workers of a run.
+
+    The limit starts at `min_limit` and grows by one per success (slow start) until the first sign of
+    congestion, then by one per round trip. A 429, timeout or 5xx multiplies it by `backoff_ratio`, and so does
+    the recent latency rising above `latency_tolerance` times its long-term average; at most one decrease per round trip, since
+    the requests in flight at that moment all report the same congestion. The limit only grows while it is
+    actually used, so it doesn't run away when the data source is the bottleneck.
+    """
+    def __init__(
+        self,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        latency_tolerance: float = 2.0,
+        backoff_ratio: float = 0.7,
+        logger=None,
+    ):
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError(f"Invalid concurrency bounds [{min_limit}, {max_limit}].")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.logger = logger
+
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.slow_start = True
+        self.short_latency = None
+        self.long_latency = None
+        self.last_decrease = 0.0
+        self.num_decreases = 0
+        self.condition = threading.Condition()
+        self.async_waiters = AsyncWaiters()
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self.condition:
+            while not self._try_acquire():
+                self.condition.wait()
+
+    async def async_acquire(self):
+        while True:
+            with self.condition:
+                if self._try_acquire():
+                    return
+                waiter = self.async_waiters.add()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.condition:
+                    self.async_waiters.discard(waiter)
+                raise
+
+    def _notify(self):
+        self.condition.notify_all()
+        self.async_waiters.notify(int(self.limit) - self.in_flight)
+
+    def _decrease(self, now: float, reason: str):
+        # one decrease per round trip
+        if now - self.last_decrease < (self.short_latency or 1.0):
+            return
+        previous = self.limit
+        self.limit = max(float(self.min_limit), self.limit * self.backoff_ratio)
+        self.slow_start = False
+        self.last_decrease = now
+        self.num_decreases += 1
+        if self.logger is not None:
+            self.logger.debug(f"Concurrency limit {previous:.0f} -> {self.limit:.0f} because of {reason}.")
+
+    def _observe(self, latency: float):
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = latency
+            return
+        self.short_latency = (1 - SHORT_ALPHA) * self.short_latency + SHORT_ALPHA * latency
+        self.long_latency = (1 - LONG_ALPHA) * self.long_latency + LONG_ALPHA * latency
+
+    def cancel(self):
+        """Give back a slot whose request was never sent."""
+        with self.condition:
+            self.in_flight -= 1
+            self._notify()
+
+    def release(self, latency: float, error: Exception = None):
+        with self.condition:
+            # saturated before this request finished, i.e. the limit is what holds workers back
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            now = time.monotonic()
+            if error is not None:
+                if is_congestion_error(error):
+                    self._decrease(now, type(error).__name__)
+            else:
+                self._observe(latency)
+                if self.short_latency > self.latency_tolerance * self.long_latency:
+                    self._decrease(now, f"latency {self.short_latency:.2f}s vs {self.long_latency:.2f}s")
+                elif saturated:
+                    self.limit += 1.0 if self.slow_start else 1.0 / self.limit
+                    self.limit = min(self.limit, float(self.max_limit))
+            self._notify()
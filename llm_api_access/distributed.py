@@ -0,0 +1,298 @@
+import os
+import glob
+import json
+import time
+import socket
+import sqlite3
+import threading
+from typing import Callable, Iterable, List, Optional
+from .id_index import IdIndex
+from .serialization import get_serializer
+from .sinks import get_output_sink, iter_jsonl
+from .utils import iter_output_ids
+
+
+class WorkUnit(object):
+    def __init__(self, unit_id: int, items: List[dict]):
+        self.unit_id = unit_id
+        self.items = items
+
+
+class WorkQueue(object):
+    """SQLite-backed queue of work units that several processes or hosts claim through leases.
+
+    The first worker to open the queue fills it with the (resume-filtered) dataset, split into units of
+    `unit_size` items. Every worker then leases one unit at a time; a lease that isn't renewed within
+    `lease_seconds` (e.g. because its worker died) expires and the unit goes back to the queue. No
+    central service is needed, only a filesystem that all workers share and on which SQLite locking works.
+    """
+    def __init__(self, db_path: str, lease_seconds: float = 600, worker_id: str = ""):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.local = threading.local()
+
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS units ("
+                "unit_id INTEGER PRIMARY KEY, items TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', "
+                "owner TEXT, lease_expires REAL NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS units_status ON units (status, lease_expires)")
+
+    def connect(self) -> sqlite3.Connection:
+        # one connection per thread, transactions are managed explicitly
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        """Close the connection of the calling thread."""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """Execute a statement, waiting while other workers hold the database lock for longer than the timeout."""
+        while True:
+            try:
+                return self.connect().execute(sql, params)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                time.sleep(0.5)
+
+    def _begin(self, conn: sqlite3.Connection):
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                time.sleep(0.5)
+
+    def _get_meta(self, conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def initialize(self, load_dataset: Callable[[], Iterable], unit_size: int) -> bool:
+        """Fill the queue unless another worker already did. Returns True if this worker filled it.
+
+        Filling happens in a single transaction, so a worker dying half-way leaves an empty queue
+        that the next worker fills again.
+        """
+        conn = self.connect()
+        self._begin(conn)
+        try:
+            if self._get_meta(conn, "state") is not None:
+                conn.execute("COMMIT")
+                return False
+            unit, unit_id = [], 0
+            for item in load_dataset():
+                unit.append(item)
+                if len(unit) >= unit_size:
+                    conn.execute("INSERT INTO units (unit_id, items) VALUES (?, ?)", (unit_id, json.dumps(unit, ensure_ascii=False)))
+                    unit, unit_id = [], unit_id + 1
+            if len(unit) > 0:
+                conn.execute("INSERT INTO units (unit_id, items) VALUES (?, ?)", (unit_id, json.dumps(unit, ensure_ascii=False)))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('state', 'ready')")
+            conn.execute("INSERT INTO meta (key, value) VALUES ('merge', 'pending')")
+            conn.execute("INSERT INTO meta (key, value) VALUES ('merge_expires', '0')")
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim(self) -> Optional[WorkUnit]:
+        conn = self.connect()
+        self._begin(conn)
+        try:
+            now = time.time()
+            row = conn.execute(
+                "SELECT unit_id, items FROM units WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) ORDER BY unit_id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE units SET status = 'leased', owner = ?, lease_expires = ? WHERE unit_id = ?",
+                (self.worker_id, now + self.lease_seconds, row[0]),
+            )
+            conn.execute("COMMIT")
+            return WorkUnit(row[0], json.loads(row[1]))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def renew(self, unit: WorkUnit) -> bool:
+        """Extend the lease; False if it was lost, i.e. it expired and another worker claimed the unit."""
+        cursor = self._execute(
+            "UPDATE units SET lease_expires = ? WHERE unit_id = ? AND owner = ? AND status = 'leased'",
+            (time.time() + self.lease_seconds, unit.unit_id, self.worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, unit: WorkUnit) -> bool:
+        """Mark the unit done; False if the lease was lost, then the unit is left to its new owner."""
+        cursor = self._execute(
+            "UPDATE units SET status = 'done', items = '[]' WHERE unit_id = ? AND owner = ? AND status = 'leased'",
+            (unit.unit_id, self.worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, unit: WorkUnit) -> bool:
+        """Give the unit back to the queue undone, e.g. after its run failed; False if the lease was lost anyway."""
+        cursor = self._execute(
+            "UPDATE units SET status = 'pending', owner = NULL, lease_expires = 0 "
+            "WHERE unit_id = ? AND owner = ? AND status = 'leased'",
+            (unit.unit_id, self.worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def num_unfinished(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM units WHERE status != 'done'").fetchone()[0]
+
+    def next_lease_expiry(self) -> Optional[float]:
+        return self._execute("SELECT MIN(lease_expires) FROM units WHERE status = 'leased'").fetchone()[0]
+
+    def claim_merge(self) -> bool:
+        """Exactly one worker wins the right to merge the output shards once all units are done.
+
+        The merge is leased like a unit, so if the merging worker dies, the next worker that finds every unit
+        done takes it over.
+        """
+        conn = self.connect()
+        self._begin(conn)
+        try:
+            now = time.time()
+            owner = self._get_meta(conn, "merge")
+            expires = float(self._get_meta(conn, "merge_expires") or 0)
+            if owner == "done" or (owner != "pending" and expires >= now):
+                conn.execute("COMMIT")
+                return False
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'merge'", (self.worker_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('merge_expires', ?)", (str(now + self.lease_seconds),)
+            )
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def renew_merge(self) -> bool:
+        cursor = self._execute(
+            "UPDATE meta SET value = ? WHERE key = 'merge_expires' "
+            "AND (SELECT value FROM meta WHERE key = 'merge') = ?",
+            (str(time.time() + self.lease_seconds), self.worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete_merge(self) -> bool:
+        cursor = self._execute("UPDATE meta SET value = 'done' WHERE key = 'merge' AND value = ?", (self.worker_id,))
+        return cursor.rowcount == 1
+
+    def iter_units(self) -> Iterable[WorkUnit]:
+        """Claim units until all of them are done, waiting for expiring leases of other workers."""
+        while True:
+            unit = self.claim()
+            if unit is not None:
+                yield unit
+                continue
+            if self.num_unfinished() == 0:
+                return
+            # the remaining units are leased by others; wait for them to finish or for a lease to expire
+            next_expiry = self.next_lease_expiry()
+            wait = 1.0 if next_expiry is None else next_expiry - time.time() + 0.1
+            time.sleep(min(max(wait, 0.1), 1.0))
+
+
+class LeaseKeeper(object):
+    """Renews the lease of a unit, or with `unit=None` of the merge, in the background while it is being processed."""
+    def __init__(self, queue: WorkQueue, unit: WorkUnit = None, logger=None):
+        self.queue = queue
+        self.unit = unit
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.keep, daemon=True)
+
+    def renew(self) -> bool:
+        return self.queue.renew(self.unit) if self.unit is not None else self.queue.renew_merge()
+
+    def keep(self):
+        name = f"unit {self.unit.unit_id}" if self.unit is not None else "the merge"
+        try:
+            while not self.stopped.wait(self.queue.lease_seconds / 3):
+                try:
+                    renewed = self.renew()
+                except sqlite3.Error as e:
+                    # try again at the next interval, the lease is still valid for two more
+                    if self.logger is not None:
+                        self.logger.error(f"\033[91mCould not renew the lease of {name}: {e}\033[0m")
+                    continue
+                if not renewed and self.logger is not None:
+                    self.logger.warning(f"\033[91mThe lease of {name} expired and was taken over by another worker.\033[0m")
+        finally:
+            self.queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def output_shard_path(output_filepath: str, worker_id: str) -> str:
+    return f"{output_filepath}.shard-{worker_id}.jsonl"
+
+
+def merge_output_shards(
+    output_filepath: str, save_as_json: bool = False, chunk_size: int = 1000, serializer: str = "auto"
+) -> int:
+    """Merge the per-worker shards into the single output file that resuming expects.
+
+    Items whose `id` is already in the output (e.g. redone after an expired lease) are dropped,
+    the result is sorted by `id` and the id index is brought up to date. Returns the number of merged items.
+    """
+    shard_paths = sorted(glob.glob(glob.escape(output_filepath) + ".shard-*.jsonl"))
+    id_index = IdIndex(output_filepath)
+    if os.path.isfile(output_filepath):
+        if not id_index.is_fresh():
+            id_index.rebuild(iter_output_ids(output_filepath))
+        seen_ids = id_index.load()
+    else:
+        id_index.remove()
+        seen_ids = set()
+
+    sink = get_output_sink(output_filepath, save_as_json=save_as_json, serializer=get_serializer(serializer))
+    num_merged, buffer = 0, []
+    for shard_path in shard_paths:
+        for item in iter_jsonl(shard_path):
+            if item['id'] in seen_ids:
+                continue
+            seen_ids.add(item['id'])
+            buffer.append(item)
+            if len(buffer) >= chunk_size:
+                sink.write(buffer)
+                id_index.append([item['id'] for item in buffer])
+                num_merged, buffer = num_merged + len(buffer), []
+    sink.write(buffer)
+    id_index.append([item['id'] for item in buffer])
+    num_merged += len(buffer)
+    sink.finalize(sort_by_id=True)
+    id_index.touch()
+
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+        IdIndex(shard_path).remove()
+    return num_merged
@@ -0,0 +1,78 @@
+import threading
+from collections import deque
+
+
+class HedgeCancelled(Exception):
+    """The request lost against its hedge (or the other way round) and was stopped."""
+
+
+class HedgingPolicy(object):
+    """Decides when a slow request gets a duplicate ("hedge"), shared by all workers of a run.
+
+    A request that hasn't answered after the `percentile` of the recent successful latencies (at least
+    `min_delay` seconds) is sent a second time; the first answer wins and the other request is cancelled.
+    With a `RequestRouter`, the hedge goes to the least loaded route, usually another key or endpoint.
+    Each request earns `budget` hedges, so hedges add at most that fraction of extra requests.
+    """
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        budget: float = 0.05,
+        min_delay: float = 1.0,
+        window: int = 1000,
+        min_samples: int = 20,
+    ):
+        if not 0 < percentile < 1:
+            raise ValueError(f"Hedging percentile should be in (0, 1), got {percentile}.")
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+
+        self.latencies = deque(maxlen=window)
+        self.num_observed = 0
+        self.delay = None
+        # unspent hedges, at most 10 of them can be saved up
+        self.credits = 0.0
+        self.max_credits = 10.0
+        self.num_requests = 0
+        self.num_hedges = 0
+        self.num_wins = 0
+        self.num_skipped = 0
+        self.lock = threading.Lock()
+
+    def observe(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_observed += 1
+            # sorting the window on every request would be wasteful, the percentile moves slowly
+            if len(self.latencies) >= self.min_samples and (self.delay is None or self.num_observed % 20 == 0):
+                ordered = sorted(self.latencies)
+                self.delay = max(self.min_delay, ordered[int(self.percentile * (len(ordered) - 1))])
+
+    def hedge_delay(self):
+        """Seconds after which a new request gets hedged, None while there are too few latencies to tell."""
+        with self.lock:
+            self.num_requests += 1
+            self.credits = min(self.max_credits, self.credits + self.budget)
+            return self.delay
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.credits < 1.0:
+                self.num_skipped += 1
+                return False
+            self.credits -= 1.0
+            self.num_hedges += 1
+            return True
+
+    def hedge_won(self):
+        with self.lock:
+            self.num_wins += 1
+
+    def summary(self) -> str:
+        delay = "-" if self.delay is None else f"{self.delay:.2f}s"
+        return (
+            f"{self.num_hedges} hedge(s) for {self.num_requests} requests, {self.num_wins} won, "
+            f"{self.num_skipped} skipped for the budget, delay {delay}."
+        )
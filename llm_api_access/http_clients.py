@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import importlib
+import importlib.util
+import openai
+from typing import Dict, Tuple
+
+
+def httpx_module():
+    """`httpx`, or `httpx2` for newer SDKs, whichever the installed `openai` is built on."""
+    return importlib.import_module(openai.DefaultHttpxClient.__mro__[1].__module__.split(".")[0])
+
+
+class HttpClientPool(object):
+    """HTTP connection pools shared by all workers of a run: one per endpoint, used by an OpenAI client per API key.
+
+    Without it every worker builds its own client and pool, which opens (and TLS-handshakes) a connection per
+    worker and drops connections beyond the SDK's 100 kept alive. The httpx clients are thread-safe; async ones
+    belong to the event loop that first uses them, so the async runner calls `async_close` before its loop ends.
+    """
+    def __init__(
+        self,
+        max_connections: int = 1000,
+        max_keepalive_connections: int = 0,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        logger=None,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections if max_keepalive_connections > 0 else max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        if self.http2 and importlib.util.find_spec("h2") is None:
+            if logger is not None:
+                logger.warning("\033[91m`http2` needs the `h2` package (pip install llm-api-access[http2]), using HTTP/1.1.\033[0m")
+            self.http2 = False
+        self.lock = threading.Lock()
+        self.http_clients: Dict[str, object] = {}
+        self.async_http_clients: Dict[str, object] = {}
+        self.clients: Dict[Tuple, openai.OpenAI] = {}
+        self.async_clients: Dict[Tuple, openai.AsyncOpenAI] = {}
+
+    @classmethod
+    def from_args(cls, arguments, logger=None) -> "HttpClientPool":
+        return cls(
+            max_connections=arguments.http_max_connections,
+            max_keepalive_connections=arguments.http_max_keepalive_connections,
+            keepalive_expiry=arguments.http_keepalive_expiry,
+            http2=arguments.http2,
+            logger=logger,
+        )
+
+    def client_kwargs(self) -> dict:
+        limits = httpx_module().Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        return {"limits": limits, "http2": self.http2}
+
+    def client(self, api_key: str, base_url: str, max_retries: int) -> openai.OpenAI:
+        key = (base_url, api_key, max_retries)
+        with self.lock:
+            if key not in self.clients:
+                if base_url not in self.http_clients:
+                    self.http_clients[base_url] = openai.DefaultHttpxClient(**self.client_kwargs())
+                self.clients[key] = openai.OpenAI(
+                    api_key=api_key, base_url=base_url, max_retries=max_retries, http_client=self.http_clients[base_url],
+                )
+            return self.clients[key]
+
+    def async_client(self, api_key: str, base_url: str, max_retries: int) -> openai.AsyncOpenAI:
+        key = (base_url, api_key, max_retries)
+        with self.lock:
+            if key not in self.async_clients:
+                if base_url not in self.async_http_clients:
+                    self.async_http_clients[base_url] = openai.DefaultAsyncHttpxClient(**self.client_kwargs())
+                self.async_clients[key] = openai.AsyncOpenAI(
+                    api_key=api_key, base_url=base_url, max_retries=max_retries, http_client=self.async_http_clients[base_url],
+                )
+            return self.async_clients[key]
+
+    def close(self):
+        with self.lock:
+            http_clients, self.http_clients, self.clients = list(self.http_clients.values()), {}, {}
+        for http_client in http_clients:
+            http_client.close()
+
+    async def async_close(self):
+        with self.lock:
+            http_clients, self.async_http_clients, self.async_clients = list(self.async_http_clients.values()), {}, {}
+        await asyncio.gather(*[http_client.aclose() for http_client in http_clients])
@@ -0,0 +1,67 @@
+import os
+import json
+from typing import Iterable
+
+
+class IdIndex(object):
+    """Append-only sidecar log of the `id`s already written to an output file.
+
+    The log lives next to the output file (`<output_filepath>.ids`), one JSON-encoded id per line, and is
+    appended by the `Consumer` right after each write. Resuming a run then only needs to read this log
+    instead of deserializing every response in the output file.
+    """
+    suffix = ".ids"
+
+    def __init__(self, output_filepath: str):
+        self.output_filepath = output_filepath
+        self.filepath = output_filepath + self.suffix
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.filepath)
+
+    def is_fresh(self) -> bool:
+        """The index can be trusted if it was written after the last modification of the output file."""
+        if not self.exists() or not os.path.isfile(self.output_filepath):
+            return False
+        return os.stat(self.filepath).st_mtime_ns >= os.stat(self.output_filepath).st_mtime_ns
+
+    def load(self) -> set:
+        """Raises ValueError if a line other than the last one is garbled, the index needs a `rebuild` then."""
+        ids = set()
+        torn_line = None
+        with open(self.filepath, "r", encoding="utf-8", errors="replace") as fin:
+            for line in fin:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                if torn_line is not None:
+                    raise ValueError(f"Garbled line in the id index '{self.filepath}': {torn_line[:100]}")
+                try:
+                    ids.add(json.loads(line))
+                except json.JSONDecodeError:
+                    # a torn last line of an interrupted run
+                    torn_line = line
+        return ids
+
+    def append(self, ids: Iterable):
+        lines = [json.dumps(_id, ensure_ascii=False) + "\n" for _id in ids]
+        if len(lines) == 0:
+            return
+        with open(self.filepath, "a", encoding="utf-8") as fout:
+            fout.writelines(lines)
+
+    def touch(self):
+        """Mark the index as fresh after the output file was rewritten without new ids, e.g. sorted."""
+        if self.exists():
+            os.utime(self.filepath)
+
+    def rebuild(self, ids: Iterable):
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as fout:
+            for _id in ids:
+                fout.write(json.dumps(_id, ensure_ascii=False) + "\n")
+        os.replace(tmp_filepath, self.filepath)
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.filepath)
@@ -0,0 +1,179 @@
+import io
+import os
+import base64
+import hashlib
+import logging
+import importlib.util
+import mimetypes
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+# resolutions the model actually sees, see https://platform.openai.com/docs/guides/vision
+LOW_DETAIL_SIZE = 512
+HIGH_DETAIL_MAX_SIZE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+# (path, mtime, size) -> content hash entries an `ImageEncoder` keeps, least recently used go first
+MAX_PATH_HASHES = 65536
+
+
+def target_size(width: int, height: int, detail: str) -> Tuple[int, int]:
+    """Size an image of `width` x `height` is scaled to by the provider for `detail`, never upscaled."""
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_SIZE / max(width, height))
+    else:
+        # 'high' and 'auto': fit into 2048x2048, then shortest side at most 768
+        scale = min(1.0, HIGH_DETAIL_MAX_SIZE / max(width, height))
+        short_side = min(width, height) * scale
+        if short_side > HIGH_DETAIL_SHORT_SIDE:
+            scale *= HIGH_DETAIL_SHORT_SIDE / short_side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def parse_data_url(data_url: str) -> Tuple[str, bytes]:
+    header, _, data = data_url.partition(",")
+    mime_type = header[len("data:"):].split(";")[0] or "application/octet-stream"
+    return mime_type, base64.b64decode(data)
+
+
+def to_data_url(mime_type: str, data: bytes) -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+class ImageEncoder(object):
+    """Turns the image references of data items into the `url` of an `image_url` content part.
+
+    A reference is a local path (or `file://` URL), a `data:` URL or an http(s) URL; remote URLs are passed
+    through for the provider to download. Encoding happens in the worker right before the request, so the
+    dataset only holds paths. Encoded images are kept in an LRU cache of `cache_size_mb`, keyed by content
+    hash, so an image used by several items is read and encoded once. With `downscale`, images larger than
+    what `detail` makes the model see are resized and recompressed first (needs Pillow).
+    """
+    def __init__(
+        self,
+        detail: str = "auto",
+        downscale: bool = False,
+        quality: int = 85,
+        cache_size_mb: float = 256,
+        logger: logging.Logger = None,
+    ):
+        self.detail = detail
+        self.downscale = downscale
+        self.quality = quality
+        self.cache_size = int(cache_size_mb * 1024 * 1024)
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.cache: "OrderedDict[str, str]" = OrderedDict()
+        self.cache_bytes = 0
+        # (path, mtime, size) -> content hash, so cached files aren't even read again
+        self.path_hashes: "OrderedDict[tuple, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        if self.downscale and importlib.util.find_spec("PIL") is None:
+            self.downscale = False
+            if self.logger is not None:
+                self.logger.warning("`image_downscale` needs Pillow (`pip install pillow`), images are sent as they are.")
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        with self.lock:
+            data_url = self.cache.get(key, None)
+            if data_url is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            return data_url
+
+    def _cache_put(self, key: str, data_url: str):
+        if len(data_url) > self.cache_size:
+            return
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = data_url
+            self.cache_bytes += len(data_url)
+            while self.cache_bytes > self.cache_size:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted)
+
+    def shrink(self, mime_type: str, data: bytes) -> Tuple[str, bytes]:
+        """Downscale to the resolution `detail` uses and recompress, unless that doesn't make it smaller."""
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as image:
+            size = target_size(image.width, image.height, self.detail)
+            if size == (image.width, image.height) and mime_type in ("image/jpeg", "image/webp"):
+                return mime_type, data
+            image.load()
+            if size != (image.width, image.height):
+                image = image.resize(size, Image.LANCZOS)
+            buffer = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                # keep transparency
+                image.save(buffer, format="PNG", optimize=True)
+                new_mime_type = "image/png"
+            else:
+                image.convert("RGB").save(buffer, format="JPEG", quality=self.quality, optimize=True)
+                new_mime_type = "image/jpeg"
+        if buffer.tell() >= len(data):
+            return mime_type, data
+        return new_mime_type, buffer.getvalue()
+
+    def encode_bytes(self, mime_type: str, data: bytes, key: str = None) -> str:
+        key = key or hashlib.sha256(data).hexdigest()
+        data_url = self._cache_get(key)
+        if data_url is not None:
+            return data_url
+        with self.lock:
+            self.misses += 1
+        if self.downscale:
+            mime_type, data = self.shrink(mime_type, data)
+        data_url = to_data_url(mime_type, data)
+        with self.lock:
+            self.bytes_out += len(data_url)
+        self._cache_put(key, data_url)
+        return data_url
+
+    def encode(self, reference: str) -> str:
+        if reference.startswith(("http://", "https://")):
+            return reference
+        if reference.startswith("data:"):
+            if not self.downscale:
+                return reference
+            mime_type, data = parse_data_url(reference)
+            with self.lock:
+                self.bytes_in += len(reference)
+            return self.encode_bytes(mime_type, data)
+
+        path = reference[len("file://"):] if reference.startswith("file://") else reference
+        stat = os.stat(path)
+        path_key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            key = self.path_hashes.get(path_key, None)
+            if key is not None:
+                self.path_hashes.move_to_end(path_key)
+        if key is not None:
+            data_url = self._cache_get(key)
+            if data_url is not None:
+                return data_url
+        with open(path, "rb") as fin:
+            data = fin.read()
+        key = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.bytes_in += len(data)
+            if self.cache_size > 0:
+                self.path_hashes[path_key] = key
+                if len(self.path_hashes) > MAX_PATH_HASHES:
+                    self.path_hashes.popitem(last=False)
+        mime_type = mimetypes.guess_type(path)[0] or "image/jpeg"
+        return self.encode_bytes(mime_type, data, key=key)
+
+    def summary(self) -> str:
+        return (
+            f"{self.misses} image(s) encoded, {self.hits} cache hits, "
+            f"{self.bytes_in / 1e6:.1f} MB read, {self.bytes_out / 1e6:.1f} MB encoded."
+        )
@@ -1,7 +1,26 @@
+import time
+import asyncio
+import threading
 import openai
+from typing import List
+from concurrent import futures
 from .arguments import EntireArguments
+from .rate_limiter import RateLimiter, estimate_payload_tokens
+from .response_cache import ResponseCache
+from .router import RequestRouter
+from .http_clients import HttpClientPool
+from .concurrency import AdaptiveConcurrencyLimiter
+from .images import ImageEncoder
+from .prompts import load_prompt_prefix
+from .streaming import StreamAccumulator, StreamStats
+from .metrics import MetricsRegistry
+from .hedging import HedgingPolicy, HedgeCancelled
+from .retry import ErrorMessage
 from openai.types.chat import ChatCompletion
 
+# losing requests of hedges that may still run on the hedge pool of a requester, see `hedged_request_api`
+MAX_HEDGE_LOSERS = 8
+
 
 class LLMRequester(object):
     def __init__(
@@ -13,46 +32,74 @@ class LLMRequester(object):
         self.arguments = arguments
         self.llm = self.arguments.llm
         self.base_url = self.arguments.base_url
-        self.api_key_idx = 0
         self.max_retries = 5 if "max_retries" not in kwargs else kwargs["max_retries"]
+        # shared by all workers of a run, see `LLMRunner`
+        self.rate_limiter: RateLimiter = kwargs.get("rate_limiter", None)
+        self.response_cache: ResponseCache = kwargs.get("response_cache", None)
+        self.router: RequestRouter = kwargs.get("router", None)
+        self.concurrency_limiter: AdaptiveConcurrencyLimiter = kwargs.get("concurrency_limiter", None)
+        self.image_encoder: ImageEncoder = kwargs.get("image_encoder", None)
+        if self.image_encoder is None:
+            self.image_encoder = ImageEncoder(detail=self.arguments.image_detail, cache_size_mb=0)
+        # system prompt and few-shot examples, the same for every request
+        self.prefix_messages = load_prompt_prefix(self.arguments.system_prompt, self.arguments.few_shot_filepath)
+
+        # streaming, see `StreamAccumulator`
+        self.stream = self.arguments.stream
+        self.stop_predicates = kwargs.get("stop_predicates", None)
+        self.last_stream_stats: StreamStats = None
+
+        self.metrics: MetricsRegistry = kwargs.get("metrics", None)
+        # connection pools shared by all workers, see `HttpClientPool`
+        self.http_clients: HttpClientPool = kwargs.get("http_clients", None)
+
+        # duplicates of slow requests, see `HedgingPolicy`
+        self.hedging: HedgingPolicy = kwargs.get("hedging", None)
+        self.hedge_executor = None
+        self.num_hedge_losers = 0
+        self.hedge_lock = threading.Lock()
 
         self.api_key = self.arguments.api_key
         if isinstance(self.api_key, str):
             self.api_key = [self.api_key]
+        self.key_label = f"...{self.api_key[0][-4:]}"
+
+        self.openai_client = self.build_client()
 
-        self.openai_client = openai.OpenAI(
-            api_key=self.api_key[0],
+    def build_client(self):
+        api_key = self.api_key[0]
+        if self.http_clients is not None:
+            return self.http_clients.client(api_key, self.base_url, self.max_retries)
+        return openai.OpenAI(
+            api_key=api_key,
             base_url=self.base_url,
             max_retries=self.max_retries,
         )
 
-    def update_api_key(self):
-        self.api_key_idx += 1
-        if self.api_key_idx >= len(self.api_key):
-            raise RuntimeError("All API_KEY quota exceeded.")
-        self.openai_client.api_key = self.api_key[self.api_key_idx]
-
     def get_payload(self, prompt, temperature=0.0, max_completion_tokens=256, n=1, **kwargs):
-        if "image_url" not in kwargs:
+        # `image_url` (data/http URL) and `image_path` (local file, encoded here) take one image or a list
+        images = []
+        for key in ("image_url", "image_path"):
+            value = kwargs.pop(key, None)
+            if value is not None:
+                images += value if isinstance(value, (list, tuple)) else [value]
+        if len(images) == 0:
             contents = prompt
         else:
-            # add image
-            contents = [
-                {"type": "text", "text": prompt},
+            # add images
+            contents = [{"type": "text", "text": prompt}] + [
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": kwargs['image_url'],
+                        "url": self.image_encoder.encode(image),
                         "detail": self.arguments.image_detail,
                     },
                 }
+                for image in images
             ]
         payload = {
             "model": self.llm,
-            "messages": [
-                {"role": "system", "content": "You are a helpful asistant."},
-                {"role": "user", "content": contents},
-            ],
+            "messages": self.prefix_messages + [{"role": "user", "content": contents}],
             "temperature": temperature,
             "max_completion_tokens": max_completion_tokens,
             "n": n,
@@ -60,13 +107,223 @@ class LLMRequester(object):
         }
         return payload
 
+    def parse_choices(self, completion: ChatCompletion) -> List[str]:
+        return [
+            completion.choices[i].message.content
+            for i in range(len(completion.choices))
+        ]
+
+    def parse_completion(self, completion: ChatCompletion) -> str:
+        return "\n\n".join(self.parse_choices(completion))
+
+    def on_rate_limited(self, error: openai.RateLimitError):
+        self.rate_limiter.update_from_headers(error.response.headers)
+        self.rate_limiter.pause()
+
+    def on_response(self, raw_response, completion: ChatCompletion, estimated_tokens: int):
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        if completion.usage is not None:
+            self.rate_limiter.correct(estimated_tokens, completion.usage.total_tokens)
+
     def request(self, payload) -> ChatCompletion:
-        completion = self.openai_client.chat.completions.create(**payload)
+        request_func = self.request_api if self.hedging is None else self.hedged_request_api
+        if self.response_cache is not None:
+            return self.response_cache.get_or_request(payload, request_func)
+        return request_func(payload)
+
+    def acquire_rate_limit(self, payload) -> int:
+        if self.rate_limiter is None:
+            return 0
+        estimated_tokens = estimate_payload_tokens(payload)
+        self.rate_limiter.acquire(estimated_tokens)
+        return estimated_tokens
+
+    def request_api(self, payload, cancelled: threading.Event = None) -> ChatCompletion:
+        """Send one request. With `cancelled` set, a stream is stopped early by raising `HedgeCancelled`."""
+        # waiting for a concurrency slot, the rate limiter or a free route doesn't count as API latency
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.acquire()
+        try:
+            estimated_tokens = self.acquire_rate_limit(payload)
+            route = self.router.acquire() if self.router is not None else None
+        except BaseException:
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.cancel()
+            raise
+        client = self.openai_client if route is None else route.client
+
+        start_time, completion, error, is_cancelled = time.monotonic(), None, None, False
+        try:
+            completion = self.create_completion(client, payload, estimated_tokens, cancelled=cancelled)
+            return completion
+        except HedgeCancelled:
+            is_cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.finish_request(route, time.monotonic() - start_time, completion, error, is_cancelled)
+
+    def finish_request(self, route, latency: float, completion: ChatCompletion, error: Exception, is_cancelled: bool):
+        """Give back the route and concurrency slot of a request and record how it went."""
+        if is_cancelled:
+            # tells nothing about the provider, the other request of the hedge just was faster
+            if route is not None:
+                self.router.cancel(route)
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.cancel()
+            if self.metrics is not None:
+                self.metrics.counter("llm_requests_total", "API requests by outcome.", status="cancelled").inc()
+            return
+        if route is not None:
+            self.router.release(route, latency, error)
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.release(latency, error)
+        if self.hedging is not None and error is None:
+            self.hedging.observe(latency)
+        self.record_request(route, latency, completion, error)
+
+    def record_hedge(self, outcome: str):
+        if outcome == "won":
+            self.hedging.hedge_won()
+        if self.metrics is not None:
+            self.metrics.counter(
+                "llm_hedges_total", "Hedged requests by which request answered first.", outcome=outcome
+            ).inc()
+
+    def hedged_request_api(self, payload) -> ChatCompletion:
+        """`request_api`, sending a second request once the first is slower than `HedgingPolicy.hedge_delay`.
+
+        Both run on a thread pool of this requester. A losing stream is closed early; a blocking
+        non-streamed request can't be interrupted, it runs to its end and the answer is dropped. The pool
+        has room for `MAX_HEDGE_LOSERS` of those next to the two requests of the current call, and no hedge
+        is sent while it is full, so neither request ever queues behind a loser.
+        """
+        delay = self.hedging.hedge_delay()
+        if delay is None:
+            return self.request_api(payload)
+        if self.hedge_executor is None:
+            self.hedge_executor = futures.ThreadPoolExecutor(max_workers=2 + MAX_HEDGE_LOSERS)
+
+        cancelled = threading.Event()
+        primary = self.hedge_executor.submit(self.request_api, payload, cancelled)
+        try:
+            return primary.result(timeout=delay)
+        except futures.TimeoutError:
+            pass
+        if self.num_hedge_losers >= MAX_HEDGE_LOSERS or not self.hedging.try_hedge():
+            return primary.result()
+
+        hedge = self.hedge_executor.submit(self.request_api, payload, cancelled)
+        pending = {primary, hedge}
+        while len(pending) > 0:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    cancelled.set()
+                    self.record_hedge("won" if future is hedge else "lost")
+                    for loser in pending:
+                        self.track_hedge_loser(loser)
+                    return future.result()
+        # both failed
+        self.record_hedge("failed")
+        return primary.result()
+
+    def track_hedge_loser(self, future: futures.Future):
+        with self.hedge_lock:
+            self.num_hedge_losers += 1
+
+        def on_done(_):
+            with self.hedge_lock:
+                self.num_hedge_losers -= 1
+
+        future.add_done_callback(on_done)
+
+    def close(self):
+        """Stop the hedge pool; losing requests still running finish in the background."""
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False)
+            self.hedge_executor = None
+
+    def create_completion(
+        self, client: openai.OpenAI, payload, estimated_tokens: int = 0, cancelled: threading.Event = None
+    ) -> ChatCompletion:
+        if self.rate_limiter is None and not self.stream:
+            return client.chat.completions.create(**payload)
+
+        start_time = time.monotonic()
+        try:
+            raw_response = client.chat.completions.with_raw_response.create(**payload, **self.stream_kwargs())
+        except openai.RateLimitError as e:
+            if self.rate_limiter is not None:
+                self.on_rate_limited(e)
+            raise
+        completion = raw_response.parse()
+        if self.stream:
+            completion = self.consume_stream(completion, start_time, cancelled=cancelled)
+        if self.rate_limiter is not None:
+            self.on_response(raw_response, completion, estimated_tokens)
         return completion
 
+    def record_request(self, route, latency: float, completion: ChatCompletion, error: Exception):
+        if self.metrics is None:
+            return
+        key = route.name if route is not None else self.key_label
+        if error is not None:
+            self.metrics.counter("llm_requests_total", "API requests by outcome.", status="error").inc()
+            self.metrics.counter("llm_request_errors_total", "Failed API requests per key.", key=key).inc()
+            if isinstance(error, openai.RateLimitError):
+                self.metrics.counter("llm_rate_limited_total", "429 responses per key.", key=key).inc()
+            return
+
+        self.metrics.counter("llm_requests_total", "API requests by outcome.", status="ok").inc()
+        self.metrics.histogram("llm_request_latency_seconds", "Latency of successful API requests.").observe(latency)
+        usage = completion.usage
+        if usage is not None:
+            self.metrics.counter("llm_prompt_tokens_total", "Prompt tokens.").inc(usage.prompt_tokens)
+            self.metrics.counter("llm_completion_tokens_total", "Completion tokens.").inc(usage.completion_tokens)
+            details = getattr(usage, "prompt_tokens_details", None)
+            if details is not None and details.cached_tokens:
+                self.metrics.counter("llm_cached_tokens_total", "Prompt tokens served from the provider's cache.").inc(details.cached_tokens)
+
+    def stream_kwargs(self) -> dict:
+        if not self.stream:
+            return {}
+        return {"stream": True, "stream_options": {"include_usage": True}}
+
+    def consume_stream(self, stream, start_time: float, cancelled: threading.Event = None) -> ChatCompletion:
+        accumulator = StreamAccumulator(stop_predicates=self.stop_predicates, start_time=start_time)
+        try:
+            for chunk in stream:
+                if cancelled is not None and cancelled.is_set():
+                    raise HedgeCancelled()
+                if accumulator.add(chunk):
+                    break
+        finally:
+            # closing the connection early is what makes the server stop generating
+            stream.close()
+        return self.finish_stream(accumulator)
+
+    def finish_stream(self, accumulator: StreamAccumulator) -> ChatCompletion:
+        stats = self.last_stream_stats = accumulator.stats()
+        if self.metrics is not None:
+            if stats.time_to_first_token is not None:
+                self.metrics.histogram(
+                    "llm_time_to_first_token_seconds", "Time to the first streamed token."
+                ).observe(stats.time_to_first_token)
+            if stats.inter_token_latency is not None:
+                self.metrics.histogram(
+                    "llm_inter_token_latency_seconds", "Mean time between streamed chunks of a request."
+                ).observe(stats.inter_token_latency)
+            if stats.early_stopped:
+                self.metrics.counter("llm_early_stopped_total", "Streams cut short by a stop predicate.").inc()
+        return accumulator.to_completion()
+
     def chat_one_turn(
-        self, prompt, *args, temperature=0.0, max_completion_tokens=256, n=1, **kwargs
+        self, prompt, *args, temperature=0.0, max_completion_tokens=256, n=1, return_choices=False, **kwargs
     ):
+        """Returns `(result, err_msg)`. The result is the choices joined by blank lines, or their list with `return_choices`."""
         err_msg = ""
         try:
             payload = self.get_payload(
@@ -74,23 +331,145 @@ class LLMRequester(object):
             )
             completion = self.request(payload=payload)
             # assert 'error' not in response, f"Response format error: {response}"
+            result = self.parse_choices(completion) if return_choices else self.parse_completion(completion)
+        except Exception as e:
+            result = None
+            err_msg = ErrorMessage(e)
 
-            result = [
-                completion.choices[i].message.content
-                for i in range(len(completion.choices))
-            ]
-            result = "\n\n".join(result)
+        return result, err_msg
+
+
+class AsyncLLMRequester(LLMRequester):
+    """Same as `LLMRequester`, but built on `openai.AsyncOpenAI`, so `request` and `chat_one_turn` are coroutines."""
+    def build_client(self):
+        api_key = self.api_key[0]
+        if self.http_clients is not None:
+            return self.http_clients.async_client(api_key, self.base_url, self.max_retries)
+        return openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=self.base_url,
+            max_retries=self.max_retries,
+        )
+
+    async def close(self):
+        if self.http_clients is None:
+            await self.openai_client.close()
+        else:
+            # async clients are bound to this event loop, a later loop builds new ones
+            await self.http_clients.async_close()
+        if self.router is not None:
+            await self.router.async_close()
+
+    async def request(self, payload) -> ChatCompletion:
+        request_func = self.request_api if self.hedging is None else self.hedged_request_api
+        if self.response_cache is not None:
+            return await self.response_cache.async_get_or_request(payload, request_func)
+        return await request_func(payload)
+
+    async def acquire_rate_limit(self, payload) -> int:
+        if self.rate_limiter is None:
+            return 0
+        estimated_tokens = estimate_payload_tokens(payload)
+        await self.rate_limiter.async_acquire(estimated_tokens)
+        return estimated_tokens
+
+    async def request_api(self, payload) -> ChatCompletion:
+        if self.concurrency_limiter is not None:
+            await self.concurrency_limiter.async_acquire()
+        try:
+            estimated_tokens = await self.acquire_rate_limit(payload)
+            route = await self.router.async_acquire() if self.router is not None else None
+        except BaseException:
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.cancel()
+            raise
+        client = self.openai_client if route is None else route.async_client
+
+        start_time, completion, error, is_cancelled = time.monotonic(), None, None, False
+        try:
+            completion = await self.create_completion(client, payload, estimated_tokens)
+            return completion
+        except asyncio.CancelledError:
+            is_cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.finish_request(route, time.monotonic() - start_time, completion, error, is_cancelled)
+
+    async def hedged_request_api(self, payload) -> ChatCompletion:
+        """`request_api`, sending a second request once the first is slower than `HedgingPolicy.hedge_delay`.
+
+        The losing request is cancelled, which closes its connection.
+        """
+        delay = self.hedging.hedge_delay()
+        if delay is None:
+            return await self.request_api(payload)
+
+        primary = asyncio.ensure_future(self.request_api(payload))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if len(done) > 0 or not self.hedging.try_hedge():
+                return await primary
+
+            hedge = asyncio.ensure_future(self.request_api(payload))
+            pending.add(hedge)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.record_hedge("won" if task is hedge else "lost")
+                        return task.result()
+            # both failed
+            self.record_hedge("failed")
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create_completion(self, client: openai.AsyncOpenAI, payload, estimated_tokens: int = 0) -> ChatCompletion:
+        if self.rate_limiter is None and not self.stream:
+            return await client.chat.completions.create(**payload)
+
+        start_time = time.monotonic()
+        try:
+            raw_response = await client.chat.completions.with_raw_response.create(**payload, **self.stream_kwargs())
+        except openai.RateLimitError as e:
+            if self.rate_limiter is not None:
+                self.on_rate_limited(e)
+            raise
+        completion = raw_response.parse()
+        if self.stream:
+            completion = await self.consume_stream(completion, start_time)
+        if self.rate_limiter is not None:
+            self.on_response(raw_response, completion, estimated_tokens)
+        return completion
+
+    async def consume_stream(self, stream, start_time: float) -> ChatCompletion:
+        accumulator = StreamAccumulator(stop_predicates=self.stop_predicates, start_time=start_time)
+        try:
+            async for chunk in stream:
+                if accumulator.add(chunk):
+                    break
+        finally:
+            await stream.close()
+        return self.finish_stream(accumulator)
+
+    async def chat_one_turn(
+        self, prompt, *args, temperature=0.0, max_completion_tokens=256, n=1, return_choices=False, **kwargs
+    ):
+        """Returns `(result, err_msg)`. The result is the choices joined by blank lines, or their list with `return_choices`."""
+        err_msg = ""
+        try:
+            payload = self.get_payload(
+                prompt=prompt, temperature=temperature, max_completion_tokens=max_completion_tokens, n=n, **kwargs,
+            )
+            completion = await self.request(payload=payload)
+            result = self.parse_choices(completion) if return_choices else self.parse_completion(completion)
         except Exception as e:
-            # error handling
-            # if completion['error']['code'] == "content_policy_violation":
-            #     return None, "content_policy_violation"
-            # elif completion['error']['code'] == "insufficient_quota":
-            #     self.logger.info(f"Updating api_key_idx to {self.api_key_idx}")
-            #     try:
-            #         self.update_api_key()
-            #     except Exception:
-            #         raise
             result = None
-            err_msg = str(e)
+            err_msg = ErrorMessage(e)
 
         return result, err_msg
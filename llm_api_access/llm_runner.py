@@ -1,16 +1,43 @@
-import os
-import json
 import time
 import signal
+import asyncio
+import threading
 import logging
 import argparse
-from typing import Callable
+from typing import Callable, Iterable, Sized
 from functools import partial
 from .arguments import EntireArguments, GenerationArguments
-from .llm_requester import LLMRequester
+from .llm_requester import LLMRequester, AsyncLLMRequester
+from .rate_limiter import RateLimiter
+from .response_cache import ResponseCache
+from .router import RequestRouter
+from .http_clients import HttpClientPool
+from .concurrency import AdaptiveConcurrencyLimiter
+from .images import ImageEncoder
+from .hedging import HedgingPolicy
+from .scheduling import RequestCostEstimator, ScheduledItem, longest_first, request_features
+from .metrics import COUNT_BUCKETS, MetricsRegistry, MetricsExporter
+from .postprocess import get_postprocessor, start_postprocess_pool
+from .retry import (
+    RetryItem,
+    RetryScheduler,
+    RequestFailedError,
+    DeadLetterWriter,
+    backoff_delay,
+    dead_letter_filepath,
+    is_retryable_error,
+)
+from .id_index import IdIndex
+from .serialization import get_serializer
+from .sinks import OutputSink, get_output_sink
 from rich.progress import Progress, TimeElapsedColumn, MofNCompleteColumn
-from multiprocessing import Queue
+from queue import Empty, Full, Queue
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor
+
+
+class RunFailedError(Exception):
+    """A run stopped short of writing the results of all its data items."""
 
 
 class LLMRunner(object):
@@ -33,9 +60,90 @@ class LLMRunner(object):
 
         self.producer_process_func = producer_process_func
         self.consumer_postprocess_func = consumer_postprocess_func
+        self.postprocess_pool = None
+        if self.arguments.postprocess_workers > 0:
+            # forked here, before any run starts its threads, and reused by every run of this runner
+            self.postprocess_pool = start_postprocess_pool(
+                self.consumer_postprocess_func, self.arguments.postprocess_workers
+            )
 
         self.gen_kwargs = GenerationArguments.from_args(self.arguments).to_dict()
 
+        self.rate_limiter = None
+        if self.arguments.requests_per_minute > 0 or self.arguments.tokens_per_minute > 0:
+            self.rate_limiter = RateLimiter(
+                requests_per_minute=self.arguments.requests_per_minute,
+                tokens_per_minute=self.arguments.tokens_per_minute,
+            )
+
+        self.response_cache = None
+        if len(self.arguments.cache_dir) > 0:
+            self.response_cache = ResponseCache(
+                cache_dir=self.arguments.cache_dir,
+                max_size_mb=self.arguments.cache_max_size_mb,
+                max_age_hours=self.arguments.cache_max_age_hours,
+                force=self.arguments.cache_force,
+                logger=self.logger,
+            )
+            self.logger.info(f"Use '{self.arguments.cache_dir}' as response cache.")
+
+        self.stop_predicates = kwargs.get("stop_predicates", None)
+        self.metrics = MetricsRegistry()
+
+        self.concurrency_limiter = None
+        if self.arguments.adaptive_concurrency:
+            self.concurrency_limiter = AdaptiveConcurrencyLimiter(
+                min_limit=self.arguments.min_concurrency,
+                max_limit=self.arguments.max_concurrency,
+                logger=self.logger,
+            )
+            self.metrics.gauge(
+                "concurrency_limit", "Current adaptive limit of in-flight requests.",
+                func=lambda: self.concurrency_limiter.current_limit,
+            )
+            self.logger.info(
+                f"Adapt concurrency between {self.arguments.min_concurrency} and {self.arguments.max_concurrency}."
+            )
+
+        # the retry scheduler owns retries, so SDK retries would only block the worker and hide 429s from the limiters
+        self.sdk_max_retries = self.arguments.sdk_max_retries
+        if self.sdk_max_retries < 0:
+            self.sdk_max_retries = 0 if self.arguments.max_item_retries > 0 else 5
+
+        self.http_clients = HttpClientPool.from_args(self.arguments, logger=self.logger)
+        self.router = RequestRouter.from_args(
+            self.arguments, logger=self.logger, max_retries=min(self.sdk_max_retries, 1), http_clients=self.http_clients,
+        )
+        if self.router is not None:
+            self.logger.info(f"Route requests over {[route.name for route in self.router.routes]}.")
+
+        self.hedging = None
+        if self.arguments.hedge_requests:
+            self.hedging = HedgingPolicy(
+                percentile=self.arguments.hedge_percentile,
+                budget=self.arguments.hedge_budget,
+                min_delay=self.arguments.hedge_min_delay,
+            )
+
+        self.image_encoder = ImageEncoder(
+            detail=self.arguments.image_detail,
+            downscale=self.arguments.image_downscale,
+            quality=self.arguments.image_quality,
+            cache_size_mb=self.arguments.image_cache_mb,
+            logger=self.logger,
+        )
+
+        self.dead_letters = DeadLetterWriter(
+            dead_letter_filepath(self.arguments.output_filepath, self.arguments.dead_letter_path)
+        )
+
+        self.cost_estimator = None
+        if self.arguments.size_aware_scheduling:
+            self.cost_estimator = RequestCostEstimator(
+                features_func=self.request_features, refine=self.arguments.size_aware_refine,
+            )
+            self.logger.info("Send the data items expected to take longest first.")
+
         self.args = args
         self.kwargs = kwargs
 
@@ -49,88 +157,382 @@ class LLMRunner(object):
             setattr(namespace, key, new_value)
         return namespace
 
+    def build_consumer(
+        self,
+        queue: Queue,
+        num_producers: int,
+        num_dataitems: int,
+        output_filename: str,
+        *args,
+        **kwargs
+    ):
+        return Consumer(
+            queue=queue,
+            num_producers=num_producers,
+            num_dataitems=num_dataitems,
+            output_filename=output_filename,
+            logger=self.logger,
+            postprocess_func=self.consumer_postprocess_func,
+            save_as_json=self.arguments.save_as_json,
+            sort_output=self.arguments.sort_output,
+            metrics=self.metrics,
+            serializer=self.arguments.serializer,
+            postprocess_workers=self.arguments.postprocess_workers,
+            postprocess_ordered=self.arguments.postprocess_ordered,
+            postprocess_pool=self.postprocess_pool,
+            *args,
+            **kwargs,
+        )
+
+    def start_metrics_exporter(self) -> MetricsExporter:
+        if len(self.arguments.metrics_path) == 0:
+            return None
+        exporter = MetricsExporter(self.metrics, self.arguments.metrics_path, interval=self.arguments.metrics_interval)
+        exporter.start()
+        return exporter
+
+    def log_summary(self, exporter: MetricsExporter = None):
+        if exporter is not None:
+            exporter.stop()
+        self.logger.info(self.metrics.summary())
+        if self.concurrency_limiter is not None:
+            self.logger.info(
+                f"Adaptive concurrency: limit {self.concurrency_limiter.current_limit} at the end, "
+                f"{self.concurrency_limiter.num_decreases} backoffs."
+            )
+        if self.response_cache is not None:
+            self.logger.info(
+                f"Response cache: {self.response_cache.hits} hits, {self.response_cache.misses} misses."
+            )
+        if self.hedging is not None:
+            self.logger.info(f"Hedging: {self.hedging.summary()}")
+        if self.image_encoder.hits + self.image_encoder.misses > 0:
+            self.logger.info(f"Images: {self.image_encoder.summary()}")
+        if self.dead_letters.num_written > 0:
+            self.logger.warning(
+                f"\033[91m{self.dead_letters.num_written} item(s) failed permanently and were written to "
+                f"'{self.dead_letters.filepath}'. Run again to retry them.\033[0m"
+            )
+
+    def check_run(self, consumer: "Consumer", producer_exception: Exception = None):
+        """Raise `RunFailedError` if the producer or the consumer of the run failed, the output is incomplete then."""
+        if producer_exception is not None:
+            raise RunFailedError(f"Producer failed because: {producer_exception}") from producer_exception
+        if consumer.exception is not None:
+            raise RunFailedError(f"Consumer failed because: {consumer.exception}") from consumer.exception
+
+    def close(self):
+        """Close the connections and the postprocessing pool of the run, after the last `run` of this runner."""
+        if self.postprocess_pool is not None:
+            self.postprocess_pool.shutdown(wait=True)
+        if self.router is not None:
+            self.router.close()
+        self.http_clients.close()
+
+    def request_features(self, item):
+        """Features of the request of `item` for the cost estimate, see `request_features`.
+
+        Uses `prepare_inputs_func` (`prepare_llm_inputs` of the wrapper) if given, the item as text otherwise.
+        """
+        prepare_inputs_func = self.kwargs.get("prepare_inputs_func", None)
+        inputs = prepare_inputs_func(item, self.prompt_template) if prepare_inputs_func is not None else str(item)
+        return request_features(inputs, max_completion_tokens=self.gen_kwargs.get("max_completion_tokens", 256))
+
+    def retry_delay(self, item, attempt: int, error: Exception):
+        """Seconds to wait before retrying a failed item, or None if it should be given up."""
+        if is_retryable_error(error) and attempt < self.arguments.max_item_retries:
+            delay = backoff_delay(attempt, self.arguments.retry_base_delay, self.arguments.retry_max_delay)
+            self.logger.error(
+                f"\033[91mProducer: Solving failed because:\n{error}\033[0m\n\n"
+                f"Retry {attempt + 1}/{self.arguments.max_item_retries} in {delay:.1f}s. Data item: {item}"
+            )
+            self.metrics.counter("producer_item_retries_total", "Data items retried after a failure.").inc()
+            return delay
+
+        self.logger.error(
+            f"\033[91mProducer: Gave up after {attempt + 1} attempt(s) because:\n{error}\033[0m\n\nData item: {item}"
+        )
+        # stages a pipeline finished for this item, kept for a retry that won't come
+        pipeline_state = getattr(self.producer_process_func, "state", None)
+        if pipeline_state is not None:
+            pipeline_state.discard(item)
+        try:
+            self.dead_letters.write(item, error, attempts=attempt + 1)
+        except OSError as e:
+            self.logger.error(f"\033[91mProducer: Writing to '{self.dead_letters.filepath}' failed because:\n{e}\033[0m")
+        self.metrics.counter("producer_dead_letters_total", "Data items given up after their retries.").inc()
+        return None
+
     def predict_batch(
         self,
         data_queue: Queue,
         queue: Queue,
+        retry_scheduler: RetryScheduler,
         *args,
         **kwargs
     ):
-        llm_requester = LLMRequester(arguments=self.arguments)
+        llm_requester = LLMRequester(
+            arguments=self.arguments,
+            rate_limiter=self.rate_limiter,
+            response_cache=self.response_cache,
+            router=self.router,
+            concurrency_limiter=self.concurrency_limiter,
+            image_encoder=self.image_encoder,
+            hedging=self.hedging,
+            stop_predicates=self.stop_predicates,
+            metrics=self.metrics,
+            http_clients=self.http_clients,
+            max_retries=self.sdk_max_retries,
+        )
         chat_one_turn_func = partial(llm_requester.chat_one_turn, **self.gen_kwargs)
 
-        while not data_queue.empty():
-            try:
-                item = data_queue.get(timeout=5)
-            except Exception:
-                break
+        try:
+            while True:
+                item = data_queue.get()
+                if item is signal.SIGTERM:
+                    # one sentinel per worker is put once every item is done, see `Producer.run`
+                    break
+                self.predict_item(item, queue, chat_one_turn_func, retry_scheduler)
+        finally:
+            llm_requester.close()
+        queue.put(signal.SIGTERM)
+
+    def predict_item(self, item, queue: Queue, chat_one_turn_func: Callable, retry_scheduler: RetryScheduler):
+        """Run one data item of `predict_batch`; a failed one is scheduled for a retry or given up."""
+        is_finished = True
+        try:
+            attempt, features = 0, None
+            if isinstance(item, ScheduledItem):
+                item, features = item.item, item.features
+            elif isinstance(item, RetryItem):
+                item, attempt = item.item, item.attempt
 
             try:
+                start_time = time.monotonic()
                 prompt, response, err_msg = self.producer_process_func(item, self.prompt_template, chat_one_turn_func)
-                assert err_msg is None or len(err_msg) == 0, err_msg
-
+                if err_msg is not None and len(err_msg) > 0:
+                    raise RequestFailedError(err_msg)
+                if features is not None:
+                    self.cost_estimator.observe(features, time.monotonic() - start_time)
                 queue.put([item, prompt, response])
             except Exception as e:
-                self.logger.error(f"\033[91mProducer: Solving failed because:\n{e}\033[0m\n\nData item: {item}")
-                data_queue.put(item)
-                time.sleep(2.5)
-                continue
-        queue.put(signal.SIGTERM)
+                delay = self.retry_delay(item, attempt, e)
+                if delay is not None:
+                    # the worker goes on with other items while this one waits
+                    retry_scheduler.schedule(item, attempt + 1, delay)
+                    is_finished = False
+        finally:
+            # also if the worker dies on this item, otherwise `Producer.run` waits for it forever
+            if is_finished:
+                retry_scheduler.done()
 
     def run(
         self,
-        data_items: list,
+        data_items: Iterable,
         num_threads: int,
         output_filename: str,
         *args,
         **kwargs
     ):
+        if self.concurrency_limiter is not None:
+            # idle workers just wait for a slot, the limiter decides how many requests are in flight
+            num_threads = self.arguments.max_concurrency
         queue = Queue()
         producer = Producer(
             task=self.predict_batch,
             queue=queue,
             num_threads=num_threads,
+            data_queue_size=self.arguments.data_queue_size,
             logger=self.logger,
+            cost_estimator=self.cost_estimator,
+            schedule_window=self.arguments.size_aware_window,
             *args,
             **kwargs,
         )
-        consumer = Consumer(
+        consumer = self.build_consumer(
             queue=queue,
             num_producers=num_threads,
-            num_dataitems=len(data_items),
+            num_dataitems=len(data_items) if isinstance(data_items, Sized) else None,
             output_filename=output_filename,
-            logger=self.logger,
-            postprocess_func=self.consumer_postprocess_func,
-            save_as_json=self.arguments.save_as_json,
             *args,
             **kwargs,
         )
+        self.metrics.gauge("data_queue_depth", "Data items waiting for a worker.", func=producer.data_queue.qsize)
+        self.metrics.gauge("result_queue_depth", "Results waiting for the consumer.", func=queue.qsize)
+        exporter = self.start_metrics_exporter()
 
         consumer.run()
         producer.run(data=data_items)
 
         producer.join()
         consumer.join()
+        self.log_summary(exporter)
+        self.check_run(consumer, producer.exception)
+
+
+class AsyncLLMRunner(LLMRunner):
+    """Runs all requests as coroutines on one event loop, bounded by a semaphore of `max_concurrency`.
+
+    `producer_process_func` should be a coroutine function, e.g. one wrapped by `async_llm_inputs_wrapper`.
+    Results are handed to the same `Consumer` as `LLMRunner` uses.
+    """
+    async def predict_one(
+        self,
+        item,
+        queue: Queue,
+        chat_one_turn_func: Callable,
+        semaphore: asyncio.Semaphore,
+    ):
+        attempt, features = 0, None
+        if isinstance(item, ScheduledItem):
+            item, features = item.item, item.features
+        try:
+            while True:
+                try:
+                    start_time = time.monotonic()
+                    prompt, response, err_msg = await self.producer_process_func(
+                        item, self.prompt_template, chat_one_turn_func
+                    )
+                    if err_msg is not None and len(err_msg) > 0:
+                        raise RequestFailedError(err_msg)
+                    if features is not None:
+                        self.cost_estimator.observe(features, time.monotonic() - start_time)
+                    queue.put([item, prompt, response])
+                    return
+                except Exception as e:
+                    delay = self.retry_delay(item, attempt, e)
+                    if delay is None:
+                        return
+                    # don't hold a concurrency slot while backing off
+                    semaphore.release()
+                    try:
+                        await asyncio.sleep(delay)
+                    finally:
+                        await semaphore.acquire()
+                    attempt += 1
+        finally:
+            semaphore.release()
+
+    async def predict_all(
+        self,
+        data_items: Iterable,
+        queue: Queue,
+        max_concurrency: int,
+    ):
+        llm_requester = AsyncLLMRequester(
+            arguments=self.arguments,
+            rate_limiter=self.rate_limiter,
+            response_cache=self.response_cache,
+            router=self.router,
+            concurrency_limiter=self.concurrency_limiter,
+            image_encoder=self.image_encoder,
+            hedging=self.hedging,
+            stop_predicates=self.stop_predicates,
+            metrics=self.metrics,
+            http_clients=self.http_clients,
+            max_retries=self.sdk_max_retries,
+        )
+        chat_one_turn_func = partial(llm_requester.chat_one_turn, **self.gen_kwargs)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        pending = set()
+        if self.cost_estimator is not None:
+            data_items = longest_first(data_items, self.cost_estimator, window=self.arguments.size_aware_window)
+        try:
+            for item in data_items:
+                # acquire before creating the task, so at most `max_concurrency` tasks exist at once
+                await semaphore.acquire()
+                task = asyncio.ensure_future(self.predict_one(item, queue, chat_one_turn_func, semaphore))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if len(pending) > 0:
+                await asyncio.gather(*pending)
+        finally:
+            await llm_requester.close()
+
+    def run(
+        self,
+        data_items: Iterable,
+        num_threads: int,
+        output_filename: str,
+        *args,
+        **kwargs
+    ):
+        queue = Queue()
+        consumer = self.build_consumer(
+            queue=queue,
+            num_producers=1,
+            num_dataitems=len(data_items) if isinstance(data_items, Sized) else None,
+            output_filename=output_filename,
+            *args,
+            **kwargs,
+        )
+        self.metrics.gauge("result_queue_depth", "Results waiting for the consumer.", func=queue.qsize)
+        exporter = self.start_metrics_exporter()
+
+        consumer.run()
+        producer_exception = None
+        try:
+            asyncio.run(
+                self.predict_all(
+                    data_items=data_items,
+                    queue=queue,
+                    max_concurrency=self.arguments.max_concurrency,
+                )
+            )
+        except Exception as e:
+            producer_exception = e
+            self.logger.error(f"Producer failed because: {e}")
+        finally:
+            queue.put(signal.SIGTERM)
+        consumer.join()
+        self.log_summary(exporter)
+        self.check_run(consumer, producer_exception)
 
 
 class Producer():
-    def __init__(self, task, queue: Queue, num_threads: int, logger, *args, **kwargs):
+    def __init__(
+        self,
+        task,
+        queue: Queue,
+        num_threads: int,
+        logger,
+        data_queue_size: int = 1024,
+        cost_estimator: RequestCostEstimator = None,
+        schedule_window: int = 100000,
+        *args,
+        **kwargs
+    ):
+        """With `cost_estimator`, items are queued most expensive first, see `longest_first`."""
         self.task = task
         self.queue = queue
         self.num_threads = num_threads
+        self.data_queue_size = data_queue_size
+        self.cost_estimator = cost_estimator
+        self.schedule_window = schedule_window
         self.logger = logger
         self.args = args
         self.kwargs = kwargs
         self.thread_pool = ThreadPool(processes=self.num_threads)
+        # bounded, so `data` is only pulled as fast as workers consume it
+        self.data_queue = Queue(maxsize=self.data_queue_size)
+        self.retry_scheduler = RetryScheduler(self.data_queue)
+        self.num_alive = self.num_threads
+        self.lock = threading.Lock()
+        self.exception = None
 
-    def run(self, data: list):
-        data_queue = Queue()
-        for item in data:
+    def put(self, item) -> bool:
+        """Put `item` on the data queue; False if no worker is left to take it."""
+        while self.num_alive > 0:
             try:
-                data_queue.put(item, timeout=1)
-            except Exception:
-                self.logger.error("Putting data items to data_queue failed.")
-                return
+                self.data_queue.put(item, timeout=1.0)
+                return True
+            except Full:
+                continue
+        return False
+
+    def run(self, data: Iterable):
+        data_queue = self.data_queue
 
         for thread_idx in range(self.num_threads):
             self.thread_pool.apply_async(
@@ -138,18 +540,44 @@ class Producer():
                 kwds={
                     "data_queue": data_queue,
                     "queue": self.queue,
+                    "retry_scheduler": self.retry_scheduler,
                     **self.kwargs,
                 },
                 error_callback=self.error_callback,
             )
         self.thread_pool.close()
 
+        if self.cost_estimator is not None:
+            data = longest_first(data, self.cost_estimator, window=self.schedule_window)
+        try:
+            for item in data:
+                # counted before it is queued, so it can't be done before it was submitted
+                self.retry_scheduler.submitted()
+                if not self.put(item):
+                    break
+        except Exception as e:
+            self.exception = e
+            self.logger.error(f"Putting data items to data_queue failed because: {e}")
+        # failed items come back through the retry scheduler until they succeed or are given up
+        if not self.retry_scheduler.wait_until_done():
+            self.logger.error("\033[91mProducer: All workers failed, the remaining data items are left for the next run.\033[0m")
+        self.retry_scheduler.close()
+        for _ in range(self.num_threads):
+            if not self.put(signal.SIGTERM):
+                break
+
     def join(self):
         self.thread_pool.join()
 
     def error_callback(self, exception):
         self.logger.error(f"Producer failed because: {exception}")
         self.queue.put(signal.SIGTERM)
+        with self.lock:
+            if self.exception is None:
+                self.exception = exception
+            self.num_alive -= 1
+            if self.num_alive == 0:
+                self.retry_scheduler.cancel()
 
 
 class Consumer():
@@ -161,6 +589,15 @@ class Consumer():
         output_filename: str,
         save_as_json: bool,
         logger,
+        flush_size: int = 20,
+        flush_interval: float = 5.0,
+        sink: OutputSink = None,
+        sort_output: bool = True,
+        metrics: MetricsRegistry = None,
+        serializer: str = "auto",
+        postprocess_workers: int = 0,
+        postprocess_ordered: bool = True,
+        postprocess_pool: ProcessPoolExecutor = None,
         *args,
         **kwargs
     ):
@@ -170,6 +607,18 @@ class Consumer():
         self.output_filename = output_filename
         self.save_as_json = save_as_json
         self.logger = logger
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.sort_output = sort_output
+        self.sink = sink if sink is not None else get_output_sink(
+            output_filename, save_as_json=save_as_json, serializer=get_serializer(serializer)
+        )
+        self.id_index = IdIndex(output_filename)
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.postprocess_workers = postprocess_workers
+        self.postprocess_ordered = postprocess_ordered
+        self.postprocess_pool = postprocess_pool
+        self.exception = None
 
         self.args = args
         self.kwargs = kwargs
@@ -179,6 +628,15 @@ class Consumer():
         self.progress = Progress(*progress_columns, refresh_per_second=1)
 
     def run(self):
+        postprocess_kwargs = dict(self.kwargs)
+        postprocessor = get_postprocessor(
+            postprocess_kwargs.pop("postprocess_func"),
+            self.postprocess_workers,
+            self.postprocess_ordered,
+            self.postprocess_pool,
+            *self.args,
+            **postprocess_kwargs,
+        )
         self.progress.start()
         self.thread_pool.apply_async(
             func=self.consumer_task,
@@ -188,7 +646,7 @@ class Consumer():
                 "num_dataitems": self.num_dataitems,
                 "num_producers": self.num_producers,
                 "output_filename": self.output_filename,
-                **self.kwargs
+                "postprocessor": postprocessor,
             },
             error_callback=self.error_callback,
         )
@@ -199,52 +657,16 @@ class Consumer():
         self.progress.stop()
 
     def error_callback(self, exception):
+        self.exception = exception
         self.logger.error(f"\033[91mConsumer failed because:\n{exception}\033[0m")
 
-    def write_results_to_file(self, data: list, output_filename: str, sort_by_id: bool = False):
-        def _sort_by_id(data):
-            try:
-                _ = int(data[0]['id'])
-                is_integer_id = True
-            except Exception:
-                is_integer_id = False
-                pass
-            if is_integer_id:
-                data = sorted(data, key=lambda x: int(x["id"]))
-            else:
-                data = sorted(data, key=lambda x: x["id"])
-            return data
-
-        if self.save_as_json:
-            if os.path.isfile(output_filename):
-                with open(output_filename, "r", encoding="utf-8") as fin:
-                    existing_data = json.load(fin)
-            else:
-                existing_data = []
-            data = existing_data + data
-            if sort_by_id:
-                data = _sort_by_id(data)
-            with open(output_filename, "w", encoding="utf-8") as fout:
-                json.dump(data, fout, ensure_ascii=False, indent=4)
-        else:
-            if sort_by_id:
-                if os.path.isfile(output_filename):
-                    with open(output_filename, "r", encoding="utf-8") as fin:
-                        existing_data = []
-                        for line in fin:
-                            existing_data.append(json.loads(line.strip()))
-                else:
-                    existing_data = []
-                data = existing_data + data
-                data = _sort_by_id(data)
-                with open(output_filename, "w", encoding="utf-8") as fout:
-                    for item in data:
-                        fout.write(json.dumps(item, ensure_ascii=False) + "\n")
-            else:
-                # save as jsonl, just append
-                with open(output_filename, "a", encoding="utf-8") as fout:
-                    for item in data:
-                        fout.write(json.dumps(item, ensure_ascii=False) + "\n")
+    def write_results_to_file(self, data: list, output_filename: str, sort_by_id: bool = False, finalize: bool = False):
+        self.sink.write(data)
+        # always after the data itself, so the index never lists an id that isn't in the output
+        self.id_index.append([item['id'] for item in data if 'id' in item])
+        if finalize:
+            self.sink.finalize(sort_by_id=sort_by_id)
+            self.id_index.touch()
 
     def consumer_task(
         self,
@@ -253,33 +675,69 @@ class Consumer():
         num_dataitems: int,
         num_producers: int,
         output_filename: str,
-        postprocess_func,
-        *args,
-        **kwargs
+        postprocessor,
     ):
         task_id = progress.add_task(description="Number of Accomplished Items", total=num_dataitems)
-        data_received = 0
         receive_buffer = []
+        last_flush_time = time.monotonic()
         num_producers_remain = num_producers
-        while num_producers_remain > 0:
-            while not queue.empty():
-                dataitem = queue.get()
-                if dataitem == signal.SIGTERM:
-                    num_producers_remain -= 1
-                    continue
-                else:
-                    inputs, prompt, response = dataitem
-                    try:
-                        result = postprocess_func(inputs, response, *args, **prompt, **kwargs)
-                    except Exception as e:
-                        self.logger.error(f"\033[91mConsumer: postprocessed failed because:\n{e}\033[0m\n\nData item: {inputs}")
-                        continue
+        postprocess_seconds = self.metrics.histogram("consumer_postprocess_seconds", "Time spent in `postprocess_func` per item.")
+        written = self.metrics.counter("consumer_results_total", "Results postprocessed by the consumer.", status="ok")
+        failed = self.metrics.counter("consumer_results_total", "Results postprocessed by the consumer.", status="error")
+        idle_seconds = self.metrics.counter("consumer_idle_seconds_total", "Time the consumer waited for results.")
+        queue_depth = self.metrics.histogram(
+            "result_queue_depth_observed", "Results waiting for the consumer, sampled on every result.", buckets=COUNT_BUCKETS,
+        )
+        self.metrics.gauge("postprocess_pending", "Results in the postprocessing pool.", func=lambda: postprocessor.num_pending)
+
+        def handoff(postprocessed: list):
+            for inputs, result, exception, seconds in postprocessed:
+                postprocess_seconds.observe(seconds)
+                if exception is None:
                     receive_buffer.append(result)
-                    data_received += 1
+                    written.inc()
                     self.progress.update(task_id=task_id, advance=1)
-            if len(receive_buffer) > 20:
+                else:
+                    failed.inc()
+                    self.logger.error(f"\033[91mConsumer: postprocessed failed because:\n{exception}\033[0m\n\nData item: {inputs}")
+
+        while num_producers_remain > 0 or postprocessor.num_pending > 0:
+            # block until something arrives, but wake up in time to honour `flush_interval`
+            timeout = max(0.0, last_flush_time + self.flush_interval - time.monotonic())
+            wait_start = time.monotonic()
+            if num_producers_remain == 0 or postprocessor.num_pending >= postprocessor.max_pending:
+                # the pool is full (or the producers are done), wait for it instead of the queue
+                handoff(postprocessor.collect(timeout=timeout))
+            else:
+                try:
+                    dataitem = queue.get(timeout=timeout if postprocessor.num_pending == 0 else min(timeout, 0.05))
+                except Empty:
+                    dataitem = None
+                idle_seconds.inc(time.monotonic() - wait_start)
+
+                if dataitem is signal.SIGTERM:
+                    num_producers_remain -= 1
+                elif dataitem is not None:
+                    queue_depth.observe(queue.qsize())
+                    inputs, prompt, response = dataitem
+                    postprocessor.submit(inputs, response, prompt)
+                handoff(postprocessor.collect())
+
+            if len(receive_buffer) >= self.flush_size or (
+                len(receive_buffer) > 0 and time.monotonic() - last_flush_time >= self.flush_interval
+            ):
                 self.write_results_to_file(data=receive_buffer, output_filename=output_filename)
-                receive_buffer = []
-            time.sleep(5)
-        self.write_results_to_file(data=receive_buffer, output_filename=output_filename, sort_by_id=True)
+                receive_buffer.clear()
+                last_flush_time = time.monotonic()
+            elif len(receive_buffer) == 0:
+                last_flush_time = time.monotonic()
+        postprocessor.close()
+        self.write_results_to_file(
+            data=receive_buffer, output_filename=output_filename, sort_by_id=self.sort_output, finalize=True,
+        )
+        if postprocessor.broken is not None:
+            # all results are written, but the pool is gone, also for the next runs
+            raise RunFailedError(
+                f"A postprocessing worker died ({postprocessor.broken}), the rest was postprocessed on the consumer thread."
+            )
         receive_buffer = []
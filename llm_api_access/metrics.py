@@ -0,0 +1,253 @@
+import os
+import json
+import math
+import time
+import bisect
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# log-spaced latency buckets from 1ms to ~20min, upper bounds in seconds
+DEFAULT_BUCKETS = tuple(0.001 * 1.25 ** i for i in range(64))
+# most results finding this many others ahead of them, while the consumer is rarely idle, point at the consumer
+# as the bottleneck
+CONSUMER_BOUND_DEPTH = 64
+# log-spaced buckets for counts such as queue depths, from 0 to ~1.3M
+COUNT_BUCKETS = (0.0,) + tuple(1.25 ** i for i in range(64))
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """Either set explicitly, or computed by `func` each time it is read (e.g. a queue size)."""
+    def __init__(self, func: Callable[[], float] = None):
+        self.func = func
+        self._value = 0.0
+
+    def set(self, value: float):
+        self._value = value
+
+    @property
+    def value(self) -> float:
+        if self.func is None:
+            return self._value
+        try:
+            return float(self.func())
+        except Exception:
+            # a broken callback shouldn't break the export
+            return math.nan
+
+
+class Histogram(object):
+    def __init__(self, buckets: Tuple[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th quantile, i.e. at most 25% above the true value."""
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for idx, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count > 0:
+                    return self.buckets[idx] if idx < len(self.buckets) else math.inf
+        return math.inf
+
+
+class MetricsRegistry(object):
+    """Counters, gauges and histograms of one run, shared by the requesters, workers and the consumer.
+
+    Metrics are identified by name plus labels, e.g. `counter("llm_requests_total", status="ok")`,
+    and created on first use. Recording is a dict lookup plus a locked addition, so it can stay on
+    the hot path.
+    """
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.metrics: Dict[Tuple[str, Tuple], object] = {}
+        self.helps: Dict[str, str] = {}
+
+    def _get(self, cls, name: str, help: str, labels: dict, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key, None)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key, None)
+                if metric is None:
+                    metric = self.metrics[key] = cls(**kwargs)
+                    if help:
+                        self.helps[name] = help
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = "", func: Callable[[], float] = None, **labels) -> Gauge:
+        gauge = self._get(Gauge, name, help, labels, func=func)
+        if func is not None:
+            # a runner reused for several units registers the queue of each new unit
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name: str, help: str = "", buckets: Tuple[float] = DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def _items(self) -> List[Tuple[str, Tuple, object]]:
+        with self.lock:
+            return sorted(((name, labels, metric) for (name, labels), metric in self.metrics.items()), key=lambda x: (x[0], x[1]))
+
+    def total(self, name: str) -> float:
+        return sum(metric.value for metric_name, _, metric in self._items() if metric_name == name and isinstance(metric, Counter))
+
+    def snapshot(self) -> dict:
+        snapshot = {"elapsed_seconds": self.elapsed(), "metrics": []}
+        for name, labels, metric in self._items():
+            entry = {"name": name, "labels": dict(labels)}
+            if isinstance(metric, Histogram):
+                entry.update(
+                    count=metric.count, sum=metric.sum,
+                    p50=metric.percentile(0.50), p95=metric.percentile(0.95), p99=metric.percentile(0.99),
+                )
+            else:
+                entry["value"] = metric.value
+            snapshot["metrics"].append(entry)
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        lines, described = [], set()
+
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if len(pairs) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        for name, labels, metric in self._items():
+            if name not in described:
+                described.add(name)
+                if name in self.helps:
+                    lines.append(f"# HELP {name} {self.helps[name]}")
+                kind = "histogram" if isinstance(metric, Histogram) else "counter" if isinstance(metric, Counter) else "gauge"
+                lines.append(f"# TYPE {name} {kind}")
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                with metric.lock:
+                    counts = list(metric.counts)
+                for bound, count in zip(list(metric.buckets) + [math.inf], counts):
+                    cumulative += count
+                    le = "+Inf" if math.isinf(bound) else f"{bound:.6g}"
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {metric.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {metric.count}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filepath: str):
+        """Write a Prometheus textfile (`.prom`) or a JSON snapshot (anything else), atomically."""
+        if filepath.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+        tmp_filepath = filepath + ".tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as fout:
+            fout.write(content)
+        os.replace(tmp_filepath, filepath)
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed(), 1e-9)
+        lines = [f"Run metrics after {elapsed:.1f}s:"]
+        num_requests = self.total("llm_requests_total")
+        lines.append(f"  requests: {num_requests:.0f} ({num_requests / elapsed:.2f}/s)")
+        for name, title in (
+            ("llm_request_latency_seconds", "API latency"),
+            ("llm_time_to_first_token_seconds", "time to first token"),
+            ("consumer_postprocess_seconds", "postprocess time"),
+        ):
+            histogram = self.metrics.get((name, ()), None)
+            if histogram is not None and histogram.count > 0:
+                lines.append(
+                    f"  {title}: p50 {histogram.percentile(0.5):.3f}s, "
+                    f"p95 {histogram.percentile(0.95):.3f}s, p99 {histogram.percentile(0.99):.3f}s"
+                )
+        depth = self.metrics.get(("result_queue_depth_observed", ()), None)
+        if depth is not None and depth.count > 0:
+            idle_share = self.total("consumer_idle_seconds_total") / elapsed
+            lines.append(
+                f"  result queue: p50 {depth.percentile(0.5):.0f}, p95 {depth.percentile(0.95):.0f} waiting, "
+                f"consumer idle {idle_share:.0%} of the run"
+            )
+            if idle_share < 0.25 and depth.percentile(0.5) >= CONSUMER_BOUND_DEPTH:
+                lines.append("  -> the consumer is the limiting stage, `postprocess_workers` runs postprocessing in parallel")
+        for name, title in (
+            ("llm_prompt_tokens_total", "prompt tokens"),
+            ("llm_completion_tokens_total", "completion tokens"),
+        ):
+            total = self.total(name)
+            lines.append(f"  {title}: {total:.0f} ({total / elapsed:.1f}/s)")
+        cached_tokens, prompt_tokens = self.total("llm_cached_tokens_total"), self.total("llm_prompt_tokens_total")
+        lines.append(f"  cached prompt tokens: {cached_tokens:.0f} ({cached_tokens / max(prompt_tokens, 1):.1%} of prompt tokens)")
+        for name, title in (
+            ("llm_request_errors_total", "request errors"),
+            ("llm_rate_limited_total", "429 responses"),
+            ("producer_item_retries_total", "item retries"),
+            ("producer_dead_letters_total", "items given up"),
+        ):
+            per_label = [
+                f"{dict(labels).get('key', '') or 'all'}={metric.value:.0f}"
+                for metric_name, labels, metric in self._items() if metric_name == name and metric.value > 0
+            ]
+            lines.append(f"  {title}: {self.total(name):.0f}" + (f" ({', '.join(per_label)})" if len(per_label) > 1 else ""))
+        return "\n".join(lines)
+
+
+class MetricsExporter(object):
+    """Writes the registry to `filepath` every `interval` seconds from a background thread."""
+    def __init__(self, registry: MetricsRegistry, filepath: str, interval: float = 10.0):
+        self.registry = registry
+        self.filepath = filepath
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.export_loop, daemon=True)
+
+    def export_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def export(self):
+        try:
+            self.registry.write(self.filepath)
+        except OSError:
+            pass
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.export()
@@ -0,0 +1,111 @@
+import threading
+from typing import Callable, List
+
+
+class Stage(object):
+    """One chat turn of a multi-stage pipeline, see `LLMRunnerWrapperBase.stages`.
+
+    `prepare_func(inputs, outputs)` builds the prompt of this stage, a string or a dict like the return value
+    of `prepare_llm_inputs`, from the data item and `outputs`, the results of the earlier stages by name.
+    Returning None skips the stage, its result is None then. `gen_kwargs` override the generation arguments
+    (e.g. `n`, `temperature`) for this stage.
+    """
+    def __init__(self, name: str, prepare_func: Callable, **gen_kwargs):
+        self.name = name
+        self.prepare_func = prepare_func
+        self.gen_kwargs = gen_kwargs
+
+
+def check_stages(stages: List[Stage]):
+    names = [stage.name for stage in stages]
+    if len(names) == 0:
+        raise ValueError("A pipeline needs at least one stage.")
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stage names should be unique, got {names}.")
+
+
+class PipelineState(object):
+    """Results of the finished stages of items that failed halfway, so that a retry resumes at the failed stage.
+
+    Keyed by the `id` of the item. An entry is taken out when its item is retried and dropped when the item is
+    given up, see `LLMRunner.retry_delay`.
+    """
+    def __init__(self):
+        self.outputs = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.outputs)
+
+    def resume(self, item):
+        with self.lock:
+            return self.outputs.pop(item['id'], ({}, {}))
+
+    def save(self, item, prompts: dict, outputs: dict):
+        with self.lock:
+            self.outputs[item['id']] = (prompts, outputs)
+
+    def discard(self, item):
+        with self.lock:
+            self.outputs.pop(item['id'], None)
+
+
+def stage_prompt(stage: Stage, inputs: dict, outputs: dict):
+    prompt = stage.prepare_func(inputs, outputs)
+    if prompt is None or isinstance(prompt, dict):
+        return prompt
+    return {"prompt": prompt}
+
+
+def pipeline_wrapper(stages: List[Stage]):
+    """`producer_process_func` running `stages` one after the other for a data item.
+
+    The response is `{stage name: list of choices}` and the prompt `{stage name: prompt}`; both are handed
+    to `postprocess_llm_outputs`. Other items are in other stages meanwhile, on the other workers.
+    """
+    check_stages(stages)
+    state = PipelineState()
+
+    def pipeline_processor(inputs: dict, prompt_template: str, chat_one_turn_func):
+        prompts, outputs = state.resume(inputs)
+        for stage in stages:
+            if stage.name in outputs:
+                continue
+            prompt = stage_prompt(stage, inputs, outputs)
+            if prompt is None:
+                prompts[stage.name] = outputs[stage.name] = None
+                continue
+            result, err_msg = chat_one_turn_func(**{**stage.gen_kwargs, **prompt, "return_choices": True})
+            if err_msg is not None and len(err_msg) > 0:
+                state.save(inputs, prompts, outputs)
+                return {"prompt": prompts}, None, err_msg
+            prompts[stage.name], outputs[stage.name] = prompt["prompt"], result
+        return {"prompt": prompts}, outputs, ""
+
+    pipeline_processor.state = state
+    return pipeline_processor
+
+
+def async_pipeline_wrapper(stages: List[Stage]):
+    """Same as `pipeline_wrapper`, for the coroutine `chat_one_turn` of `AsyncLLMRequester`."""
+    check_stages(stages)
+    state = PipelineState()
+
+    async def pipeline_processor(inputs: dict, prompt_template: str, chat_one_turn_func):
+        prompts, outputs = state.resume(inputs)
+        for stage in stages:
+            if stage.name in outputs:
+                continue
+            prompt = stage_prompt(stage, inputs, outputs)
+            if prompt is None:
+                prompts[stage.name] = outputs[stage.name] = None
+                continue
+            result, err_msg = await chat_one_turn_func(**{**stage.gen_kwargs, **prompt, "return_choices": True})
+            if err_msg is not None and len(err_msg) > 0:
+                state.save(inputs, prompts, outputs)
+                return {"prompt": prompts}, None, err_msg
+            prompts[stage.name], outputs[stage.name] = prompt["prompt"], result
+        return {"prompt": prompts}, outputs, ""
+
+    pipeline_processor.state = state
+    return pipeline_processor
@@ -0,0 +1,187 @@
+import time
+import multiprocessing
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor
+from queue import Empty, Queue
+from typing import Callable, List, Tuple
+
+# (inputs, result, exception, seconds spent in `postprocess_func`)
+Postprocessed = Tuple[dict, object, Exception, float]
+
+POOL_START_TIMEOUT = 60.0
+
+_worker_state = {}
+
+
+def _init_worker(postprocess_func: Callable, started):
+    _worker_state["func"] = postprocess_func
+    # no worker takes a task before all of them are started, see `start_postprocess_pool`
+    started.wait(timeout=POOL_START_TIMEOUT)
+
+
+def _postprocess_in_worker(inputs: dict, response, prompt: dict, args: tuple, kwargs: dict):
+    start_time = time.monotonic()
+    result = _worker_state["func"](inputs, response, *args, **prompt, **kwargs)
+    return result, time.monotonic() - start_time
+
+
+def start_postprocess_pool(postprocess_func: Callable, num_workers: int) -> ProcessPoolExecutor:
+    """Start `num_workers` processes running `postprocess_func`, for `ProcessPostprocessor`.
+
+    The workers are forked where the platform allows, so `postprocess_func` (usually a bound method of the wrapper)
+    doesn't have to be picklable, only the inputs, responses and results. Forking copies only the calling thread,
+    so call this before starting any other thread, a lock held by one of them stays locked in the workers forever.
+    """
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    context = multiprocessing.get_context(start_method)
+    started = context.Barrier(num_workers + 1)
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(postprocess_func, started),
+    )
+    # Python < 3.11 starts a worker per submit while none is idle, and none is idle before all of them passed
+    # the barrier: so `num_workers` submits fork them all now, on every version. Without `max_tasks_per_child`
+    # the pool never replaces a worker, so later submits don't fork any more.
+    warm_up = [executor.submit(int) for _ in range(num_workers)]
+    started.wait(timeout=POOL_START_TIMEOUT)
+    for future in warm_up:
+        future.result()
+    return executor
+
+
+def _postprocess_inline(postprocess_func: Callable, inputs: dict, response, prompt: dict, args: tuple, kwargs: dict):
+    start_time = time.monotonic()
+    try:
+        result, exception = postprocess_func(inputs, response, *args, **prompt, **kwargs), None
+    except Exception as e:
+        result, exception = None, e
+    return inputs, result, exception, time.monotonic() - start_time
+
+
+class InlinePostprocessor(object):
+    """Runs `postprocess_func` right away on the consumer thread."""
+    num_pending = 0
+    max_pending = 1
+    broken = None
+
+    def __init__(self, postprocess_func: Callable, *args, **kwargs):
+        self.postprocess_func = postprocess_func
+        self.args = args
+        self.kwargs = kwargs
+        self.done: List[Postprocessed] = []
+
+    def submit(self, inputs: dict, response, prompt: dict):
+        self.done.append(_postprocess_inline(self.postprocess_func, inputs, response, prompt, self.args, self.kwargs))
+
+    def collect(self, timeout: float = 0.0) -> List[Postprocessed]:
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        pass
+
+
+class ProcessPostprocessor(object):
+    """Runs `postprocess_func` in the processes of `executor` (see `start_postprocess_pool`), so CPU-heavy
+    postprocessing doesn't hold up the consumer.
+
+    With `ordered`, `collect` hands out results in the order they were submitted, otherwise as soon as each one
+    is done. The consumer stops submitting while `max_pending` results are in the pool. The executor belongs to
+    the caller, `close` leaves it running for the next run.
+
+    If a worker dies, the pool is broken for good: the items still in it and all later ones are postprocessed
+    on the consumer thread instead, and `broken` is set so the caller can report the run as failed.
+    """
+    def __init__(
+        self,
+        postprocess_func: Callable,
+        executor: ProcessPoolExecutor,
+        num_workers: int,
+        ordered: bool = True,
+        max_pending: int = None,
+        *args,
+        **kwargs
+    ):
+        self.postprocess_func = postprocess_func
+        self.executor = executor
+        self.broken: BrokenExecutor = None
+        self.args = args
+        self.kwargs = kwargs
+        self.ordered = ordered
+        self.max_pending = max_pending if max_pending is not None else 4 * num_workers
+        self.done = Queue()
+        self.finished = {}
+        self.num_submitted = self.num_collected = 0
+
+    @property
+    def num_pending(self) -> int:
+        return self.num_submitted - self.num_collected
+
+    def submit(self, inputs: dict, response, prompt: dict):
+        seq = self.num_submitted
+        self.num_submitted += 1
+
+        def on_done(future: Future):
+            try:
+                result, seconds = future.result()
+                self.done.put((seq, (inputs, result, None, seconds), None))
+            except BrokenExecutor as e:
+                # a worker died, not `postprocess_func`: `collect` postprocesses the item on the consumer thread
+                self.done.put((seq, None, (inputs, response, prompt, e)))
+            except Exception as e:
+                self.done.put((seq, (inputs, None, e, 0.0), None))
+
+        if self.broken is None:
+            try:
+                self.executor.submit(
+                    _postprocess_in_worker, inputs, response, prompt, self.args, self.kwargs
+                ).add_done_callback(on_done)
+                return
+            except BrokenExecutor as e:
+                self.broken = e
+        self.done.put((seq, self.postprocess_inline(inputs, response, prompt), None))
+
+    def postprocess_inline(self, inputs: dict, response, prompt: dict) -> Postprocessed:
+        return _postprocess_inline(self.postprocess_func, inputs, response, prompt, self.args, self.kwargs)
+
+    def collect(self, timeout: float = 0.0) -> List[Postprocessed]:
+        """Results done so far, waiting up to `timeout` seconds for the first one."""
+        deadline = time.monotonic() + timeout
+        collected = []
+        while True:
+            try:
+                seq, postprocessed, rerun = self.done.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                break
+            if rerun is not None:
+                inputs, response, prompt, self.broken = rerun
+                postprocessed = self.postprocess_inline(inputs, response, prompt)
+            if not self.ordered:
+                collected.append(postprocessed)
+            else:
+                self.finished[seq] = postprocessed
+                while self.num_collected + len(collected) in self.finished:
+                    collected.append(self.finished.pop(self.num_collected + len(collected)))
+            if len(collected) > 0:
+                # got something, only take what's ready without waiting any longer
+                deadline = 0.0
+        self.num_collected += len(collected)
+        return collected
+
+    def close(self):
+        pass
+
+
+def get_postprocessor(
+    postprocess_func: Callable,
+    num_workers: int = 0,
+    ordered: bool = True,
+    executor: ProcessPoolExecutor = None,
+    *args,
+    **kwargs
+):
+    """`ProcessPostprocessor` on `executor`, the pool of `start_postprocess_pool`, if `num_workers > 0`."""
+    if num_workers > 0:
+        return ProcessPostprocessor(postprocess_func, executor, num_workers, ordered, None, *args, **kwargs)
+    return InlinePostprocessor(postprocess_func, *args, **kwargs)
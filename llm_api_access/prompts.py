@@ -0,0 +1,108 @@
+import json
+from itertools import islice
+from typing import Callable, Iterable, List
+
+
+# ~1024 tokens, the shortest prompt prefix providers cache
+PREFIX_GROUP_CHARS = 4096
+
+
+def load_prompt_prefix(system_prompt: str, few_shot_filepath: str = "") -> List[dict]:
+    """The messages sent before the user prompt of every request: the system prompt, then the few-shot examples.
+
+    `few_shot_filepath` is a JSON/YAML list of `{"role": ..., "content": ...}` messages (or a dict with
+    such a list under `messages`). Keeping them identical across requests makes them a cacheable prefix.
+    """
+    messages = []
+    if len(system_prompt) > 0:
+        messages.append({"role": "system", "content": system_prompt})
+    if len(few_shot_filepath) == 0:
+        return messages
+
+    with open(few_shot_filepath, "r", encoding="utf-8") as fin:
+        if few_shot_filepath.lower().endswith(".yaml") or few_shot_filepath.lower().endswith(".yml"):
+            import yaml
+            few_shot = yaml.safe_load(fin)
+        elif few_shot_filepath.lower().endswith(".json"):
+            few_shot = json.load(fin)
+        else:
+            raise ValueError("'few_shot_filepath' should only be YAML file or JSON file.")
+    if isinstance(few_shot, dict):
+        few_shot = few_shot["messages"]
+    for message in few_shot:
+        if message.get("role") not in ("system", "user", "assistant") or "content" not in message:
+            raise ValueError(f"Invalid few-shot message: {message}")
+        messages.append({"role": message["role"], "content": message["content"]})
+    return messages
+
+
+def order_by_prefix(items: List, keys: List[str], lead: int = 64, group_chars: int = PREFIX_GROUP_CHARS) -> List:
+    """Sort items by prompt, so that prompts sharing a prefix are sent back to back.
+
+    Prompts agreeing in their first `group_chars` characters form a group. The first item of each group
+    is sent `lead` items ahead of the rest of it: with `lead` above the number of requests in flight it is
+    answered, and the prefix cached, by the time the rest of its group is sent, instead of all of them
+    missing the cache at once.
+    """
+    order = sorted(range(len(items)), key=lambda idx: keys[idx])
+    groups = []
+    for idx in order:
+        if len(groups) > 0 and keys[groups[-1][0]][:group_chars] == keys[idx][:group_chars]:
+            groups[-1].append(idx)
+        else:
+            groups.append([idx])
+
+    # position of the rest of each group among the non-leading items
+    rest_starts, num_rest = [], 0
+    for group in groups:
+        rest_starts.append(num_rest)
+        num_rest += len(group) - 1
+
+    ordered, num_leaders, num_rest = [], 0, 0
+    for group in groups:
+        for idx in group[1:]:
+            while num_leaders < len(groups) and rest_starts[num_leaders] <= num_rest + lead:
+                ordered.append(groups[num_leaders][0])
+                num_leaders += 1
+            ordered.append(idx)
+            num_rest += 1
+    ordered.extend(group[0] for group in groups[num_leaders:])
+    return [items[idx] for idx in ordered]
+
+
+def prefix_scheduled(
+    data_items: Iterable,
+    prompt_func: Callable[[dict], str],
+    window: int = 10000,
+    lead: int = 64,
+) -> Iterable:
+    """Reorder `data_items` with `order_by_prefix`, `window` items at a time.
+
+    A list gives a list again; any other iterable is reordered lazily, one window in memory at a time.
+    """
+    def keys_of(chunk):
+        keys = []
+        for item in chunk:
+            try:
+                keys.append(prompt_func(item))
+            except Exception:
+                # fails again in the worker, where it is retried or given up
+                keys.append("")
+        return keys
+
+    if isinstance(data_items, list):
+        return [
+            item
+            for start in range(0, len(data_items), window)
+            for item in order_by_prefix(data_items[start:start + window], keys_of(data_items[start:start + window]), lead)
+        ]
+
+    def generate():
+        iterator = iter(data_items)
+        while True:
+            chunk = list(islice(iterator, window))
+            if len(chunk) == 0:
+                return
+            yield from order_by_prefix(chunk, keys_of(chunk), lead)
+
+    return generate()
@@ -0,0 +1,140 @@
+import time
+import asyncio
+import threading
+from typing import Callable, Mapping, Optional
+
+
+# rough per-image prompt cost, see https://platform.openai.com/docs/guides/vision
+LOW_DETAIL_IMAGE_TOKENS = 85
+HIGH_DETAIL_IMAGE_TOKENS = 765
+
+
+def estimate_payload_tokens(payload: dict) -> int:
+    """Estimate how many tokens a payload built by `LLMRequester.get_payload` counts against the TPM budget.
+
+    Providers charge `max_completion_tokens * n` up front, so the estimate includes it as well as the prompt.
+    Text is estimated at ~4 characters per token, which is corrected later from `completion.usage`.
+    """
+    prompt_chars = 0
+    num_tokens = 0
+    for message in payload.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            prompt_chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                prompt_chars += len(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                detail = part.get("image_url", {}).get("detail", "auto")
+                num_tokens += LOW_DETAIL_IMAGE_TOKENS if detail == "low" else HIGH_DETAIL_IMAGE_TOKENS
+        num_tokens += 4     # per-message overhead
+    num_tokens += prompt_chars // 4 + 1
+    num_tokens += payload.get("max_completion_tokens", 0) * payload.get("n", 1)
+    return num_tokens
+
+
+def _parse_header_int(headers: Mapping[str, str], key: str) -> Optional[int]:
+    value = headers.get(key, None)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+class TokenBucket(object):
+    def __init__(self, capacity: int, period: float = 60.0, now: float = None):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = float(capacity)
+        self.updated_at = time.monotonic() if now is None else now
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        # never ask for more than the bucket can ever hold, otherwise the request would wait forever
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimiter(object):
+    """Thread-safe requests-per-minute / tokens-per-minute limiter shared by all workers of a run.
+
+    Pass a budget of 0 to disable that dimension. The buckets are corrected with the actual usage of each
+    completion and clamped to the `x-ratelimit-*` headers reported by the provider. `clock` is only replaced
+    in tests.
+    """
+    def __init__(
+        self, requests_per_minute: int = 0, tokens_per_minute: int = 0, clock: Callable[[], float] = time.monotonic,
+    ):
+        self.clock = clock
+        now = self.clock()
+        self.request_bucket = TokenBucket(requests_per_minute, now=now) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute, now=now) if tokens_per_minute > 0 else None
+        self.lock = threading.Lock()
+
+    def _try_acquire(self, num_tokens: int) -> float:
+        """Take one request and `num_tokens` tokens if both are available, otherwise return seconds to wait."""
+        with self.lock:
+            now = self.clock()
+            wait = 0.0
+            for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, num_tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+            if self.request_bucket is not None:
+                self.request_bucket.level -= 1
+            if self.token_bucket is not None:
+                self.token_bucket.level -= min(num_tokens, self.token_bucket.capacity)
+            return 0.0
+
+    def acquire(self, num_tokens: int):
+        while True:
+            wait = self._try_acquire(num_tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def async_acquire(self, num_tokens: int):
+        while True:
+            wait = self._try_acquire(num_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def correct(self, estimated_tokens: int, actual_tokens: int):
+        """Give back (or charge) the difference between the estimated and the actually used tokens."""
+        if self.token_bucket is None:
+            return
+        with self.lock:
+            bucket = self.token_bucket
+            bucket.level = min(bucket.capacity, bucket.level + estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Clamp the local buckets to what the provider reports in its `x-ratelimit-*` response headers."""
+        with self.lock:
+            for bucket, name in ((self.request_bucket, "requests"), (self.token_bucket, "tokens")):
+                if bucket is None:
+                    continue
+                limit = _parse_header_int(headers, f"x-ratelimit-limit-{name}")
+                if limit is not None and 0 < limit < bucket.capacity:
+                    bucket.capacity = limit
+                    bucket.rate = limit / 60.0
+                remaining = _parse_header_int(headers, f"x-ratelimit-remaining-{name}")
+                if remaining is not None:
+                    bucket.level = min(bucket.level, remaining)
+
+    def pause(self):
+        """Empty the buckets after a 429 so that workers back off until they refill."""
+        with self.lock:
+            for bucket in (self.request_bucket, self.token_bucket):
+                if bucket is not None:
+                    bucket.level = min(bucket.level, 0.0)
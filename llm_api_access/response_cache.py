@@ -0,0 +1,214 @@
+import os
+import time
+import json
+import asyncio
+import hashlib
+import threading
+from typing import Callable, Optional
+from openai.types.chat import ChatCompletion
+from .streaming import is_early_stopped
+
+
+def payload_cache_key(payload: dict) -> str:
+    """Stable hash of everything that determines a completion: model, messages and sampling parameters."""
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.completion: Optional[ChatCompletion] = None
+
+
+class ResponseCache(object):
+    """Content-addressed on-disk cache of `ChatCompletion`s, shared by all workers of a run.
+
+    Entries live in `cache_dir/<key[:2]>/<key>.json` and are written atomically, so several workers
+    (or processes) can share one directory. Only deterministic payloads (`temperature == 0`) are cached
+    unless `force` is set. Identical requests that are in flight at the same time are coalesced, so only
+    the first one reaches the API and the others wait for its result. The async path does its disk IO in the
+    event loop's executor.
+    """
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size_mb: float = 1024,
+        max_age_hours: float = 0,
+        force: bool = False,
+        logger=None,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_hours * 3600
+        self.force = force
+        self.logger = logger
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.async_inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.total_size = 0
+        self.is_evicting = False
+        self.evict()
+
+    def is_cacheable(self, payload: dict) -> bool:
+        return self.force or payload.get("temperature", 1.0) == 0
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        filepath = self.entry_path(key)
+        try:
+            if self.max_age > 0 and time.time() - os.path.getmtime(filepath) > self.max_age:
+                os.remove(filepath)
+                return None
+            with open(filepath, "r", encoding="utf-8") as fin:
+                return ChatCompletion.model_validate_json(fin.read())
+        except Exception:
+            # missing, expired concurrently or half-written by a crashed process: treat as a miss
+            return None
+
+    def put(self, key: str, completion: ChatCompletion):
+        """Store `completion`; failing to do so only costs a later cache miss, so errors are logged, not raised.
+
+        Completions cut short by a stop predicate aren't stored, a run with other predicates needs the whole text.
+        """
+        if is_early_stopped(completion):
+            return
+        try:
+            size_delta = self._write(key, completion)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.warning(f"\033[91mCould not write response cache entry {key}: {e}\033[0m")
+            return
+
+        with self.lock:
+            self.total_size += size_delta
+            need_eviction = self.total_size > self.max_size and not self.is_evicting
+            if need_eviction:
+                self.is_evicting = True
+        if need_eviction:
+            self.evict()
+
+    def _write(self, key: str, completion: ChatCompletion) -> int:
+        """Write the entry atomically and return by how much it grew the cache."""
+        filepath = self.entry_path(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        data = completion.model_dump_json().encode("utf-8")
+        try:
+            old_size = os.path.getsize(filepath)
+        except OSError:
+            old_size = 0
+        tmp_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_filepath, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp_filepath, filepath)
+        return len(data) - old_size
+
+    def evict(self):
+        """Drop expired entries, then the oldest ones until the cache is back under 90% of `max_size`.
+
+        Scans the directory without holding the lock, so other workers keep reading and writing meanwhile.
+        """
+        try:
+            now = time.time()
+            entries = []
+            for root, _, filenames in os.walk(self.cache_dir):
+                for filename in filenames:
+                    filepath = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(filepath)
+                    except OSError:
+                        continue
+                    if self.max_age > 0 and now - stat.st_mtime > self.max_age:
+                        self._remove(filepath)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, filepath))
+
+            total_size = sum(entry[1] for entry in entries)
+            if total_size > self.max_size:
+                entries.sort()
+                for _, size, filepath in entries:
+                    if total_size <= self.max_size * 0.9:
+                        break
+                    self._remove(filepath)
+                    total_size -= size
+            with self.lock:
+                self.total_size = total_size
+        finally:
+            with self.lock:
+                self.is_evicting = False
+
+    def _remove(self, filepath: str):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+    def lookup(self, payload: dict):
+        key = payload_cache_key(payload)
+        completion = self.get(key)
+        with self.lock:
+            if completion is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return key, completion
+
+    def get_or_request(self, payload: dict, request_func: Callable[[dict], ChatCompletion]) -> ChatCompletion:
+        if not self.is_cacheable(payload):
+            return request_func(payload)
+        key, completion = self.lookup(payload)
+        if completion is not None:
+            return completion
+
+        with self.lock:
+            inflight = self.inflight.get(key, None)
+            is_leader = inflight is None
+            if is_leader:
+                inflight = self.inflight[key] = _InFlight()
+        if not is_leader:
+            inflight.event.wait()
+            if inflight.completion is not None:
+                return inflight.completion
+            # the leading request failed, try on our own
+            return request_func(payload)
+
+        try:
+            completion = request_func(payload)
+            inflight.completion = completion
+            self.put(key, completion)
+            return completion
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            inflight.event.set()
+
+    async def async_get_or_request(self, payload: dict, request_func: Callable) -> ChatCompletion:
+        if not self.is_cacheable(payload):
+            return await request_func(payload)
+        loop = asyncio.get_running_loop()
+        key, completion = await loop.run_in_executor(None, self.lookup, payload)
+        if completion is not None:
+            return completion
+
+        future = self.async_inflight.get(key, None)
+        if future is not None:
+            completion = await asyncio.shield(future)
+            if completion is not None:
+                return completion
+            return await request_func(payload)
+
+        future = loop.create_future()
+        self.async_inflight[key] = future
+        try:
+            completion = await request_func(payload)
+            await loop.run_in_executor(None, self.put, key, completion)
+            return completion
+        finally:
+            del self.async_inflight[key]
+            future.set_result(completion)
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import heapq
+import random
+import itertools
+import threading
+import traceback
+from queue import Full
+from typing import List
+from .sinks import iter_jsonl
+
+
+class ErrorMessage(str):
+    """`str(error)` that keeps the exception it came from, returned as `err_msg` by `chat_one_turn`."""
+    def __new__(cls, error: Exception):
+        message = super().__new__(cls, str(error))
+        message.error = error
+        return message
+
+
+class RequestFailedError(Exception):
+    """The producer function returned a non-empty `err_msg`."""
+    def __init__(self, err_msg: str):
+        super().__init__(err_msg)
+        self.error = getattr(err_msg, "error", None)
+
+
+def unwrap_error(error: Exception) -> Exception:
+    if isinstance(error, RequestFailedError) and error.error is not None:
+        return error.error
+    return error
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether sending the same request again may succeed.
+
+    Rejections of the request itself (400 incl. content policy, 401, 403, 404, 422) and running out of
+    keys are final. Rate limits, timeouts, connection errors, 5xx and unknown errors (e.g. from user code
+    or a malformed response) are retried, within `max_item_retries`.
+    """
+    import openai
+
+    error = unwrap_error(error)
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    if isinstance(error, RuntimeError) and "All API_KEY quota exceeded" in str(error):
+        return False
+    return True
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Full jitter exponential backoff before retry number `attempt + 1`."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RetryItem(object):
+    """A data item put back on the data queue, with the number of attempts it already had."""
+    def __init__(self, item, attempt: int):
+        self.item = item
+        self.attempt = attempt
+
+
+class RetryScheduler(object):
+    """Puts failed items back on the data queue once their backoff has passed, from a background thread.
+
+    It also keeps count of the items that are neither done nor given up, so that the producer only
+    stops the workers when no retry can come anymore, see `wait_until_done`. If the workers die, `cancel`
+    stops the waiting.
+    """
+    def __init__(self, data_queue):
+        self.data_queue = data_queue
+        self.heap = []
+        self.counter = itertools.count()
+        self.num_unfinished = 0
+        self.stopped = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.schedule_loop, daemon=True)
+        self.thread.start()
+
+    def submitted(self):
+        with self.condition:
+            self.num_unfinished += 1
+
+    def done(self):
+        """The item succeeded or was given up."""
+        with self.condition:
+            self.num_unfinished -= 1
+            self.condition.notify_all()
+
+    def schedule(self, item, attempt: int, delay: float):
+        with self.condition:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), RetryItem(item, attempt)))
+            self.condition.notify_all()
+
+    def schedule_loop(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (len(self.heap) == 0 or self.heap[0][0] > time.monotonic()):
+                    timeout = None if len(self.heap) == 0 else self.heap[0][0] - time.monotonic()
+                    self.condition.wait(timeout=timeout)
+                if self.stopped:
+                    return
+                _, _, retry_item = heapq.heappop(self.heap)
+            # outside the lock, the data queue is bounded and may block until a worker takes an item
+            while not self.cancelled:
+                try:
+                    self.data_queue.put(retry_item, timeout=1.0)
+                    break
+                except Full:
+                    continue
+
+    def wait_until_done(self) -> bool:
+        """Block until every item is done; False if `cancel` was called before that."""
+        with self.condition:
+            while self.num_unfinished > 0 and not self.cancelled:
+                self.condition.wait()
+            return self.num_unfinished == 0
+
+    def cancel(self):
+        """No worker is left to finish the remaining items."""
+        with self.condition:
+            self.cancelled = True
+            self.stopped = True
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+def dead_letter_filepath(output_filepath: str, dead_letter_path: str = "") -> str:
+    return dead_letter_path or f"{output_filepath}.failed.jsonl"
+
+
+class DeadLetterWriter(object):
+    """Appends items that exhausted their retries to a JSONL file, created on the first write."""
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.num_written = 0
+        self.lock = threading.Lock()
+
+    def write(self, item, error: Exception, attempts: int):
+        import openai
+
+        error = unwrap_error(error)
+        record = {
+            "item": item,
+            "error": str(error),
+            "error_type": type(error).__name__,
+            "attempts": attempts,
+            "failed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if not isinstance(error, openai.APIError):
+            record["traceback"] = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+            with open(self.filepath, "a", encoding="utf-8") as fout:
+                fout.write(line)
+            self.num_written += 1
+
+
+def load_dead_letters(filepath: str) -> List[dict]:
+    if not os.path.isfile(filepath):
+        return []
+    return [record["item"] for record in iter_jsonl(filepath)]
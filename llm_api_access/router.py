@@ -0,0 +1,250 @@
+import time
+import json
+import random
+import asyncio
+import threading
+from typing import List, Optional
+import openai
+from .api_keys import api_keys as registered_api_keys
+from .concurrency import AsyncWaiters
+from .http_clients import HttpClientPool
+
+
+# after this many consecutive connection errors / 5xx an endpoint is ejected for a while
+UNHEALTHY_THRESHOLD = 3
+EJECTION_SECONDS = 30.0
+MAX_EJECTION_SECONDS = 600.0
+# smoothing factor of the latency / error rate moving averages
+EWMA_ALPHA = 0.2
+
+
+def is_quota_error(error: Exception) -> bool:
+    """The key itself is unusable: out of quota, revoked or not allowed to use the model."""
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return True
+    return isinstance(error, openai.RateLimitError) and getattr(error, "code", None) == "insufficient_quota"
+
+
+def is_endpoint_error(error: Exception) -> bool:
+    """The endpoint is unreachable or failing, independent of the key."""
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+
+class Endpoint(object):
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.base_url = base_url
+        self.consecutive_failures = 0
+        self.ejection_seconds = EJECTION_SECONDS
+        self.ejected_until = 0.0
+
+
+class Route(object):
+    """One API key on one endpoint, with its own clients, concurrency limit and health statistics."""
+    def __init__(
+        self, endpoint: Endpoint, api_key: str, max_concurrency: int = 0, max_retries: int = 5, http_clients: HttpClientPool = None,
+    ):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.latency = 1.0      # optimistic prior, refined by the first responses
+        self.error_rate = 0.0
+        self.disabled = False
+        self.http_clients = http_clients if http_clients is not None else HttpClientPool()
+
+    @property
+    def name(self) -> str:
+        return f"{self.endpoint.name}/...{self.api_key[-4:]}"
+
+    @property
+    def client(self) -> openai.OpenAI:
+        return self.http_clients.client(self.api_key, self.endpoint.base_url, self.max_retries)
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        return self.http_clients.async_client(self.api_key, self.endpoint.base_url, self.max_retries)
+
+    def is_available(self, now: float) -> bool:
+        if self.disabled or self.endpoint.ejected_until > now:
+            return False
+        return self.max_concurrency <= 0 or self.in_flight < self.max_concurrency
+
+    def score(self) -> float:
+        # expected time until a new request on this route is answered successfully, lower is better
+        return (self.in_flight + 1) * self.latency / max(1.0 - self.error_rate, 0.05)
+
+
+class RequestRouter(object):
+    """Spreads requests over every (endpoint, API key) pair of a run.
+
+    Each request goes to the available route with the lowest expected latency, weighted by its recent
+    error rate. Keys that are out of quota or rejected are disabled for the rest of the run. Endpoints
+    that fail repeatedly are ejected for an exponentially growing cool-down. Thread-safe; the async
+    runner uses `async_acquire`.
+    """
+    def __init__(self, routes: List[Route], logger=None):
+        if len(routes) == 0:
+            raise ValueError("RequestRouter needs at least one route.")
+        self.routes = routes
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.async_waiters = AsyncWaiters()
+
+    @classmethod
+    def from_args(
+        cls, arguments, logger=None, max_retries: int = 1, http_clients: HttpClientPool = None,
+    ) -> Optional["RequestRouter"]:
+        """Build a router from `endpoints_config`, or from several keys of one endpoint.
+
+        Returns None when there is just one key on one endpoint, which needs no routing.
+        Routed clients retry only `max_retries` times themselves, so that failures reach the router
+        quickly and the next attempt can go to another route.
+        """
+        if len(arguments.endpoints_config) > 0:
+            endpoint_configs = load_endpoints_config(arguments.endpoints_config)
+        else:
+            endpoint_configs = [{"name": arguments.endpoint_name or "default", "base_url": arguments.base_url}]
+
+        routes = []
+        for config in endpoint_configs:
+            endpoint = Endpoint(name=config["name"], base_url=config["base_url"])
+            keys = config.get("api_keys", None) or config.get("api_key", None)
+            if keys is None and config["name"] in registered_api_keys:
+                keys = registered_api_keys[config["name"]]
+            if keys is None:
+                keys = arguments.api_key
+            if isinstance(keys, str):
+                keys = [keys]
+            max_concurrency = config.get("max_concurrency", arguments.max_concurrency_per_key)
+            for api_key in keys:
+                routes.append(Route(
+                    endpoint, api_key, max_concurrency=max_concurrency, max_retries=max_retries, http_clients=http_clients,
+                ))
+
+        if len(routes) == 1 and len(arguments.endpoints_config) == 0:
+            return None
+        return cls(routes, logger=logger)
+
+    def _log(self, message: str):
+        if self.logger is not None:
+            self.logger.warning(message)
+
+    def _try_acquire(self) -> Optional[Route]:
+        now = time.monotonic()
+        if all(route.disabled for route in self.routes):
+            raise RuntimeError("All API_KEY quota exceeded.")
+        candidates = [route for route in self.routes if route.is_available(now)]
+        if len(candidates) == 0:
+            return None
+        best_score = min(route.score() for route in candidates)
+        route = random.choice([route for route in candidates if route.score() == best_score])
+        route.in_flight += 1
+        return route
+
+    def _ejection_wait(self) -> Optional[float]:
+        """Seconds until the first ejected endpoint comes back, None if none is ejected."""
+        now = time.monotonic()
+        ejected = [route.endpoint.ejected_until - now for route in self.routes if route.endpoint.ejected_until > now]
+        return min(ejected) if len(ejected) > 0 else None
+
+    def _wait_time(self) -> float:
+        # routes are either saturated (woken up by `release`) or ejected (wait for the earliest to come back)
+        wait = self._ejection_wait()
+        return wait if wait is not None else 1.0
+
+    def acquire(self) -> Route:
+        with self.condition:
+            while True:
+                route = self._try_acquire()
+                if route is not None:
+                    return route
+                self.condition.wait(timeout=self._wait_time())
+
+    async def async_acquire(self) -> Route:
+        while True:
+            with self.condition:
+                route = self._try_acquire()
+                if route is not None:
+                    return route
+                waiter = self.async_waiters.add()
+                timeout = self._ejection_wait()
+            try:
+                # woken by `release`/`cancel`, or when an ejected endpoint comes back
+                await asyncio.wait([waiter], timeout=timeout)
+            except asyncio.CancelledError:
+                with self.condition:
+                    self.async_waiters.discard(waiter)
+                raise
+            if not waiter.done():
+                with self.condition:
+                    self.async_waiters.discard(waiter)
+
+    def _notify(self, wake_all: bool = False):
+        # a finished request frees at most one slot; a disabled key may leave none, which every waiter has to see
+        self.condition.notify_all()
+        if wake_all:
+            self.async_waiters.notify_all()
+        else:
+            self.async_waiters.notify(1)
+
+    def cancel(self, route: Route):
+        """Give back a route whose request was cancelled, without counting it as success or failure."""
+        with self.condition:
+            route.in_flight -= 1
+            self._notify()
+
+    def release(self, route: Route, latency: float, error: Exception = None):
+        with self.condition:
+            route.in_flight -= 1
+            endpoint = route.endpoint
+            was_disabled = route.disabled
+            if error is None:
+                route.latency = (1 - EWMA_ALPHA) * route.latency + EWMA_ALPHA * latency
+                route.error_rate = (1 - EWMA_ALPHA) * route.error_rate
+                endpoint.consecutive_failures = 0
+                endpoint.ejection_seconds = EJECTION_SECONDS
+            else:
+                route.error_rate = (1 - EWMA_ALPHA) * route.error_rate + EWMA_ALPHA
+                if is_quota_error(error) and not route.disabled:
+                    route.disabled = True
+                    self._log(f"Disable API key '{route.name}' because: {error}")
+                elif is_endpoint_error(error) and endpoint.ejected_until <= time.monotonic():
+                    # failures of requests sent before the ejection don't count again
+                    endpoint.consecutive_failures += 1
+                    if endpoint.consecutive_failures >= UNHEALTHY_THRESHOLD:
+                        endpoint.ejected_until = time.monotonic() + endpoint.ejection_seconds
+                        self._log(f"Eject endpoint '{endpoint.name}' for {endpoint.ejection_seconds:.0f}s because: {error}")
+                        endpoint.ejection_seconds = min(endpoint.ejection_seconds * 2, MAX_EJECTION_SECONDS)
+                        endpoint.consecutive_failures = 0
+            self._notify(wake_all=route.disabled and not was_disabled)
+
+    def http_client_pools(self) -> List[HttpClientPool]:
+        return list({id(route.http_clients): route.http_clients for route in self.routes}.values())
+
+    def close(self):
+        for http_clients in self.http_client_pools():
+            http_clients.close()
+
+    async def async_close(self):
+        for http_clients in self.http_client_pools():
+            await http_clients.async_close()
+
+
+def load_endpoints_config(filepath: str) -> List[dict]:
+    """Read a YAML/JSON list of `{name, base_url, api_keys, max_concurrency}` endpoint definitions.
+
+    `api_keys` may be omitted, then the keys registered under `name` in `llm_api_access.api_keys` are used.
+    """
+    with open(filepath, "r", encoding="utf-8") as fin:
+        if filepath.lower().endswith(".yaml") or filepath.lower().endswith(".yml"):
+            import yaml
+            configs = yaml.safe_load(fin)
+        elif filepath.lower().endswith(".json"):
+            configs = json.load(fin)
+        else:
+            raise ValueError("'endpoints_config' should only be YAML file or JSON file.")
+    if isinstance(configs, dict):
+        configs = configs["endpoints"]
+    return configs
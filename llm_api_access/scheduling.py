@@ -0,0 +1,126 @@
+import heapq
+import itertools
+import threading
+from typing import Callable, Iterable, List, Tuple
+
+
+# prior latency model in seconds: base + per 1k prompt tokens + per image + per 1k allowed completion tokens,
+# roughly prefill at ~5k tokens/s and a quarter of `max_completion_tokens` generated at ~50 tokens/s
+PRIOR_WEIGHTS = (0.5, 0.2, 0.1, 5.0)
+# how many observations the prior is worth
+PRIOR_STRENGTH = 1.0
+
+
+def request_features(inputs, max_completion_tokens: int = 256) -> Tuple[float, ...]:
+    """(1, prompt tokens / 1k, images, completion token limit / 1k) of the prepared inputs of a data item."""
+    if isinstance(inputs, str):
+        inputs = {"prompt": inputs}
+    num_images = 0
+    for key in ("image_url", "image_path"):
+        images = inputs.get(key, None)
+        if isinstance(images, str):
+            num_images += 1
+        elif isinstance(images, (list, tuple)):
+            num_images += len(images)
+    # ~4 characters per token, like the rate limiter's estimate
+    prompt_tokens = len(inputs.get("prompt", "")) / 4
+    completion_tokens = inputs.get("max_completion_tokens", None) or max_completion_tokens
+    return (1.0, prompt_tokens / 1000, float(num_images), completion_tokens / 1000)
+
+
+def solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """Solve `matrix @ x = vector` by Gaussian elimination with partial pivoting."""
+    size = len(vector)
+    rows = [list(matrix[idx]) + [vector[idx]] for idx in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda row: abs(rows[row][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for row in range(col + 1, size):
+            factor = rows[row][col] / rows[col][col]
+            for idx in range(col, size + 1):
+                rows[row][idx] -= factor * rows[col][idx]
+    solution = [0.0] * size
+    for row in reversed(range(size)):
+        solution[row] = (rows[row][size] - sum(rows[row][idx] * solution[idx] for idx in range(row + 1, size))) / rows[row][row]
+    return solution
+
+
+class ScheduledItem(object):
+    """A data item handed to a worker by `longest_first`, with the features its cost was estimated from."""
+    def __init__(self, item, features: Tuple[float, ...]):
+        self.item = item
+        self.features = features
+
+
+class RequestCostEstimator(object):
+    """Expected latency of the request of a data item, linear in its `request_features`.
+
+    `features_func` maps a data item to its features. With `refine`, the weights are fitted to the observed
+    latencies by ridge regression towards `PRIOR_WEIGHTS`, so that e.g. a slow generation speed makes the
+    completion token limit count more. Only the order of the estimates matters for scheduling.
+    """
+    def __init__(self, features_func: Callable, refine: bool = True):
+        self.features_func = features_func
+        self.refine = refine
+        self.weights = list(PRIOR_WEIGHTS)
+        size = len(PRIOR_WEIGHTS)
+        # normal equations of the ridge regression, starting from the prior
+        self.gram = [[PRIOR_STRENGTH if row == col else 0.0 for col in range(size)] for row in range(size)]
+        self.moments = [PRIOR_STRENGTH * weight for weight in PRIOR_WEIGHTS]
+        self.num_observations = 0
+        # bumped whenever the weights change, so that queued estimates can be redone
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def features(self, item) -> Tuple[float, ...]:
+        try:
+            return self.features_func(item)
+        except Exception:
+            # fails again in the worker, where it is retried or given up
+            return (1.0, 0.0, 0.0, 0.0)
+
+    def estimate(self, features: Tuple[float, ...]) -> float:
+        return sum(weight * feature for weight, feature in zip(self.weights, features))
+
+    def observe(self, features: Tuple[float, ...], latency: float):
+        if not self.refine:
+            return
+        with self.lock:
+            for row, row_feature in enumerate(features):
+                for col, col_feature in enumerate(features):
+                    self.gram[row][col] += row_feature * col_feature
+                self.moments[row] += row_feature * latency
+            self.num_observations += 1
+            # refit at 16, 32, 64, ... observations, each refit reorders the queued items
+            if self.num_observations >= 16 and self.num_observations & (self.num_observations - 1) == 0:
+                try:
+                    self.weights = solve(self.gram, self.moments)
+                    self.version += 1
+                except ZeroDivisionError:
+                    pass
+
+
+def longest_first(data_items: Iterable, estimator: RequestCostEstimator, window: int = 100000) -> Iterable[ScheduledItem]:
+    """Yield `data_items` as `ScheduledItem`s, the most expensive of the next `window` items first.
+
+    With all items in the window this is longest-processing-time-first: the long requests start early,
+    instead of one of them being dequeued last and keeping the run going long after everything else.
+    """
+    heap, counter, version = [], itertools.count(), estimator.version
+
+    def pop():
+        nonlocal heap, version
+        if version != estimator.version:
+            version = estimator.version
+            heap = [(-estimator.estimate(features), order, item, features) for _, order, item, features in heap]
+            heapq.heapify(heap)
+        _, _, item, features = heapq.heappop(heap)
+        return ScheduledItem(item, features)
+
+    for item in data_items:
+        features = estimator.features(item)
+        heapq.heappush(heap, (-estimator.estimate(features), next(counter), item, features))
+        if len(heap) >= window:
+            yield pop()
+    while len(heap) > 0:
+        yield pop()
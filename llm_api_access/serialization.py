@@ -0,0 +1,78 @@
+import re
+import json
+from typing import Callable, Union
+
+SERIALIZERS = ["auto", "orjson", "msgspec", "json"]
+
+
+class Serializer(object):
+    """Encodes one item as a single line of UTF-8 JSON (non-ASCII kept as is, like `ensure_ascii=False`) and decodes it.
+
+    orjson and msgspec are several times faster than the stdlib `json`. Items they can't encode, e.g. integers
+    beyond 64 bits, fall back to the stdlib, so every serializer writes what `json` would accept.
+    """
+    def __init__(self, name: str, dumps_func: Callable = None, loads_func: Callable = None):
+        self.name = name
+        self.dumps_func = dumps_func
+        self.loads_func = loads_func if loads_func is not None else json.loads
+
+    def dumps(self, obj) -> bytes:
+        if self.dumps_func is not None:
+            try:
+                return self.dumps_func(obj)
+            except Exception:
+                pass
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    def loads(self, data: Union[bytes, str]):
+        return self.loads_func(data)
+
+
+# 20 digits in a row, which may be an integer beyond 64 bits
+_LONG_DIGITS = {bytes: re.compile(rb"[0-9]{20}"), str: re.compile(r"[0-9]{20}")}
+
+
+def _orjson_serializer() -> Serializer:
+    import orjson
+
+    def loads(data: Union[bytes, str]):
+        # orjson reads integers beyond 64 bits as floats, the stdlib keeps them exact
+        if _LONG_DIGITS[type(data)].search(data) is not None:
+            return json.loads(data)
+        return orjson.loads(data)
+
+    return Serializer(
+        "orjson",
+        dumps_func=lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+        loads_func=loads,
+    )
+
+
+def _msgspec_serializer() -> Serializer:
+    import msgspec
+    encoder, decoder = msgspec.json.Encoder(), msgspec.json.Decoder()
+    return Serializer("msgspec", dumps_func=encoder.encode, loads_func=decoder.decode)
+
+
+_serializers = {}
+
+
+def get_serializer(name: str = "auto") -> Serializer:
+    """`auto` picks orjson, then msgspec, then the stdlib `json`, whichever is installed first."""
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown serializer '{name}', should be one of {SERIALIZERS}.")
+    if name not in _serializers:
+        if name == "json":
+            _serializers[name] = Serializer("json")
+        elif name == "orjson":
+            _serializers[name] = _orjson_serializer()
+        elif name == "msgspec":
+            _serializers[name] = _msgspec_serializer()
+        else:
+            for candidate in ["orjson", "msgspec", "json"]:
+                try:
+                    _serializers[name] = get_serializer(candidate)
+                    break
+                except ImportError:
+                    continue
+    return _serializers[name]
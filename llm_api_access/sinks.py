@@ -0,0 +1,497 @@
+import io
+import os
+import gzip
+import json
+import heapq
+import shutil
+import tempfile
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional
+from .serialization import Serializer, get_serializer
+
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+COLUMNAR_SUFFIXES = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+JSON_COLUMNS_KEY = b"llm_api_access.json_columns"
+
+
+def compression_of(filepath: str) -> Optional[str]:
+    """`gzip` for `*.gz`, `zstd` for `*.zst` and None for uncompressed files."""
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if filepath.lower().endswith(suffix):
+            return compression
+    return None
+
+
+def columnar_format_of(filepath: str) -> Optional[str]:
+    """`parquet` for `*.parquet`, `arrow` for `*.arrow`/`*.feather` and None for JSON/JSONL files."""
+    for suffix, columnar_format in COLUMNAR_SUFFIXES.items():
+        if filepath.lower().endswith(suffix):
+            return columnar_format
+    return None
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing '*.zst' files needs `zstandard`: pip install llm-api-access[zstd]")
+    return zstandard
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Reading or writing Parquet/Arrow files needs `pyarrow`: pip install llm-api-access[parquet]")
+    return pyarrow
+
+
+def open_binary(filepath: str, mode: str = "rb", compression: str = None) -> BinaryIO:
+    """Open a plain, gzip or zstd file for streaming reads ("rb") or writes ("wb"); `compression` defaults to
+    the one of the file suffix. Concatenated gzip members / zstd frames are read as one stream."""
+    compression = compression if compression is not None else compression_of(filepath)
+    if compression == "gzip":
+        return gzip.open(filepath, mode, compresslevel=6)
+    if compression == "zstd":
+        zstandard = _import_zstandard()
+        fh = open(filepath, mode)
+        if "r" in mode:
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True))
+        return zstandard.ZstdCompressor().stream_writer(fh)
+    return open(filepath, mode)
+
+
+def compress(data: bytes, compression: str = None) -> bytes:
+    """`data` as one self-contained gzip member / zstd frame, which can be appended to a compressed file."""
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        return _import_zstandard().ZstdCompressor().compress(data)
+    return data
+
+
+def iter_jsonl(filepath: str, serializer: Serializer = None, compression: str = None) -> Iterator[dict]:
+    serializer = serializer if serializer is not None else get_serializer()
+    with open_binary(filepath, "rb", compression=compression) as fin:
+        for line in fin:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            yield serializer.loads(line)
+
+
+def iter_json_array(filepath: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """Items of a JSON array file, decoded one at a time, so only the item being decoded is held in memory."""
+    decoder = json.JSONDecoder()
+    with open(filepath, "r", encoding="utf-8") as fin:
+        buffer, pos, is_eof = "", 0, False
+
+        def skip(chars: str) -> bool:
+            """Move `pos` past `chars`, reading on as needed; False at the end of the file."""
+            nonlocal buffer, pos, is_eof
+            while True:
+                while pos < len(buffer) and buffer[pos] in chars:
+                    pos += 1
+                if pos < len(buffer):
+                    return True
+                if is_eof:
+                    return False
+                buffer, pos = fin.read(chunk_size), 0
+                is_eof = len(buffer) == 0
+
+        if not skip(" \t\r\n") or buffer[pos] != "[":
+            raise ValueError(f"'{filepath}' is not a JSON array.")
+        pos += 1
+        while skip(" \t\r\n,") and buffer[pos] != "]":
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # a number cut off by the end of the buffer decodes as well, so the item must be followed by a delimiter
+                    if (end < len(buffer) and buffer[end] in " \t\r\n,]") or is_eof:
+                        break
+                except json.JSONDecodeError:
+                    if is_eof:
+                        raise
+                more = fin.read(max(chunk_size, len(buffer) - pos))
+                buffer, pos, is_eof = buffer[pos:] + more, 0, len(more) == 0
+            pos = end
+            yield item
+
+
+def first_non_blank_char(name, chunk_size: int = 4096) -> str:
+    """Return the first non-whitespace character of a (compressed) text file, or "" if it's blank.
+    Only reads as far as needed."""
+    with open_binary(name, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if len(chunk) == 0:
+                return ""
+            chunk = chunk.lstrip()
+            if len(chunk) > 0:
+                return chunk[:1].decode("utf-8", errors="replace")
+
+
+def is_empty_output(filepath: str) -> bool:
+    if columnar_format_of(filepath) is not None:
+        return os.path.getsize(filepath) == 0
+    return len(first_non_blank_char(filepath)) == 0
+
+
+def iter_items(filepath: str, columns: List[str] = None, serializer: Serializer = None) -> Iterator[dict]:
+    """Items of a file in any format an `OutputSink` writes: a JSON array, (gzip/zstd compressed) JSONL,
+    Parquet or Arrow. `columns` restricts the fields read from columnar files, other formats yield whole items."""
+    columnar_format = columnar_format_of(filepath)
+    if columnar_format is not None:
+        yield from _iter_columnar(filepath, columnar_format, columns=columns)
+        return
+    serializer = serializer if serializer is not None else get_serializer()
+    if compression_of(filepath) is None and first_non_blank_char(filepath) == "[":
+        yield from iter_json_array(filepath)
+        return
+    yield from iter_jsonl(filepath, serializer=serializer)
+
+
+def _merge_arrow_types(items: List[dict], column_types: dict):
+    """Merge the column types of `items` into `column_types`, which maps each key to an arrow type, or to None
+    for a column stored as JSON strings: nested fields (dicts, lists) and fields of mixed types. The schema
+    metadata lists those columns, so `_iter_columnar` decodes them again."""
+    pyarrow = _import_pyarrow()
+    for key in dict.fromkeys(key for item in items for key in item):
+        if key in column_types and column_types[key] is None:
+            continue
+        values = [item.get(key) for item in items]
+        column_type = None
+        if not any(isinstance(value, (dict, list, tuple)) for value in values):
+            try:
+                known_type = column_types.get(key, pyarrow.null())
+                column_type = pyarrow.unify_schemas(
+                    [pyarrow.schema([(key, known_type)]), pyarrow.schema([(key, pyarrow.array(values).type)])],
+                    promote_options="permissive",
+                ).field(key).type
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+                pass
+        column_types[key] = column_type
+
+
+def _arrow_schema(column_types: dict):
+    pyarrow = _import_pyarrow()
+    json_columns = [key for key, column_type in column_types.items() if column_type is None]
+    return pyarrow.schema(
+        [(key, pyarrow.string() if column_type is None else column_type) for key, column_type in column_types.items()],
+        metadata={JSON_COLUMNS_KEY: json.dumps(json_columns)},
+    )
+
+
+def _to_arrow_table(items: List[dict], schema, serializer: Serializer):
+    """`items` as a table of `schema`, see `_merge_arrow_types`; missing fields become null."""
+    pyarrow = _import_pyarrow()
+    json_columns = set(json.loads(schema.metadata[JSON_COLUMNS_KEY]))
+    arrays = []
+    for field in schema:
+        values = [item.get(field.name) for item in items]
+        if field.name in json_columns:
+            values = [None if value is None else serializer.dumps(value).decode("utf-8") for value in values]
+        arrays.append(pyarrow.array(values, type=field.type))
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def _iter_columnar(filepath: str, columnar_format: str, columns: List[str] = None) -> Iterator[dict]:
+    pyarrow = _import_pyarrow()
+    if columnar_format == "parquet":
+        import pyarrow.parquet as pq
+        reader = pq.ParquetFile(filepath)
+        schema = reader.schema_arrow
+        batches = reader.iter_batches(columns=columns)
+    else:
+        import pyarrow.ipc
+        reader = pyarrow.ipc.open_file(filepath)
+        schema = reader.schema
+        batches = (reader.get_batch(idx) for idx in range(reader.num_record_batches))
+        if columns is not None:
+            batches = (batch.select(columns) for batch in batches)
+    metadata = schema.metadata or {}
+    column_names = columns if columns is not None else schema.names
+    json_columns = [key for key in json.loads(metadata.get(JSON_COLUMNS_KEY, b"[]")) if key in column_names]
+    serializer = get_serializer()
+    # one batch at a time, the file may not fit in memory
+    for batch in batches:
+        for item in batch.to_pylist():
+            for key in json_columns:
+                if item[key] is not None:
+                    item[key] = serializer.loads(item[key])
+            yield item
+
+
+def id_sort_key(sample_item: dict) -> Callable[[dict], object]:
+    """Sort numerically if the ids look like integers, lexicographically otherwise."""
+    try:
+        _ = int(sample_item['id'])
+        return lambda item: int(item['id'])
+    except Exception:
+        return lambda item: item['id']
+
+
+def sorted_by_id(items: Iterable[dict], tmp_dir: str = None, chunk_size: int = 100000) -> Iterator[dict]:
+    """Yield `items` ordered by `id` with an external merge sort.
+
+    At most `chunk_size` items are held in memory; larger inputs are spilled as sorted JSONL chunks
+    into a temporary directory under `tmp_dir` and lazily k-way merged.
+    """
+    iterator = iter(items)
+    chunk = _take(iterator, chunk_size)
+    if len(chunk) == 0:
+        return
+    key = id_sort_key(chunk[0])
+    chunk.sort(key=key)
+    next_chunk = _take(iterator, chunk_size)
+    if len(next_chunk) == 0:
+        # everything fits in memory
+        yield from chunk
+        return
+
+    spill_dir = tempfile.mkdtemp(prefix="sort-", dir=tmp_dir)
+    try:
+        chunk_filepaths = [_spill(chunk, spill_dir, 0)]
+        del chunk
+        while len(next_chunk) > 0:
+            next_chunk.sort(key=key)
+            chunk_filepaths.append(_spill(next_chunk, spill_dir, len(chunk_filepaths)))
+            next_chunk = _take(iterator, chunk_size)
+        yield from heapq.merge(*[iter_jsonl(filepath) for filepath in chunk_filepaths], key=key)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def _take(iterator: Iterator, n: int) -> List:
+    chunk = []
+    for item in iterator:
+        chunk.append(item)
+        if len(chunk) >= n:
+            break
+    return chunk
+
+
+def _spill(chunk: List[dict], spill_dir: str, idx: int) -> str:
+    filepath = os.path.join(spill_dir, f"chunk-{idx:06d}.jsonl")
+    serializer = get_serializer()
+    with open(filepath, "wb") as fout:
+        fout.write(b"".join(serializer.dumps(item) + b"\n" for item in chunk))
+    return filepath
+
+
+def _output_dir(filepath: str) -> str:
+    return os.path.dirname(os.path.abspath(filepath))
+
+
+def _ends_with_complete_line(filepath: str, compression: str = None) -> bool:
+    """Decompress the whole file; raises if a gzip member is torn. A zstd stream reader stops silently at
+    a torn frame, so zstd frames are walked one by one."""
+    last_byte = b"\n"
+    if compression != "zstd":
+        with open_binary(filepath, "rb", compression=compression) as fin:
+            for chunk in iter(lambda: fin.read(1 << 20), b""):
+                last_byte = chunk[-1:]
+        return last_byte == b"\n"
+
+    decompressor = _import_zstandard().ZstdDecompressor()
+    frame, is_complete = decompressor.decompressobj(), True
+    with open(filepath, "rb") as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b""):
+            while len(chunk) > 0:
+                data = frame.decompress(chunk)
+                last_byte = data[-1:] or last_byte
+                chunk, is_complete = b"", frame.eof
+                if frame.eof:
+                    chunk, frame = frame.unused_data, decompressor.decompressobj()
+    return is_complete and last_byte == b"\n"
+
+
+class OutputSink(object):
+    """Where the `Consumer` puts postprocessed results.
+
+    `write` is called for every flushed batch and must be cheap (an append); `finalize` is called once
+    at the end of a run and may rewrite the output, e.g. to sort it by `id`.
+    """
+    def __init__(self, output_filepath: str, serializer: Serializer = None, *args, **kwargs):
+        self.output_filepath = output_filepath
+        self.serializer = serializer if serializer is not None else get_serializer()
+
+    def write(self, items: List[dict]):
+        raise NotImplementedError
+
+    def finalize(self, sort_by_id: bool = True):
+        pass
+
+
+class JsonlSink(OutputSink):
+    """JSONL, gzip or zstd compressed if `output_filepath` ends with `.gz`/`.zst`.
+
+    A compressed batch is appended as a gzip member / zstd frame of its own, a valid continuation of the file.
+    """
+    def __init__(self, output_filepath: str, *args, **kwargs):
+        super().__init__(output_filepath, *args, **kwargs)
+        self.compression = compression_of(output_filepath)
+
+    def write(self, items: List[dict]):
+        if len(items) == 0:
+            return
+        data = b"".join(self.serializer.dumps(item) + b"\n" for item in items)
+        with open(self.output_filepath, "ab") as fout:
+            fout.write(compress(data, self.compression))
+
+    def rewrite(self, items: Iterable[dict]):
+        tmp_filepath = self.output_filepath + ".tmp"
+        with open_binary(tmp_filepath, "wb", compression=self.compression) as fout:
+            for item in items:
+                fout.write(self.serializer.dumps(item) + b"\n")
+        os.replace(tmp_filepath, self.output_filepath)
+
+    def finalize(self, sort_by_id: bool = True):
+        if not sort_by_id or not os.path.isfile(self.output_filepath):
+            return
+        self.rewrite(sorted_by_id(
+            iter_jsonl(self.output_filepath, serializer=self.serializer), tmp_dir=_output_dir(self.output_filepath)
+        ))
+
+    def repair(self):
+        """Drop a batch torn by an interrupted run, which would hide every batch appended after it."""
+        try:
+            if _ends_with_complete_line(self.output_filepath, self.compression):
+                return
+        except Exception:
+            pass
+        self.rewrite(self.iter_readable_items())
+
+    def iter_readable_items(self) -> Iterator[dict]:
+        try:
+            yield from iter_jsonl(self.output_filepath, serializer=self.serializer, compression=self.compression)
+        except Exception:
+            return
+
+
+class StagedSink(OutputSink):
+    """Appends to a JSONL staging file during the run and writes the output file once in `finalize`."""
+    staging_suffix = ".partial.jsonl"
+
+    def __init__(self, output_filepath: str, *args, **kwargs):
+        super().__init__(output_filepath, *args, **kwargs)
+        self.staging_filepath = output_filepath + self.staging_suffix
+        self.staging_sink = JsonlSink(self.staging_filepath, serializer=self.serializer)
+
+    def write(self, items: List[dict]):
+        self.staging_sink.write(items)
+
+    def iter_items(self) -> Iterator[dict]:
+        # items of a previous run come first
+        if os.path.isfile(self.output_filepath) and not is_empty_output(self.output_filepath):
+            yield from iter_items(self.output_filepath, serializer=self.serializer)
+        if os.path.isfile(self.staging_filepath):
+            yield from iter_jsonl(self.staging_filepath, serializer=self.serializer)
+
+    def write_output(self, items: Iterable[dict], filepath: str):
+        raise NotImplementedError
+
+    def finalize(self, sort_by_id: bool = True):
+        if not os.path.isfile(self.staging_filepath):
+            return
+        items = self.iter_items()
+        if sort_by_id:
+            items = sorted_by_id(items, tmp_dir=_output_dir(self.output_filepath))
+
+        tmp_filepath = self.output_filepath + ".tmp"
+        self.write_output(items, tmp_filepath)
+        os.replace(tmp_filepath, self.output_filepath)
+        os.remove(self.staging_filepath)
+
+    def remove(self):
+        if os.path.isfile(self.staging_filepath):
+            os.remove(self.staging_filepath)
+
+
+class JsonSink(StagedSink):
+    def write_output(self, items: Iterable[dict], filepath: str):
+        with open(filepath, "w", encoding="utf-8") as fout:
+            # same layout as `json.dump(data, fout, ensure_ascii=False, indent=4)`
+            is_first = True
+            for item in items:
+                fout.write("[\n" if is_first else ",\n")
+                fout.write("    " + json.dumps(item, ensure_ascii=False, indent=4).replace("\n", "\n    "))
+                is_first = False
+            fout.write("[]" if is_first else "\n]")
+
+
+class ColumnarSink(StagedSink):
+    """Parquet (`*.parquet`) or Arrow IPC (`*.arrow`/`*.feather`) output, written once in `finalize`.
+
+    The items are spilled to a JSONL file while their schema is inferred, then written from it in batches of
+    `batch_size`, so neither pass holds more than a batch in memory.
+    """
+    batch_size = 10000
+
+    def __init__(self, output_filepath: str, *args, **kwargs):
+        super().__init__(output_filepath, *args, **kwargs)
+        self.columnar_format = columnar_format_of(output_filepath)
+        _import_pyarrow()
+
+    def write_output(self, items: Iterable[dict], filepath: str):
+        pyarrow = _import_pyarrow()
+        spill_dir = tempfile.mkdtemp(prefix="columnar-", dir=_output_dir(filepath))
+        try:
+            spill_filepath = os.path.join(spill_dir, "items.jsonl")
+            column_types = {}
+            with open(spill_filepath, "wb") as fout:
+                iterator = iter(items)
+                batch = _take(iterator, self.batch_size)
+                while len(batch) > 0:
+                    _merge_arrow_types(batch, column_types)
+                    fout.write(b"".join(self.serializer.dumps(item) + b"\n" for item in batch))
+                    batch = _take(iterator, self.batch_size)
+            schema = _arrow_schema(column_types)
+
+            if self.columnar_format == "parquet":
+                import pyarrow.parquet as pq
+                writer = pq.ParquetWriter(filepath, schema, compression="zstd")
+            else:
+                import pyarrow.ipc
+                # what `feather.write_feather` writes
+                writer = pyarrow.ipc.new_file(filepath, schema, options=pyarrow.ipc.IpcWriteOptions(compression="lz4"))
+            with writer:
+                iterator = iter_jsonl(spill_filepath, serializer=self.serializer)
+                batch = _take(iterator, self.batch_size)
+                while len(batch) > 0:
+                    writer.write_table(_to_arrow_table(batch, schema, self.serializer))
+                    batch = _take(iterator, self.batch_size)
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def get_output_sink(output_filepath: str, save_as_json: bool = False, serializer: Serializer = None) -> OutputSink:
+    """The output format follows the suffix of `output_filepath`: `.gz`/`.zst` for compressed JSONL,
+    `.parquet`/`.arrow`/`.feather` for columnar files, otherwise JSONL or, with `save_as_json`, a JSON array."""
+    if columnar_format_of(output_filepath) is not None or compression_of(output_filepath) is not None:
+        if save_as_json:
+            raise ValueError(f"`save_as_json` writes a plain JSON array, which doesn't fit '{output_filepath}'.")
+    if columnar_format_of(output_filepath) is not None:
+        return ColumnarSink(output_filepath, serializer=serializer)
+    if save_as_json:
+        return JsonSink(output_filepath, serializer=serializer)
+    return JsonlSink(output_filepath, serializer=serializer)
+
+
+def recover_output(output_filepath: str):
+    """Fold results left in a staging file by an interrupted JSON/columnar run back into the output file,
+    and drop a torn last batch of compressed JSONL."""
+    if columnar_format_of(output_filepath) is not None:
+        sink = ColumnarSink(output_filepath)
+    else:
+        sink = JsonSink(output_filepath)
+    if os.path.isfile(sink.staging_filepath):
+        sink.finalize(sort_by_id=True)
+    if compression_of(output_filepath) is not None and os.path.isfile(output_filepath):
+        JsonlSink(output_filepath).repair()
+
+
+def remove_output(output_filepath: str):
+    if os.path.isfile(output_filepath):
+        os.remove(output_filepath)
+    StagedSink(output_filepath).remove()
@@ -0,0 +1,111 @@
+import time
+import dataclasses
+from typing import Callable, Dict, List, Optional, Set
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+# `finish_reason` of a choice that a stop predicate cut short, it isn't one the API returns
+EARLY_STOP_FINISH_REASON = "early_stop"
+
+
+def is_early_stopped(completion: ChatCompletion) -> bool:
+    return any(choice.finish_reason == EARLY_STOP_FINISH_REASON for choice in completion.choices)
+
+
+@dataclasses.dataclass
+class StreamStats:
+    time_to_first_token: Optional[float] = None
+    inter_token_latency: Optional[float] = None
+    total_time: float = 0.0
+    num_chunks: int = 0
+    early_stopped: bool = False
+
+
+class StreamAccumulator(object):
+    """Builds a `ChatCompletion` from streamed chunks, timing them and checking early-stop predicates.
+
+    A predicate receives the text generated so far for one choice and returns True once the answer is
+    settled. The stream should be closed as soon as `add` returns True, once every choice is settled.
+    A settled choice stays settled, so predicates are only asked about choices that got new text.
+    """
+    def __init__(self, stop_predicates: List[Callable[[str], bool]] = None, start_time: float = None):
+        self.stop_predicates = stop_predicates or []
+        self.start_time = time.monotonic() if start_time is None else start_time
+        self.first_token_time = None
+        self.last_token_time = None
+        self.num_chunks = 0
+        self.texts: Dict[int, str] = {}
+        self.finish_reasons: Dict[int, str] = {}
+        self.settled: Set[int] = set()
+        self.usage: Optional[CompletionUsage] = None
+        self.last_chunk: Optional[ChatCompletionChunk] = None
+        self.early_stopped = False
+
+    def add(self, chunk: ChatCompletionChunk) -> bool:
+        now = time.monotonic()
+        self.last_chunk = chunk
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        updated = []
+        for choice in chunk.choices:
+            if choice.delta is not None and choice.delta.content:
+                # popped first, so the text is only referenced here and CPython extends it in place
+                text = self.texts.pop(choice.index, "")
+                text += choice.delta.content
+                self.texts[choice.index] = text
+                updated.append(choice.index)
+            elif choice.index not in self.texts:
+                self.texts[choice.index] = ""
+            if choice.finish_reason is not None:
+                self.finish_reasons[choice.index] = choice.finish_reason
+                self.settled.add(choice.index)
+        if len(updated) > 0:
+            if self.first_token_time is None:
+                self.first_token_time = now
+            self.last_token_time = now
+            self.num_chunks += 1
+            if len(self.stop_predicates) > 0 and self.update_settled(updated):
+                self.early_stopped = True
+                return True
+        return False
+
+    def update_settled(self, indices: List[int]) -> bool:
+        """Ask the predicates about the choices in `indices`; True once every choice is settled."""
+        for index in indices:
+            if index not in self.settled and any(predicate(self.texts[index]) for predicate in self.stop_predicates):
+                self.settled.add(index)
+        return all(index in self.settled for index in self.texts)
+
+    def stats(self) -> StreamStats:
+        stats = StreamStats(
+            total_time=time.monotonic() - self.start_time,
+            num_chunks=self.num_chunks,
+            early_stopped=self.early_stopped,
+        )
+        if self.first_token_time is not None:
+            stats.time_to_first_token = self.first_token_time - self.start_time
+            if self.num_chunks > 1:
+                stats.inter_token_latency = (self.last_token_time - self.first_token_time) / (self.num_chunks - 1)
+        return stats
+
+    def to_completion(self) -> ChatCompletion:
+        chunk = self.last_chunk
+        choices = []
+        for index in sorted(self.texts):
+            message = ChatCompletionMessage(role="assistant", content=self.texts[index])
+            if index not in self.finish_reasons and self.early_stopped:
+                # not validated, `finish_reason` only allows the values of the API
+                choices.append(Choice.model_construct(
+                    index=index, finish_reason=EARLY_STOP_FINISH_REASON, logprobs=None, message=message,
+                ))
+            else:
+                choices.append(Choice(index=index, finish_reason=self.finish_reasons.get(index, "stop"), message=message))
+        return ChatCompletion(
+            id=chunk.id if chunk is not None else "",
+            choices=choices,
+            created=chunk.created if chunk is not None else int(time.time()),
+            model=chunk.model if chunk is not None else "",
+            object="chat.completion",
+            usage=self.usage,
+        )
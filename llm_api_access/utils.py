@@ -1,8 +1,19 @@
 import os
 import json
 import logging
-from typing import Callable
+import itertools
+from typing import Callable, Iterable, Sized
 from .arguments import DataArguments
+from .id_index import IdIndex
+from .serialization import get_serializer
+from .sinks import (
+    columnar_format_of,
+    compression_of,
+    is_empty_output,
+    iter_items,
+    recover_output,
+    remove_output,
+)
 
 
 def get_logger(output_dir: str):
@@ -34,40 +45,84 @@ def save2jsonl(name, data):
 
 
 def readjson2list(name):
+    """Load a JSON list or a JSONL file, or any other output format (see `sinks.iter_items`), as a list."""
+    if compression_of(name) is not None or columnar_format_of(name) is not None:
+        return list(iter_items(name))
+    serializer = get_serializer()
     data = []
-    with open(name, "r", encoding="utf-8") as file:
+    with open(name, "rb") as file:
         try:
-            data = json.load(file)
+            data = serializer.loads(file.read())
         except Exception:
+            file.seek(0)
             for line in file:
-                dict_obj = json.loads(line.strip())
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                dict_obj = serializer.loads(line)
                 data.append(dict_obj)
     return data
 
 
+def iter_output_ids(name):
+    """Yield the `id` of every item in an output file of any format, streaming JSONL line by line and only
+    reading the `id` column of Parquet/Arrow files."""
+    for item in iter_items(name, columns=["id"]):
+        yield item['id']
+
+
 def omit_existing_data_wrapper(data_processor_func: Callable):
+    """Drop the items whose `id` is already in `output_filepath`.
+
+    If `data_processor_func` returns a list, a filtered list is returned; any other iterable
+    (e.g. a generator) is filtered lazily, so the dataset is never materialized.
+    """
     def data_processor(data_args: DataArguments):
         dataset = data_processor_func(data_args)
 
+        id_index = IdIndex(data_args.output_filepath)
+        if not data_args.regenerate:
+            recover_output(data_args.output_filepath)
         if os.path.isfile(data_args.output_filepath) and not data_args.regenerate:
-            is_empty_file = False
-            with open(data_args.output_filepath) as fin:
-                if len(fin.read().strip()) == 0:
-                    os.remove(data_args.output_filepath)
-                    is_empty_file = True
-
-            exist_data = readjson2list(data_args.output_filepath) if not is_empty_file else []
-            exist_data_ids = set([item['id'] for item in exist_data])
-            data_remains = [item for item in dataset if item['id'] not in exist_data_ids]
-            dataset = data_remains
-        else:
-            if os.path.isfile(data_args.output_filepath):
+            if is_empty_output(data_args.output_filepath):
                 os.remove(data_args.output_filepath)
+                id_index.remove()
+                return dataset
+
+            # the index is written by `Consumer`; rebuild it once for outputs of older runs or edited files
+            if not id_index.is_fresh():
+                id_index.rebuild(iter_output_ids(data_args.output_filepath))
+            try:
+                exist_data_ids = id_index.load()
+            except ValueError:
+                id_index.rebuild(iter_output_ids(data_args.output_filepath))
+                exist_data_ids = id_index.load()
+            if len(exist_data_ids) == 0:
+                return dataset
+            if isinstance(dataset, list):
+                dataset = [item for item in dataset if item['id'] not in exist_data_ids]
+            else:
+                dataset = (item for item in dataset if item['id'] not in exist_data_ids)
+        else:
+            remove_output(data_args.output_filepath)
+            id_index.remove()
         return dataset
 
     return data_processor
 
 
+def peek_iterable(iterable: Iterable):
+    """Return `(is_empty, iterable)` without losing the first item of a one-shot iterator."""
+    if isinstance(iterable, Sized):
+        return len(iterable) == 0, iterable
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return True, iterator
+    return False, itertools.chain([first], iterator)
+
+
 def llm_inputs_wrapper(llm_inputs_func: Callable):
     def llm_inputs_processor(inputs: dict, prompt_template: str, chat_one_turn_func):
         prompt = llm_inputs_func(inputs, prompt_template)
@@ -77,3 +132,14 @@ def llm_inputs_wrapper(llm_inputs_func: Callable):
         return prompt, result, err_msg
 
     return llm_inputs_processor
+
+
+def async_llm_inputs_wrapper(llm_inputs_func: Callable):
+    async def llm_inputs_processor(inputs: dict, prompt_template: str, chat_one_turn_func):
+        prompt = llm_inputs_func(inputs, prompt_template)
+        if isinstance(prompt, str):
+            prompt = {"prompt": prompt}
+        result, err_msg = await chat_one_turn_func(**prompt)
+        return prompt, result, err_msg
+
+    return llm_inputs_processor
@@ -0,0 +1,35 @@
+import json
+import logging
+
+from llm_api_access import EntireArguments
+from llm_api_access.batch_runner import BatchLLMRunner
+
+
+def test_prompt_overrides_generation_arguments(tmp_path):
+    def prepare_llm_inputs(inputs: dict, prompt_template: str):
+        return {"prompt": inputs["query"], "max_completion_tokens": 8}
+
+    arguments = EntireArguments(
+        llm="mock",
+        api_key="sk-test",
+        base_url="http://127.0.0.1:9/v1",
+        output_filepath=str(tmp_path / "output.jsonl"),
+        max_completion_tokens=256,
+        use_batch_api=True,
+        generate_log_file=False,
+    )
+    runner = BatchLLMRunner(
+        arguments=arguments,
+        prompt_template="{query}",
+        producer_process_func=prepare_llm_inputs,
+        consumer_postprocess_func=None,
+        logger=logging.getLogger("test"),
+    )
+    try:
+        [shard] = runner.write_shards([{"id": 0, "query": "q"}], str(tmp_path), skip_ids=set())
+        with open(shard.requests_filepath) as f:
+            body = json.loads(f.readline())["body"]
+        assert body["max_completion_tokens"] == 8
+        assert body["temperature"] == arguments.temperature
+    finally:
+        runner.close()
@@ -0,0 +1,43 @@
+import asyncio
+import threading
+
+from llm_api_access.concurrency import AdaptiveConcurrencyLimiter
+
+
+def test_async_acquire_respects_limit_and_survives_cancellation():
+    limiter = AdaptiveConcurrencyLimiter(min_limit=4, max_limit=4)
+    state = {"active": 0, "peak": 0, "done": 0}
+
+    async def task():
+        await limiter.async_acquire()
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        await asyncio.sleep(0.001)
+        state["active"] -= 1
+        limiter.release(0.001)
+        state["done"] += 1
+
+    async def main():
+        tasks = [asyncio.create_task(task()) for _ in range(200)]
+        await asyncio.sleep(0.005)
+        for waiting in tasks[100:120]:
+            waiting.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(main())
+    assert state["peak"] == 4
+    assert state["done"] == 180
+    assert limiter.in_flight == 0
+    assert len(limiter.async_waiters) == 0
+
+
+def test_async_waiter_woken_by_release_from_another_thread():
+    limiter = AdaptiveConcurrencyLimiter(min_limit=1, max_limit=1)
+    limiter.acquire()
+
+    async def main():
+        threading.Timer(0.05, limiter.release, args=(0.05,)).start()
+        await asyncio.wait_for(limiter.async_acquire(), timeout=5)
+
+    asyncio.run(main())
+    assert limiter.in_flight == 1
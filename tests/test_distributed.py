@@ -0,0 +1,145 @@
+import json
+import time
+import threading
+
+import pytest
+
+from llm_api_access.distributed import LeaseKeeper, WorkQueue, merge_output_shards, output_shard_path
+
+
+def make_queue(tmp_path, worker_id: str, lease_seconds: float = 600) -> WorkQueue:
+    return WorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=lease_seconds, worker_id=worker_id)
+
+
+def fill(queue: WorkQueue, num_items: int = 10, unit_size: int = 4) -> bool:
+    return queue.initialize(lambda: [{"id": idx} for idx in range(num_items)], unit_size=unit_size)
+
+
+def test_initialize_once(tmp_path):
+    first, second = make_queue(tmp_path, "a"), make_queue(tmp_path, "b")
+    assert fill(first)
+    assert not fill(second)
+    assert first.num_unfinished() == 3
+
+
+def test_units_are_claimed_once(tmp_path):
+    first, second = make_queue(tmp_path, "a"), make_queue(tmp_path, "b")
+    fill(first)
+    claimed = [first.claim(), second.claim(), first.claim(), second.claim()]
+    assert [unit.unit_id for unit in claimed[:3]] == [0, 1, 2]
+    assert claimed[3] is None
+    assert [item["id"] for item in claimed[0].items] == [0, 1, 2, 3]
+
+
+def test_expired_lease_is_reclaimed_and_old_owner_cannot_complete(tmp_path):
+    first, second = make_queue(tmp_path, "a", lease_seconds=0.2), make_queue(tmp_path, "b", lease_seconds=0.2)
+    fill(first, num_items=4)
+    unit = first.claim()
+    assert second.claim() is None
+    time.sleep(0.3)
+    taken_over = second.claim()
+    assert taken_over.unit_id == unit.unit_id
+
+    assert not first.renew(unit)
+    assert not first.complete(unit)
+    assert first.num_unfinished() == 1
+    assert second.complete(taken_over)
+    assert first.num_unfinished() == 0
+
+
+def test_lease_keeper_renews_and_closes_its_connection(tmp_path):
+    queue = make_queue(tmp_path, "a", lease_seconds=0.3)
+    fill(queue, num_items=4)
+    unit = queue.claim()
+    with LeaseKeeper(queue, unit) as keeper:
+        time.sleep(0.6)
+        assert make_queue(tmp_path, "b", lease_seconds=0.3).claim() is None
+    assert not keeper.thread.is_alive()
+    assert queue.complete(unit)
+
+
+def test_merge_claim_is_exclusive_and_taken_over_after_expiry(tmp_path):
+    first, second = make_queue(tmp_path, "a", lease_seconds=0.2), make_queue(tmp_path, "b", lease_seconds=0.2)
+    fill(first)
+    assert first.claim_merge()
+    assert not second.claim_merge()
+    # the first worker died while merging
+    time.sleep(0.3)
+    assert second.claim_merge()
+    assert not first.renew_merge()
+    assert second.complete_merge()
+    assert not first.claim_merge()
+
+
+def test_concurrent_workers_complete_every_unit(tmp_path):
+    fill(make_queue(tmp_path, "init"), num_items=200, unit_size=5)
+    done = []
+
+    def work(worker_id: str):
+        queue = make_queue(tmp_path, worker_id)
+        for unit in queue.iter_units():
+            assert queue.complete(unit)
+            done.append(unit.unit_id)
+        queue.close()
+
+    threads = [threading.Thread(target=work, args=(f"w{idx}",)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(done) == list(range(40))
+
+
+def test_merge_output_shards_drops_duplicates(tmp_path):
+    output_filepath = str(tmp_path / "output.jsonl")
+    for worker_id, ids in [("a", [3, 1, 2]), ("b", [2, 0])]:
+        with open(output_shard_path(output_filepath, worker_id), "w", encoding="utf-8") as fout:
+            fout.writelines(json.dumps({"id": _id, "worker": worker_id}) + "\n" for _id in ids)
+    assert merge_output_shards(output_filepath) == 4
+    with open(output_filepath, encoding="utf-8") as fin:
+        assert [json.loads(line)["id"] for line in fin] == [0, 1, 2, 3]
+    assert not (tmp_path / "output.jsonl.shard-a.jsonl").exists()
+
+
+def test_released_unit_goes_back_to_the_queue(tmp_path):
+    first, second = make_queue(tmp_path, "a"), make_queue(tmp_path, "b")
+    fill(first, num_items=4)
+    unit = first.claim()
+    assert first.release(unit)
+    assert not first.complete(unit)
+    assert second.claim().unit_id == unit.unit_id
+    assert not first.release(unit)
+
+
+def test_failed_run_releases_its_unit(tmp_path):
+    from llm_api_access import EntireArguments, LLMRunnerWrapperBase
+    from llm_api_access.llm_runner import RunFailedError
+
+    class Runner(LLMRunnerWrapperBase):
+        def load_data(self, data_args):
+            return [{"id": idx, "query": "q"} for idx in range(8)]
+
+        def prepare_llm_inputs(self, inputs: dict, prompt_template: str):
+            return inputs["query"]
+
+        def postprocess_llm_outputs(self, inputs: dict, response: str, prompt: str, *args, **kwargs):
+            return {"id": inputs["id"], "response": response}
+
+    arguments = EntireArguments(
+        llm="mock",
+        api_key="sk-test",
+        base_url="http://127.0.0.1:9/v1",
+        # a directory that doesn't exist yet
+        output_filepath=str(tmp_path / "outputs" / "output.jsonl"),
+        few_shot_filepath=str(tmp_path / "missing.json"),
+        work_queue_path=str(tmp_path / "queue.sqlite"),
+        worker_id="a",
+        num_threads=2,
+        generate_log_file=False,
+    )
+    with pytest.raises(RunFailedError):
+        Runner(arguments=arguments, prompt_template="{query}").run_llm_api()
+    assert (tmp_path / "outputs").is_dir()
+    queue = make_queue(tmp_path, "b")
+    assert queue.num_unfinished() == 1
+    assert queue.claim() is not None
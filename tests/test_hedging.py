@@ -0,0 +1,61 @@
+import time
+import threading
+
+from llm_api_access import EntireArguments
+from llm_api_access.hedging import HedgingPolicy
+from llm_api_access.llm_requester import LLMRequester, MAX_HEDGE_LOSERS
+
+
+def make_requester(hedging: HedgingPolicy) -> LLMRequester:
+    arguments = EntireArguments(llm="mock", api_key="sk-test", base_url="http://127.0.0.1:9/v1", generate_log_file=False)
+    return LLMRequester(arguments=arguments, hedging=hedging)
+
+
+def warmed_up_policy(delay: float) -> HedgingPolicy:
+    hedging = HedgingPolicy(min_delay=delay, min_samples=1, budget=1.0)
+    hedging.observe(delay)
+    return hedging
+
+
+def test_policy_delay_and_budget():
+    hedging = HedgingPolicy(percentile=0.5, budget=0.5, min_delay=0.1, min_samples=3)
+    assert hedging.hedge_delay() is None
+    for latency in [1.0, 2.0, 3.0]:
+        hedging.observe(latency)
+    assert hedging.hedge_delay() == 2.0
+    assert hedging.try_hedge()
+    assert not hedging.try_hedge()
+    assert hedging.num_skipped == 1
+
+
+def test_losers_dont_delay_later_requests():
+    requester = make_requester(warmed_up_policy(0.05))
+    calls, lock = [], threading.Lock()
+    release_losers = threading.Event()
+
+    def request_api(payload, cancelled=None):
+        with lock:
+            calls.append(payload)
+            is_primary = len(calls) % 2 == 1
+        if is_primary:
+            # a blocking non-streamed request that ignores `cancelled`
+            release_losers.wait(5)
+            return "slow"
+        return "fast"
+
+    requester.request_api = request_api
+    start = time.monotonic()
+    results = [requester.hedged_request_api({"idx": idx}) for idx in range(MAX_HEDGE_LOSERS)]
+    assert results == ["fast"] * MAX_HEDGE_LOSERS
+    # each call took about the hedge delay, none waited for the losers of earlier calls
+    assert time.monotonic() - start < 2.0
+    assert requester.num_hedge_losers == MAX_HEDGE_LOSERS
+
+    # the pool is full of losers: no more hedges, the primary is waited for
+    calls.clear()
+    threading.Timer(0.2, release_losers.set).start()
+    assert requester.hedged_request_api({"idx": "last"}) == "slow"
+    assert len(calls) == 1
+
+    requester.close()
+    assert requester.hedge_executor is None
@@ -0,0 +1,61 @@
+import os
+import json
+
+from llm_api_access.arguments import DataArguments
+from llm_api_access.id_index import IdIndex
+from llm_api_access.utils import omit_existing_data_wrapper
+
+
+def write_output(filepath: str, ids: list):
+    # like the `Consumer`: the output first, then the index
+    with open(filepath, "w", encoding="utf-8") as fout:
+        fout.writelines(json.dumps({"id": _id, "response": "r"}) + "\n" for _id in ids)
+    IdIndex(filepath).append(ids)
+
+
+def remaining_ids(filepath: str, num_items: int = 10) -> list:
+    dataset = omit_existing_data_wrapper(lambda data_args: [{"id": idx} for idx in range(num_items)])
+    return [item["id"] for item in dataset(DataArguments(output_filepath=filepath))]
+
+
+def test_resume_reads_the_index(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    write_output(filepath, [0, 1, 2])
+    assert remaining_ids(filepath) == list(range(3, 10))
+
+
+def test_resume_without_index(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    write_output(filepath, [0, 1, 2, 5])
+    os.remove(filepath + IdIndex.suffix)
+    assert remaining_ids(filepath) == [3, 4, 6, 7, 8, 9]
+    assert IdIndex(filepath).load() == {0, 1, 2, 5}
+
+
+def test_resume_with_stale_index(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    write_output(filepath, [0, 1])
+    # the output got more items after the index was last written, e.g. edited by hand
+    with open(filepath, "a", encoding="utf-8") as fout:
+        fout.write(json.dumps({"id": 7, "response": "r"}) + "\n")
+    index_filepath = filepath + IdIndex.suffix
+    output_mtime = os.stat(filepath).st_mtime_ns
+    os.utime(index_filepath, ns=(output_mtime - 10 ** 9, output_mtime - 10 ** 9))
+    assert remaining_ids(filepath) == [2, 3, 4, 5, 6, 8, 9]
+
+
+def test_resume_with_garbled_index(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    write_output(filepath, [0, 1, 2, 3])
+    with open(filepath + IdIndex.suffix, "wb") as fout:
+        fout.write(b"0\n\xff\xfegarbage\n3\n")
+    assert remaining_ids(filepath) == list(range(4, 10))
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    write_output(filepath, [0, 1])
+    with open(filepath + IdIndex.suffix, "a", encoding="utf-8") as fout:
+        fout.write('"unfinis')
+    assert IdIndex(filepath).load() == {0, 1}
+    assert remaining_ids(filepath) == list(range(2, 10))
@@ -0,0 +1,22 @@
+from llm_api_access import images
+from llm_api_access.images import ImageEncoder
+
+
+def test_path_hashes_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, "MAX_PATH_HASHES", 4)
+    encoder = ImageEncoder(cache_size_mb=1)
+    paths = []
+    for idx in range(10):
+        path = tmp_path / f"{idx}.png"
+        path.write_bytes(b"image %d" % (idx % 3))
+        paths.append(str(path))
+    for path in paths:
+        assert encoder.encode(path).startswith("data:image/png;base64,")
+    assert len(encoder.path_hashes) == 4
+    # same content under another path is read again, but encoded once
+    assert encoder.misses == 3
+
+    # a recent path needs no read, its content is served from the cache
+    hits = encoder.hits
+    encoder.encode(paths[-1])
+    assert encoder.hits == hits + 1 and encoder.bytes_in == sum(len(b"image 0") for _ in paths)
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from llm_api_access.pipeline import Stage, async_pipeline_wrapper, check_stages, pipeline_wrapper
+
+
+STAGES = [
+    Stage("draft", lambda inputs, outputs: f"draft {inputs['id']}"),
+    Stage("refine", lambda inputs, outputs: f"refine {outputs['draft'][0]}"),
+]
+
+
+class FakeChat(object):
+    """`chat_one_turn` that fails the prompts in `failing` once."""
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.prompts = []
+
+    def __call__(self, prompt, return_choices=True, **kwargs):
+        self.prompts.append(prompt)
+        if prompt in self.failing:
+            self.failing.discard(prompt)
+            return None, "server error"
+        return [f"ans({prompt})"], ""
+
+
+def test_check_stages():
+    with pytest.raises(ValueError):
+        check_stages([])
+    with pytest.raises(ValueError):
+        check_stages([Stage("a", None), Stage("a", None)])
+
+
+def test_retry_resumes_at_the_failed_stage():
+    process = pipeline_wrapper(STAGES)
+    chat = FakeChat(failing=["refine ans(draft 1)"])
+    item = {"id": 1}
+
+    _, response, err_msg = process(item, "", chat)
+    assert response is None and err_msg == "server error"
+    _, response, err_msg = process(item, "", chat)
+    assert err_msg == ""
+    assert response == {"draft": ["ans(draft 1)"], "refine": ["ans(refine ans(draft 1))"]}
+    # the draft was not requested again
+    assert chat.prompts.count("draft 1") == 1
+    assert len(process.state) == 0
+
+
+def test_state_follows_the_item_id_not_the_object():
+    process = pipeline_wrapper(STAGES)
+    chat = FakeChat(failing=["refine ans(draft 7)"])
+    process({"id": 7}, "", chat)
+    del chat.prompts[:]
+
+    # a different item, possibly at the address of the freed one, starts from scratch
+    _, response, _ = process({"id": 8}, "", chat)
+    assert response["draft"] == ["ans(draft 8)"]
+    # a copy of the failed item, e.g. deserialized again, resumes
+    _, response, _ = process({"id": 7}, "", chat)
+    assert response["draft"] == ["ans(draft 7)"]
+    assert "draft 7" not in chat.prompts
+
+
+def test_given_up_items_are_forgotten():
+    process = pipeline_wrapper(STAGES)
+    process({"id": 3}, "", FakeChat(failing=["refine ans(draft 3)"]))
+    assert len(process.state) == 1
+    process.state.discard({"id": 3})
+    assert len(process.state) == 0
+
+
+def test_async_pipeline():
+    process = async_pipeline_wrapper(STAGES)
+    chat = FakeChat(failing=["refine ans(draft 2)"])
+
+    async def async_chat(**kwargs):
+        return chat(**kwargs)
+
+    async def main():
+        first = await process({"id": 2}, "", async_chat)
+        second = await process({"id": 2}, "", async_chat)
+        return first, second
+
+    (_, _, err_msg), (_, response, _) = asyncio.run(main())
+    assert err_msg == "server error"
+    assert response["refine"] == ["ans(refine ans(draft 2))"]
+    assert len(process.state) == 0
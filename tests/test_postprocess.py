@@ -0,0 +1,83 @@
+import os
+import json
+import signal
+import logging
+import multiprocessing
+from queue import Queue
+
+from llm_api_access.llm_runner import Consumer
+from llm_api_access.postprocess import get_postprocessor, start_postprocess_pool
+
+
+def add_suffix(inputs: dict, response: str, suffix: str = "", **kwargs):
+    return {"id": inputs["id"], "output": response + suffix}
+
+
+def test_results_come_back_in_order():
+    executor = start_postprocess_pool(add_suffix, num_workers=2)
+    try:
+        # the pool outlives a postprocessor, like it outlives a run of the runner
+        for suffix in ["!", "?"]:
+            postprocessor = get_postprocessor(add_suffix, 2, True, executor, suffix=suffix)
+            for idx in range(20):
+                postprocessor.submit({"id": idx}, str(idx), {})
+            collected = []
+            while postprocessor.num_pending > 0:
+                collected += postprocessor.collect(timeout=5.0)
+            postprocessor.close()
+            assert [result for _, result, _, _ in collected] == [
+                {"id": idx, "output": f"{idx}{suffix}"} for idx in range(20)
+            ]
+    finally:
+        executor.shutdown(wait=True)
+
+
+def die_in_worker(inputs: dict, response: str, **kwargs):
+    if inputs["id"] == 3 and multiprocessing.parent_process() is not None:
+        os._exit(1)
+    return {"id": inputs["id"], "output": response}
+
+
+def test_broken_pool_falls_back_to_the_consumer_thread():
+    executor = start_postprocess_pool(die_in_worker, num_workers=2)
+    try:
+        postprocessor = get_postprocessor(die_in_worker, 2, True, executor)
+        collected = []
+        for idx in range(20):
+            postprocessor.submit({"id": idx}, str(idx), {})
+            collected += postprocessor.collect(timeout=0.01)
+        while postprocessor.num_pending > 0:
+            collected += postprocessor.collect(timeout=5.0)
+        assert postprocessor.broken is not None
+        assert [result for _, result, _, _ in collected] == [{"id": idx, "output": str(idx)} for idx in range(20)]
+    finally:
+        executor.shutdown(wait=True)
+
+
+def test_inline_without_workers():
+    postprocessor = get_postprocessor(add_suffix, 0, True, None, suffix="!")
+    postprocessor.submit({"id": 0}, "0", {})
+    [(inputs, result, exception, _)] = postprocessor.collect()
+    assert result == {"id": 0, "output": "0!"} and exception is None
+
+
+def test_consumer_writes_everything_and_fails_when_the_pool_breaks(tmp_path):
+    executor = start_postprocess_pool(die_in_worker, num_workers=2)
+    try:
+        queue = Queue()
+        output_filename = str(tmp_path / "output.jsonl")
+        consumer = Consumer(
+            queue=queue, num_producers=1, num_dataitems=20, output_filename=output_filename, save_as_json=False,
+            logger=logging.getLogger("test"), postprocess_func=die_in_worker, postprocess_workers=2,
+            postprocess_pool=executor,
+        )
+        consumer.run()
+        for idx in range(20):
+            queue.put(({"id": idx}, {}, str(idx)))
+        queue.put(signal.SIGTERM)
+        consumer.join()
+        assert consumer.exception is not None
+        with open(output_filename) as f:
+            assert sorted(json.loads(line)["id"] for line in f) == list(range(20))
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,68 @@
+import pytest
+
+from llm_api_access.rate_limiter import RateLimiter, estimate_payload_tokens
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_request_bucket_limits_and_refills():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, clock=clock)
+    # a full minute's budget right away, then one request per second
+    for _ in range(60):
+        assert limiter._try_acquire(0) == 0.0
+    assert limiter._try_acquire(0) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert limiter._try_acquire(0) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limiter._try_acquire(0) == 0.0
+    assert limiter._try_acquire(0) == pytest.approx(1.0)
+    # refilling stops at the capacity
+    clock.now += 3600
+    for _ in range(60):
+        assert limiter._try_acquire(0) == 0.0
+    assert limiter._try_acquire(0) > 0
+
+
+def test_token_bucket_waits_for_the_larger_deficit():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=6000, clock=clock)
+    assert limiter._try_acquire(5000) == 0.0
+    # 1000 tokens left, 2000 more refill in 20s at 100 tokens/s
+    assert limiter._try_acquire(3000) == pytest.approx(20.0)
+    # nothing was taken by the refused request
+    clock.now += 20.0
+    assert limiter._try_acquire(3000) == 0.0
+    # more than the capacity waits for a full bucket, not forever
+    assert limiter._try_acquire(10 ** 6) == pytest.approx(60.0)
+
+
+def test_correct_pause_and_headers():
+    clock = FakeClock()
+    limiter = RateLimiter(tokens_per_minute=6000, clock=clock)
+    assert limiter._try_acquire(4000) == 0.0
+    limiter.correct(estimated_tokens=4000, actual_tokens=1000)
+    assert limiter.token_bucket.level == pytest.approx(5000)
+    limiter.update_from_headers({"x-ratelimit-limit-tokens": "3000", "x-ratelimit-remaining-tokens": "1200"})
+    assert limiter.token_bucket.capacity == 3000 and limiter.token_bucket.level == pytest.approx(1200)
+    limiter.pause()
+    # 3000 tokens per minute refill at 50 tokens/s
+    assert limiter._try_acquire(100) == pytest.approx(2.0)
+
+
+def test_estimate_counts_completion_budget_and_images():
+    payload = {
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "x" * 400},
+            {"type": "image_url", "image_url": {"url": "data:", "detail": "low"}},
+        ]}],
+        "max_completion_tokens": 100,
+        "n": 2,
+    }
+    assert estimate_payload_tokens(payload) == 85 + 4 + 101 + 200
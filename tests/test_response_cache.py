@@ -0,0 +1,106 @@
+import os
+import time
+import asyncio
+import logging
+
+from openai.types.chat import ChatCompletion
+
+from llm_api_access.response_cache import ResponseCache, payload_cache_key
+from llm_api_access.streaming import StreamAccumulator
+
+from test_streaming import make_chunk
+
+
+def make_completion(content: str) -> ChatCompletion:
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "mock",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    })
+
+
+def entry_sizes(cache: ResponseCache) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _, filenames in os.walk(cache.cache_dir) for filename in filenames
+    )
+
+
+def test_put_get_roundtrip(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put("ab" * 32, make_completion("hello"))
+    assert cache.get("ab" * 32).choices[0].message.content == "hello"
+    assert cache.get("cd" * 32) is None
+
+
+def test_early_stopped_completions_are_not_cached(tmp_path):
+    accumulator = StreamAccumulator(stop_predicates=[lambda text: "ANSWER" in text])
+    accumulator.add(make_chunk({0: "ANSWER"}))
+    cache = ResponseCache(str(tmp_path))
+    payload = {"model": "mock", "messages": [{"role": "user", "content": "q"}], "temperature": 0.0}
+    completion = cache.get_or_request(payload, lambda payload: accumulator.to_completion())
+    assert completion.choices[0].message.content == "ANSWER"
+    # a run without the predicate gets the whole text
+    completion = cache.get_or_request(payload, lambda payload: make_completion("ANSWER and more"))
+    assert completion.choices[0].message.content == "ANSWER and more"
+
+
+def test_overwrite_keeps_total_size(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    for content in ["x" * 1000, "y" * 10, "z" * 500]:
+        cache.put("ab" * 32, make_completion(content))
+    assert cache.total_size == entry_sizes(cache)
+
+
+def test_evicts_oldest_entries(tmp_path):
+    completion = make_completion("x" * 2000)
+    entry_size = len(completion.model_dump_json().encode("utf-8"))
+    cache = ResponseCache(str(tmp_path), max_size_mb=10 * entry_size / 1024 / 1024)
+    keys = [payload_cache_key({"idx": idx}) for idx in range(15)]
+    for idx, key in enumerate(keys):
+        cache.put(key, completion)
+        # distinct mtimes, so eviction order is well defined
+        os.utime(cache.entry_path(key), (1000 + idx, 1000 + idx))
+
+    assert cache.total_size <= cache.max_size
+    assert cache.total_size == entry_sizes(cache)
+    assert cache.get(keys[-1]) is not None
+    assert cache.get(keys[0]) is None
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_age_hours=1)
+    key = "ab" * 32
+    cache.put(key, make_completion("old"))
+    os.utime(cache.entry_path(key), (time.time() - 7200, time.time() - 7200))
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.entry_path(key))
+
+
+def test_put_failure_is_logged_not_raised(tmp_path, caplog):
+    cache = ResponseCache(str(tmp_path), logger=logging.getLogger("test"))
+    # a file where the shard directory should be
+    (tmp_path / "ab").write_text("")
+    cache.put("ab" * 32, make_completion("hello"))
+    assert "Could not write response cache entry" in caplog.text
+
+
+def test_coalesces_identical_requests(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    payload = {"model": "mock", "messages": [], "temperature": 0}
+    calls = []
+
+    async def request(payload):
+        calls.append(payload)
+        await asyncio.sleep(0.05)
+        return make_completion("once")
+
+    async def main():
+        return await asyncio.gather(*[cache.async_get_or_request(payload, request) for _ in range(5)])
+
+    completions = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(completion.choices[0].message.content == "once" for completion in completions)
+    assert cache.get(payload_cache_key(payload)) is not None
@@ -0,0 +1,144 @@
+import signal
+import logging
+import threading
+from queue import Queue
+
+import openai
+
+from llm_api_access.llm_runner import Producer, RunFailedError
+from llm_api_access.retry import ErrorMessage, RequestFailedError, RetryItem, RetryScheduler, is_retryable_error
+
+logger = logging.getLogger("test")
+
+
+def run_with_timeout(func, timeout: float = 10.0):
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "hangs"
+
+
+def test_retries_come_back_through_the_data_queue():
+    data_queue = Queue()
+    scheduler = RetryScheduler(data_queue)
+    scheduler.submitted()
+    scheduler.schedule({"id": 0}, attempt=1, delay=0.01)
+    retry_item = data_queue.get(timeout=5)
+    assert isinstance(retry_item, RetryItem)
+    assert retry_item.item == {"id": 0} and retry_item.attempt == 1
+
+    scheduler.done()
+    assert scheduler.wait_until_done()
+    scheduler.close()
+
+
+def test_cancel_stops_waiting():
+    scheduler = RetryScheduler(Queue(maxsize=1))
+    scheduler.submitted()
+    # the retry thread blocks on the full data queue until cancelled
+    scheduler.data_queue.put("occupied")
+    scheduler.schedule({"id": 0}, attempt=1, delay=0.0)
+    threading.Timer(0.05, scheduler.cancel).start()
+    result = []
+    run_with_timeout(lambda: result.append(scheduler.wait_until_done()))
+    assert result == [False]
+    run_with_timeout(scheduler.close)
+
+
+def test_producer_returns_when_every_worker_fails():
+    def failing_task(data_queue, queue, retry_scheduler, **kwargs):
+        raise FileNotFoundError("few-shot file")
+
+    queue = Queue()
+    # more items than the data queue holds, so putting them would block without workers
+    producer = Producer(task=failing_task, queue=queue, num_threads=3, logger=logger, data_queue_size=4)
+    run_with_timeout(lambda: producer.run(data=[{"id": idx} for idx in range(100)]))
+    producer.join()
+    assert [queue.get(timeout=1) for _ in range(3)] == [signal.SIGTERM] * 3
+
+
+def test_producer_finishes_items_of_a_worker_that_died():
+    def task(data_queue, queue, retry_scheduler, **kwargs):
+        while True:
+            item = data_queue.get()
+            if item is signal.SIGTERM:
+                break
+            try:
+                if item["id"] == 3:
+                    raise RuntimeError("worker bug")
+                queue.put(item)
+            finally:
+                retry_scheduler.done()
+        queue.put(signal.SIGTERM)
+
+    queue = Queue()
+    producer = Producer(task=task, queue=queue, num_threads=2, logger=logger, data_queue_size=4)
+    run_with_timeout(lambda: producer.run(data=[{"id": idx} for idx in range(20)]))
+    producer.join()
+    results = [queue.get(timeout=1) for _ in range(queue.qsize())]
+    assert results.count(signal.SIGTERM) == 2
+    assert len(results) == 2 + 19
+
+
+def test_is_retryable_error():
+    assert is_retryable_error(RequestFailedError(ErrorMessage(openai.APITimeoutError(request=None))))
+    assert is_retryable_error(ValueError("malformed response"))
+    assert not is_retryable_error(RuntimeError("All API_KEY quota exceeded."))
+
+
+def test_run_ends_when_requesters_fail_to_start(tmp_path):
+    from llm_api_access import EntireArguments, LLMRunnerWrapperBase
+
+    class Runner(LLMRunnerWrapperBase):
+        def load_data(self, data_args):
+            return [{"id": idx, "query": "q"} for idx in range(2000)]
+
+        def prepare_llm_inputs(self, inputs: dict, prompt_template: str):
+            return inputs["query"]
+
+        def postprocess_llm_outputs(self, inputs: dict, response: str, prompt: str, *args, **kwargs):
+            return {"id": inputs["id"], "response": response}
+
+    arguments = EntireArguments(
+        llm="mock",
+        api_key="sk-test",
+        base_url="http://127.0.0.1:9/v1",
+        output_filepath=str(tmp_path / "output.jsonl"),
+        few_shot_filepath=str(tmp_path / "missing.json"),
+        num_threads=4,
+        generate_log_file=False,
+    )
+    raised = []
+
+    def run():
+        try:
+            Runner(arguments=arguments, prompt_template="{query}").run_llm_api()
+        except RunFailedError as e:
+            raised.append(e)
+
+    run_with_timeout(run, timeout=30)
+    # no worker got to any item, that isn't a successful run
+    assert len(raised) == 1
+
+
+def test_sdk_retries_are_off_while_the_scheduler_retries(tmp_path):
+    from llm_api_access import EntireArguments
+    from llm_api_access.llm_runner import LLMRunner
+
+    def build_runner(**kwargs) -> LLMRunner:
+        arguments = EntireArguments(
+            llm="mock",
+            api_key="sk-test",
+            base_url="http://127.0.0.1:9/v1",
+            output_filepath=str(tmp_path / "output.jsonl"),
+            generate_log_file=False,
+            **kwargs,
+        )
+        return LLMRunner(
+            arguments=arguments, prompt_template="{query}", producer_process_func=None,
+            consumer_postprocess_func=None, logger=logger,
+        )
+
+    assert build_runner().sdk_max_retries == 0
+    assert build_runner(max_item_retries=0).sdk_max_retries == 5
+    assert build_runner(sdk_max_retries=2).sdk_max_retries == 2
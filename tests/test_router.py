@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import openai
+
+from llm_api_access.http_clients import httpx_module
+from llm_api_access.router import Endpoint, RequestRouter, Route
+
+
+def make_router(num_keys: int = 1, max_concurrency: int = 1) -> RequestRouter:
+    endpoint = Endpoint("mock", "http://127.0.0.1:1/v1")
+    return RequestRouter([Route(endpoint, f"sk-{idx:04d}", max_concurrency=max_concurrency) for idx in range(num_keys)])
+
+
+def quota_error() -> Exception:
+    httpx = httpx_module()
+    request = httpx.Request("POST", "http://127.0.0.1:1/v1/chat/completions")
+    return openai.AuthenticationError("invalid key", response=httpx.Response(401, request=request), body=None)
+
+
+def test_async_waiters_are_woken_by_release():
+    router = make_router(num_keys=2, max_concurrency=2)
+    state = {"active": 0, "peak": 0, "done": 0}
+
+    async def task():
+        route = await router.async_acquire()
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        await asyncio.sleep(0.001)
+        state["active"] -= 1
+        router.release(route, 0.001)
+        state["done"] += 1
+
+    async def main():
+        await asyncio.gather(*[task() for _ in range(100)])
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert state == {"active": 0, "peak": 4, "done": 100}
+    assert len(router.async_waiters) == 0
+    assert time.monotonic() - start < 5
+
+
+def test_disabling_the_last_key_fails_every_waiter():
+    router = make_router(num_keys=1, max_concurrency=1)
+
+    async def main():
+        route = await router.async_acquire()
+        waiting = [asyncio.create_task(router.async_acquire()) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        router.release(route, 0.1, error=quota_error())
+        return await asyncio.wait_for(asyncio.gather(*waiting, return_exceptions=True), timeout=5)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_waits_for_ejected_endpoint():
+    router = make_router(num_keys=1, max_concurrency=0)
+    endpoint = router.routes[0].endpoint
+    endpoint.ejected_until = time.monotonic() + 0.1
+
+    async def main():
+        return await asyncio.wait_for(router.async_acquire(), timeout=5)
+
+    start = time.monotonic()
+    assert asyncio.run(main()) is router.routes[0]
+    assert 0.05 < time.monotonic() - start < 1
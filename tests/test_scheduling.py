@@ -0,0 +1,86 @@
+import json
+import logging
+import threading
+from queue import Queue
+
+import openai
+
+from llm_api_access import EntireArguments
+from llm_api_access.llm_runner import LLMRunner
+from llm_api_access.retry import RetryScheduler, backoff_delay, load_dead_letters
+from llm_api_access.scheduling import RequestCostEstimator, longest_first, request_features
+
+logger = logging.getLogger("test")
+
+
+def test_longest_first_within_the_window():
+    estimator = RequestCostEstimator(lambda item: request_features(item["prompt"], max_completion_tokens=16))
+    items = [{"id": idx, "prompt": "x" * length} for idx, length in enumerate([10, 4000, 200, 9000, 50])]
+    ordered = [scheduled.item["id"] for scheduled in longest_first(items, estimator)]
+    assert ordered == [3, 1, 2, 4, 0]
+    # only the next `window` items are reordered
+    ordered = [scheduled.item["id"] for scheduled in longest_first(items, estimator, window=2)]
+    assert ordered == [1, 2, 3, 4, 0]
+
+
+def test_retries_come_back_in_due_order():
+    data_queue = Queue()
+    scheduler = RetryScheduler(data_queue)
+    for item_id, delay in [(0, 0.3), (1, 0.05), (2, 0.15)]:
+        scheduler.submitted()
+        scheduler.schedule({"id": item_id}, attempt=1, delay=delay)
+    assert [data_queue.get(timeout=5).item["id"] for _ in range(3)] == [1, 2, 0]
+    scheduler.cancel()
+    scheduler.close()
+
+
+def test_backoff_doubles_up_to_the_cap():
+    for attempt, bound in [(0, 1.0), (1, 2.0), (2, 4.0), (5, 10.0), (30, 10.0)]:
+        assert all(0 <= backoff_delay(attempt, 1.0, 10.0) <= bound for _ in range(100))
+
+
+def test_item_is_dead_lettered_after_its_retries(tmp_path):
+    calls = []
+    lock = threading.Lock()
+
+    def producer_process_func(item: dict, prompt_template: str, chat_one_turn_func):
+        with lock:
+            calls.append(item["id"])
+        if item["id"] == 0:
+            raise openai.APITimeoutError(request=None)
+        return {"prompt": item["query"]}, f"answer {item['id']}", ""
+
+    output_filepath = str(tmp_path / "output.jsonl")
+    arguments = EntireArguments(
+        llm="mock",
+        api_key="sk-test",
+        base_url="http://127.0.0.1:9/v1",
+        output_filepath=output_filepath,
+        num_threads=2,
+        max_item_retries=2,
+        retry_base_delay=0.01,
+        retry_max_delay=0.05,
+        generate_log_file=False,
+    )
+    runner = LLMRunner(
+        arguments=arguments,
+        prompt_template="{query}",
+        producer_process_func=producer_process_func,
+        consumer_postprocess_func=lambda inputs, response, *args, **kwargs: {"id": inputs["id"], "response": response},
+        logger=logger,
+    )
+    try:
+        runner.run(
+            data_items=[{"id": idx, "query": "q"} for idx in range(4)], num_threads=2, output_filename=output_filepath,
+        )
+    finally:
+        runner.close()
+
+    # the first attempt plus `max_item_retries` retries, the other items are tried once
+    assert calls.count(0) == 3
+    assert sorted(calls) == [0, 0, 0, 1, 2, 3]
+    with open(output_filepath) as f:
+        assert sorted(json.loads(line)["id"] for line in f) == [1, 2, 3]
+    [record] = [json.loads(line) for line in open(runner.dead_letters.filepath)]
+    assert record["item"]["id"] == 0 and record["attempts"] == 3 and record["error_type"] == "APITimeoutError"
+    assert load_dead_letters(runner.dead_letters.filepath) == [{"id": 0, "query": "q"}]
@@ -0,0 +1,106 @@
+import json
+import random
+
+from llm_api_access.serialization import get_serializer
+from llm_api_access.sinks import ColumnarSink, JsonSink, get_output_sink, iter_items, iter_json_array, sorted_by_id
+
+
+def make_items(num_items: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    return [{"id": idx, "response": f"answer {idx}", "score": rng.random()} for idx in rng.sample(range(num_items), num_items)]
+
+
+def test_sorted_by_id_in_memory():
+    items = make_items(50)
+    assert [item["id"] for item in sorted_by_id(items, chunk_size=100)] == list(range(50))
+
+
+def test_sorted_by_id_spills_and_merges(tmp_path):
+    items = make_items(1000)
+    result = list(sorted_by_id(items, tmp_dir=str(tmp_path), chunk_size=64))
+    assert [item["id"] for item in result] == list(range(1000))
+    assert sorted(result, key=lambda item: item["id"]) == sorted(items, key=lambda item: item["id"])
+    # spilled chunks are cleaned up
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sorted_by_id_string_ids(tmp_path):
+    items = [{"id": name} for name in ["b", "c", "a", "10", "x"]]
+    result = list(sorted_by_id(items, tmp_dir=str(tmp_path), chunk_size=2))
+    assert [item["id"] for item in result] == ["10", "a", "b", "c", "x"]
+
+
+def test_iter_json_array_small_chunks(tmp_path):
+    items = make_items(30) + [123456789, -1.5e10, 1e-7, "数据", [], {}, True, False, None]
+    filepath = tmp_path / "items.json"
+    for indent in [None, 4]:
+        filepath.write_text(json.dumps(items, ensure_ascii=False, indent=indent), encoding="utf-8")
+        for chunk_size in [1, 2, 3, 7, 64]:
+            assert list(iter_json_array(str(filepath), chunk_size=chunk_size)) == items
+
+
+def test_iter_json_array_truncated(tmp_path):
+    filepath = tmp_path / "items.json"
+    filepath.write_text('[{"id": 1}, {"id": 2', encoding="utf-8")
+    try:
+        list(iter_json_array(str(filepath), chunk_size=4))
+    except json.JSONDecodeError:
+        return
+    raise AssertionError("a truncated array should not decode")
+
+
+def test_json_sink_finalize_merges_previous_output(tmp_path):
+    filepath = str(tmp_path / "output.json")
+    items = make_items(300)
+
+    sink = get_output_sink(filepath, save_as_json=True)
+    assert isinstance(sink, JsonSink)
+    sink.write(items[:100])
+    sink.finalize(sort_by_id=True)
+    # a resumed run appends to the staging file and merges it into the existing array
+    sink = get_output_sink(filepath, save_as_json=True)
+    for idx in range(100, 300, 20):
+        sink.write(items[idx: idx + 20])
+    sink.finalize(sort_by_id=True)
+
+    with open(filepath, encoding="utf-8") as fin:
+        assert [item["id"] for item in json.load(fin)] == list(range(300))
+    assert [item["id"] for item in iter_items(filepath)] == list(range(300))
+
+
+def test_jsonl_sink_finalize_sorts(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    items = make_items(200)
+    sink = get_output_sink(filepath)
+    for idx in range(0, 200, 30):
+        sink.write(items[idx: idx + 30])
+    sink.finalize(sort_by_id=True)
+    assert [item["id"] for item in iter_items(filepath)] == list(range(200))
+
+
+def test_jsonl_sink_keeps_big_integers(tmp_path):
+    filepath = str(tmp_path / "output.jsonl")
+    items = [{"id": 1, "value": 2 ** 70 + 1}, {"id": 0, "value": -(2 ** 80) - 1, "text": "12345678901234567890"}]
+    sink = get_output_sink(filepath, serializer=get_serializer("orjson"))
+    sink.write(items)
+    sink.finalize(sort_by_id=True)
+    assert list(iter_items(filepath)) == items[::-1]
+
+
+def test_columnar_sink_writes_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(ColumnarSink, "batch_size", 7)
+    # a column's type only settles in later batches: null, then ints, then floats; another turns nested
+    items = [
+        {"id": idx, "score": None if idx < 10 else (idx if idx < 20 else idx + 0.5), "meta": {"n": idx} if idx == 25 else "x"}
+        for idx in range(30)
+    ]
+    for suffix in ["parquet", "arrow"]:
+        filepath = str(tmp_path / f"output.{suffix}")
+        sink = get_output_sink(filepath)
+        sink.write(items[:15])
+        sink.finalize(sort_by_id=True)
+        # a resumed run merges the existing file
+        sink = get_output_sink(filepath)
+        sink.write(items[15:])
+        sink.finalize(sort_by_id=True)
+        assert list(iter_items(filepath)) == items
@@ -0,0 +1,74 @@
+import time
+
+from openai.types.chat import ChatCompletionChunk
+
+from llm_api_access.streaming import EARLY_STOP_FINISH_REASON, StreamAccumulator, is_early_stopped
+
+
+def make_chunk(deltas: dict, finish_reasons: dict = None) -> ChatCompletionChunk:
+    finish_reasons = finish_reasons or {}
+    indices = sorted(set(deltas) | set(finish_reasons))
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "mock",
+        "choices": [
+            {"index": index, "delta": {"content": deltas.get(index)}, "finish_reason": finish_reasons.get(index)}
+            for index in indices
+        ],
+    })
+
+
+def test_rebuilds_the_completion():
+    accumulator = StreamAccumulator()
+    for token in ["Hel", "lo", " world"]:
+        assert not accumulator.add(make_chunk({0: token, 1: token.upper()}))
+    accumulator.add(make_chunk({}, finish_reasons={0: "stop", 1: "length"}))
+    completion = accumulator.to_completion()
+    assert [choice.message.content for choice in completion.choices] == ["Hello world", "HELLO WORLD"]
+    assert [choice.finish_reason for choice in completion.choices] == ["stop", "length"]
+    stats = accumulator.stats()
+    assert stats.num_chunks == 3 and stats.time_to_first_token is not None
+
+
+def test_stops_once_every_choice_is_settled():
+    calls = []
+
+    def has_answer(text: str) -> bool:
+        calls.append(text)
+        return "ANSWER" in text
+
+    accumulator = StreamAccumulator(stop_predicates=[has_answer])
+    assert not accumulator.add(make_chunk({0: "thinking ", 1: "thinking "}))
+    assert not accumulator.add(make_chunk({0: "ANSWER: 1", 1: "more "}))
+    num_calls = len(calls)
+    # choice 0 is settled and isn't asked about again
+    assert not accumulator.add(make_chunk({0: " trailing", 1: "more "}))
+    assert len(calls) == num_calls + 1
+    assert accumulator.add(make_chunk({1: "ANSWER: 2"}))
+    assert accumulator.early_stopped
+
+
+def test_finished_choices_count_as_settled():
+    accumulator = StreamAccumulator(stop_predicates=[lambda text: text.endswith("!")])
+    assert not accumulator.add(make_chunk({0: "a", 1: "b"}))
+    accumulator.add(make_chunk({}, finish_reasons={0: "stop"}))
+    assert accumulator.add(make_chunk({1: "!"}))
+    completion = accumulator.to_completion()
+    assert [choice.finish_reason for choice in completion.choices] == ["stop", EARLY_STOP_FINISH_REASON]
+    assert is_early_stopped(completion)
+
+
+def test_long_streams_grow_linearly():
+    def timed(num_chunks: int) -> float:
+        accumulator = StreamAccumulator(stop_predicates=[lambda text: False])
+        chunk = make_chunk({0: "token "})
+        start = time.perf_counter()
+        for _ in range(num_chunks):
+            accumulator.add(chunk)
+        return time.perf_counter() - start
+
+    timed(1000)
+    # quadratic work would take ~16x as long for 4x the chunks
+    assert timed(40000) < 10 * timed(10000)